@@ -7,8 +7,13 @@
 
 from flask.ext.script import Manager, Shell, prompt_bool
 from flask.ext.migrate import Migrate, MigrateCommand
+from sqlalchemy import inspect
+from sqlalchemy.orm import undefer_group
 
 from sakura import app, db
+from sakura.model import (
+    TaskManager, TaskLock, PayloadStore, ProgressStore, DatabaseProgressStore)
+from sakura.tool import ClientRegistry, BackupStore, TemplateStore
 
 manager = Manager(app, usage="manager script support for sakura")
 manager.add_command('shell', Shell(make_context=dict(app=app, db=db)))
@@ -35,6 +40,82 @@ def dropdb(force=False):
             'DEFAULT', app.config['SQLALCHEMY_DATABASE_URI'])
 
 
+@manager.command
+def initlock():
+    "Creates the task lock table and backfills locks of unconfirmed tasks"
+    db.create_all()
+    print 'Task locks backfilled: %s, location:\r\n[%-10s] %s' % (
+        TaskLock.backfill(), 'DEFAULT', app.config['SQLALCHEMY_DATABASE_URI'])
+
+
+@manager.command
+def initindex():
+    "Creates indexes missing in existing database tables"
+    for table in db.metadata.sorted_tables:
+        names = [x['name'] for x in inspect(db.engine).get_indexes(table.name)]
+        for x in table.indexes:
+            if x.name not in names:
+                x.create(bind=db.engine)
+                print 'Index created: %s.%s' % (table.name, x.name)
+
+
+@manager.command
+def purgeprogress():
+    "Deletes expired task progress kept by the database progress store"
+    store = ProgressStore.instance()
+    if isinstance(store, DatabaseProgressStore):
+        print 'Task progress purged: %s' % store.purge()
+
+
+@manager.command
+def offloadpayload(batch=100):
+    "Creates the task payload table and moves large kwargs/info into it"
+    db.create_all()
+    store, moved, last = PayloadStore(), 0, ''
+    while True:
+        tasks = TaskManager.query.options(undefer_group('payload')).filter(
+            TaskManager.task_id > last).order_by(
+            TaskManager.task_id.asc()).limit(int(batch)).all()
+        if not tasks:
+            break
+        for x in tasks:
+            for k in TaskManager._payload_columns:
+                value = getattr(x, k)
+                if store.is_ref(value):
+                    continue
+                ref = store.dump(task_id=x.task_id, name=k, value=value)
+                if ref != value:
+                    setattr(x, k, ref)
+                    moved += 1
+        db.session.commit()
+        last = tasks[-1].task_id
+        db.session.expunge_all()
+    print 'Task payloads moved: %s, location:\r\n[%-10s] %s' % (
+        moved, 'DEFAULT', app.config['SQLALCHEMY_DATABASE_URI'])
+
+
+@manager.command
+def collectblobs(force=False):
+    "Deletes backup blobs and uploaded templates no more referred"
+    running = TaskManager().get_running()
+    if running and not force:
+        print 'Tasks running: %s, retry later or use --force' % ', '.join(
+            [x.task_id for x in running])
+        return
+    minio = ClientRegistry.minio()
+    blobs = BackupStore(
+        minio=minio, bucket_name=app.config['MINIO_BUCKET'],
+        folder_pre='').collect()
+    # templates of unconfirmed tasks are kept for their rollback
+    keep = set()
+    for x in TaskManager().get_unconfirmed():
+        keep.update([y['template_id'] for y in x.loads('kwargs')['files']
+                     if y.get('template_id')])
+    templates = TemplateStore(minio=minio).collect(keep=keep)
+    print 'Backup blobs deleted: %s, templates deleted: %s' % (
+        len(blobs), len(templates))
+
+
 @manager.command
 def recreatedb():
     "Recreates database tables (same as issuing 'dropdb' and 'initdb')"
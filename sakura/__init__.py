@@ -28,7 +28,7 @@ def make_celery(app):
     celery = Celery(app.import_name, broker=app.config['CELERY_BROKER_URL'])
     exchange = Exchange('sakura')
     celery.conf.update(
-        CELERY_RESULT_BACKEND='amqp',
+        CELERY_RESULT_BACKEND=app.config['CELERY_RESULT_BACKEND'],
         CELERY_IGNORE_RESULT=False,
         CELERY_TIMEZONE='Asia/Shanghai',
         CELERY_ENABLE_UTC=True,
@@ -97,7 +97,8 @@ app, api, db, cors, celery = config_app(app, instance_config='config.py')
 
 @api.representation('application/json')
 def responseJson(data, code, headers=None):
-    resp = make_response(json.dumps(data), code)
+    # datetime columns of tasks, ex. begin_time, as strings
+    resp = make_response(json.dumps(data, default=str), code)
     resp.headers.extend(headers or {})
     return resp
 
@@ -14,6 +14,13 @@ TASK_STATE = StrEnum(
         PENDING='PENDING', PROGRESS='PROGRESS', FAILURE='FAILURE',
         SUCCESS='SUCCESS'))
 
+HOST_STATE = StrEnum(
+    'HOST_STATE',
+    dict(SUCCESS='SUCCESS', FAILURE='FAILURE', SKIPPED='SKIPPED'))
+
+ROLLOUT_HEALTH_GATE = StrEnum(
+    'ROLLOUT_HEALTH_GATE', dict(STATUS='status', CHECK='check'))
+
 TASK_PERCENTAGE = IntEnum(
     'TASK_PERCENTAGE', dict(STARTPOINT=0, ENDPOINT=100))
 
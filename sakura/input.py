@@ -7,7 +7,6 @@
 
 import re
 import json
-from copy import deepcopy
 from IPy import IP as ip_from_ipy
 
 
@@ -19,6 +18,9 @@ class dictionary(object):
         return self._get_dict(value)
 
     def _get_dict(self, value):
+        # validated in place, nested dictionaries are not copied
+        if isinstance(value, dict):
+            return value
         try:
             if isinstance(value, str):
                 value = json.loads(value)
@@ -28,68 +30,83 @@ class dictionary(object):
 
     @classmethod
     def type_desc(cls, keys):
-        for x in keys:
-            if isinstance(keys[x], dictionary):
-                keys[x] = str(keys[x])
-        return keys
+        return {k: str(v) if isinstance(v, dictionary) else v
+                for k, v in keys.items()}
 
 
 class defined_dictionary(dictionary):
     """
         Restrict input to a dictionary with specific keys
     """
-    def __init__(self, keys, argument='argument'):
+    _error = ('Invalid {arg}: {value}. {arg} must be a dictionary '
+              'like {type}')
+
+    def __init__(self, keys, argument='argument', optional=None):
         self.keys = keys
         self.argument = argument
+        # built once, nested schemas are described by their own __str__
+        self._keys = frozenset(keys.keys())
+        # keys allowed to be missing
+        self._optional = frozenset(optional if optional else [])
+        self._required = self._keys - self._optional
+        self._desc = "<type '{0}' {1}>".format(
+            self.__class__.__name__, self.type_desc(keys))
+
+    def _fail(self, value):
+        # formatted only on failure, the value may be a large template
+        return ValueError(self._error.format(
+            arg=self.argument, value=value, type=self._desc))
 
     def __call__(self, value):
         value = self._get_dict(value)
-        error = ('Invalid {arg}: {value}. {arg} must be a dictionary '
-                 'like {type}'.format(
-                     arg=self.argument, value=value, type=str(self)))
-        if value and set(value.keys()) == set(self.keys.keys()):
-            for k in value:
-                try:
-                    value[k] = self.keys[k](value[k])
-                except (TypeError, ValueError):
-                    raise ValueError(error)
-        else:
-            raise ValueError(error)
+        if (not value or not self._required.issubset(value) or
+                not self._keys.issuperset(value)):
+            raise self._fail(value)
+        for k in value:
+            try:
+                value[k] = self.keys[k](value[k])
+            except (TypeError, ValueError):
+                raise self._fail(value)
         return value
 
     def __str__(self):
-        return "<type '{0}' {1}>".format(
-            self.__class__.__name__, self.type_desc(deepcopy(self.keys)))
+        return self._desc
 
 
 class union_dictionary(dictionary):
     """
         Restrict input to a dictionary with specific keys' and values' types
     """
+    _error = ('Invalid {arg}: {value}. {arg} must be a dictionary '
+              'subjects to {type}')
+
     def __init__(self, key_type=None, value_type=None, argument='argument'):
         self.key_type = key_type
         self.value_type = value_type
         self.argument = argument
+        self._desc = "<type '{0}' {1}>".format(
+            self.__class__.__name__, {self.key_type: (
+                str(self.value_type) if isinstance(self.value_type, dictionary)
+                else self.value_type)})
+
+    def _fail(self, value):
+        # formatted only on failure, the value may be a large template
+        return ValueError(self._error.format(
+            arg=self.argument, value=value, type=self._desc))
 
     def __call__(self, value):
         value = self._get_dict(value)
-        error = ('Invalid {arg}: {value}. {arg} must be a dictionary '
-                 'subjects to {type}'.format(
-                     arg=self.argument, value=value, type=str(self)))
         if value:
             for k in value:
                 try:
                     k = self.key_type(k)
                     value[k] = self.value_type(value[k])
                 except (TypeError, ValueError, KeyError):
-                    raise ValueError(error)
+                    raise self._fail(value)
         return value
 
     def __str__(self):
-        return "<type '{0}' {1}>".format(
-            self.__class__.__name__, {self.key_type: (
-                str(self.value_type) if isinstance(self.value_type, dictionary)
-                else self.value_type)})
+        return self._desc
 
 
 def ip(value):
@@ -106,3 +123,15 @@ def ip(value):
     except (TypeError, ValueError):
         raise ValueError(message)
     return value
+
+
+def batch_size(value):
+    """ Validate a rollout batch size.
+    :param string value : number of hosts like '2' or percentage like '25%'
+    :returns            : the batch size if valid
+    :raises             : ValueError
+    """
+    message = u"{0} is not a valid batch size".format(value)
+    if not re.match(r'^([1-9]\d*|([1-9]\d?|100)%)$', str(value).strip()):
+        raise ValueError(message)
+    return str(value).strip()
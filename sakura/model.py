@@ -5,11 +5,24 @@
 # This is the model module of sakura package.
 #
 
-from sqlalchemy.dialects.mysql import LONGTEXT
+import os
+import zlib
+import json
+import time
+import base64
+import redis
+import threading
+import traceback
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import load_only, undefer_group
+from sqlalchemy.dialects.mysql import LONGTEXT, LONGBLOB
 
 from sakura import app, db
 from sakura import constant as C
-from sakura.util import logmsg
+from sakura.util import logmsg, md5hex, LRUCache
 
 
 class TaskManager(db.Model):
@@ -17,14 +30,26 @@ class TaskManager(db.Model):
         Task Manager Model.
     """
     __tablename__ = 'task_manager'
+    __table_args__ = (
+        db.Index('ix_task_manager_begin_time', 'begin_time', 'task_id'),
+        db.Index(
+            'ix_task_manager_name_state_ack', 'name', 'state', 'ack_status',
+            'begin_time'),
+        db.Index(
+            'ix_task_manager_name_ack', 'name', 'ack_status', 'begin_time'))
     __DBContraintException = 'Database Contraint Exception: %s.'
+    __CursorFormat = '%Y-%m-%dT%H:%M:%S.%f'
+    # task id -> ProgressRecorder of running tasks
+    _recorders = {}
+    # columns large values of which are kept by the payload store
+    _payload_columns = ('kwargs', 'info')
 
     # task id
     task_id = db.Column(db.String(64), primary_key=True)
     # task name
     name = db.Column(db.String(64), nullable=False)
-    # task arguments
-    kwargs = db.Column(db.Text, nullable=False)
+    # task arguments, loaded only when requested, a payload reference if large
+    kwargs = db.deferred(db.Column(db.Text, nullable=False), group='payload')
     # task creating time
     begin_time = db.Column(db.DateTime, nullable=False)
     # task ending time
@@ -33,8 +58,9 @@ class TaskManager(db.Model):
     delta_time = db.Column(db.Float)
     # task state (pending/failure/success)
     state = db.Column(db.String(16), default=C.TASK_STATE.PENDING.value)
-    # task return information
-    info = db.Column(LONGTEXT)
+    # task return information, loaded only when requested, a payload
+    # reference if large
+    info = db.deferred(db.Column(LONGTEXT), group='payload')
     # task result acknowledge status (1: pending, 2: passed, 3: rollbacked)
     ack_status = db.Column(db.String(16))
     # task current step
@@ -46,6 +72,9 @@ class TaskManager(db.Model):
     # constructor
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
+            if k in self._payload_columns:
+                v = PayloadStore().dump(
+                    task_id=kwargs.get('task_id'), name=k, value=v)
             if k in self._columns():
                 setattr(self, k, v)
 
@@ -64,32 +93,73 @@ class TaskManager(db.Model):
         return None
 
     def getObject(self, task_id):
-        li = self.__class__.query.filter_by(task_id=task_id).all()
+        li = self.__class__.query.options(undefer_group('payload')).filter_by(
+            task_id=task_id).all()
         if li:
             return li[0]
         return None
 
-    def get(self, page=None, per_page=20, **kwargs):
-        li = None
-        if not kwargs:
-            if page:
-                li = self.__class__.query.paginate(page, per_page, False)
-            else:
-                li = self.__class__.query.order_by(
-                    self.__class__.begin_time.desc()).all()
-        else:
-            li = self.__class__.query.filter_by(**kwargs).order_by(
-                self.__class__.begin_time.desc()).all()
-        if li:
-            if not kwargs and page:
-                return [x._to_dict() for x in li.items], li.pages
-            return [x._to_dict() for x in li]
-        return []
+    def _query(self, fields=None, **kwargs):
+        """ query of tasks loading only the fields if specified """
+        cls = self.__class__
+        query = cls.query.filter_by(**kwargs)
+        if fields:
+            # keys of ordering are always loaded
+            query = query.options(load_only(
+                *set(fields) | set(['task_id', 'begin_time'])))
+        return query
+
+    def get(self, page=None, per_page=20, count=True, fields=None, **kwargs):
+        cls = self.__class__
+        query = self._query(fields=fields, **kwargs).order_by(
+            cls.begin_time.desc(), cls.task_id.desc())
+        if not page:
+            return self._to_dicts(query.all(), fields)
+        if count:
+            li = query.paginate(page, per_page, False)
+            return self._to_dicts(li.items, fields), li.pages
+        # skip COUNT of the whole table
+        li = query.offset((page - 1) * per_page).limit(per_page).all()
+        return self._to_dicts(li, fields), None
+
+    def get_after(self, cursor=None, per_page=20, fields=None, **kwargs):
+        """ keyset pagination in order of begin_time and task_id desc
+            ret: (tasks, cursor of the next page, None if the last page)
+        """
+        cls = self.__class__
+        query = self._query(fields=fields, **kwargs)
+        if cursor:
+            begin_time, task_id = self.decode_cursor(cursor)
+            query = query.filter(db.or_(
+                cls.begin_time < begin_time,
+                db.and_(cls.begin_time == begin_time, cls.task_id < task_id)))
+        li = query.order_by(cls.begin_time.desc(), cls.task_id.desc()).limit(
+            per_page + 1).all()
+        next_cursor = (
+            self.encode_cursor(li[per_page - 1]) if len(li) > per_page
+            else None)
+        return self._to_dicts(li[:per_page], fields), next_cursor
+
+    @classmethod
+    def encode_cursor(cls, obj):
+        return base64.urlsafe_b64encode('{0}|{1}'.format(
+            obj.begin_time.strftime(cls.__CursorFormat), obj.task_id))
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        try:
+            begin_time, task_id = base64.urlsafe_b64decode(
+                str(cursor)).split('|', 1)
+            return datetime.strptime(begin_time, cls.__CursorFormat), task_id
+        except (TypeError, ValueError):
+            raise ValueError('{0} is not a valid cursor'.format(cursor))
 
     def update(self, task_id, **kwargs):
         obj = self.__class__.query.filter_by(task_id=task_id).first()
         if obj:
             for k, v in kwargs.items():
+                if k in self._payload_columns:
+                    v = PayloadStore().dump(task_id=task_id, name=k, value=v)
                 if k in self._columns():
                     setattr(obj, k, v)
             try:
@@ -106,18 +176,77 @@ class TaskManager(db.Model):
     def _columns(self):
         return self.__class__.__mapper__.columns.__dict__['_data']
 
-    # model to dict
-    def _to_dict(self):
-        return {k: getattr(self, k) for k in self._columns()}
+    # list of deferred model columns
+    def _deferred_columns(self):
+        return [k for k, v in self.__class__.__mapper__.column_attrs.items()
+                if v.deferred]
+
+    # model to dict, deferred columns not loaded are skipped and payload
+    # references resolved
+    def _to_dict(self, fields=None, payloads=None):
+        if fields:
+            ret = {k: getattr(self, k) for k in fields}
+        else:
+            skipped = set(self._deferred_columns()) & inspect(self).unloaded
+            ret = {k: getattr(self, k) for k in self._columns()
+                   if k not in skipped}
+        for k in self._payload_columns:
+            if k in ret:
+                ret[k] = PayloadStore().load(
+                    task_id=self.task_id, name=k, value=ret[k],
+                    payloads=payloads)
+        return ret
+
+    # models to dicts, payloads of all models read at once
+    def _to_dicts(self, objs, fields=None):
+        store = PayloadStore()
+        task_ids = [
+            x.task_id for x in objs if any(
+                store.is_ref(x.__dict__.get(k))
+                for k in self._payload_columns)]
+        payloads = store.load_many(task_ids) if task_ids else {}
+        return [x._to_dict(fields, payloads) for x in objs]
+
+    def loads(self, name):
+        """ json value of a payload column, ex. kwargs """
+        return json.loads(PayloadStore().load(
+            task_id=self.task_id, name=name, value=getattr(self, name)))
+
+    def get_unconfirmed(self):
+        """ configuration update tasks not acknowledged or rollbacked yet,
+            in order of begin time
+        """
+        cls = self.__class__
+        return cls.query.filter(
+            cls.name == C.TASK_NAME.CONFIGURATION_UPDATE.value,
+            db.or_(cls.ack_status.is_(None),
+                   cls.ack_status ==
+                   C.CONFIGURATION_UPDATE_ACK_STATE.PENDING.value)).order_by(
+            cls.begin_time.asc()).all()
+
+    def get_running(self):
+        """ tasks in progress, those begun before the hard time limit of
+            celery are taken as killed
+        """
+        cls = self.__class__
+        return cls.query.filter(
+            cls.state == C.TASK_STATE.PROGRESS.value,
+            cls.begin_time > datetime.now() - timedelta(
+                seconds=app.config['CELERYD_TASK_TIME_LIMIT'])).all()
+
+    def progress(self, task):
+        """ progress recorder of a running task """
+        recorder = self._recorders.get(task.request.id)
+        if recorder is None:
+            recorder = ProgressRecorder(manager=self, task=task)
+            self._recorders[task.request.id] = recorder
+        return recorder
 
     def task_step(
             self, task, name=None, args=None,
             state=C.TASK_STATE.PROGRESS.value,
             current=C.TASK_PERCENTAGE.STARTPOINT.value,
             data=None, message=None, error=None, flag=None):
-        if flag:
-            msg = self.update(task_id=task.request.id, step=flag)
-            app.logger.debug(logmsg(msg))
         args = args if args else {}
         meta = dict(
             current=current,
@@ -128,7 +257,553 @@ class TaskManager(db.Model):
             meta['error'] = error
         app.logger.info(logmsg(state))
         app.logger.info(logmsg(meta))
-        task.update_state(task_id=task.request.id, state=state, meta=meta)
+        recorder = self.progress(task)
+        recorder.step(state=state, meta=meta, flag=flag)
+        if name:
+            # the step shows while it runs, however long it takes, and
+            # the publisher coalesces progress of the task if any
+            recorder.flush()
         ret = name(**args) if name else None
         app.logger.debug(logmsg(ret))
         return ret, meta, state
+
+
+class ProgressRecorder(object):
+    """ ProgressRecorder
+
+    Buffer progress of a running task, and write it to the progress store
+    (or the result backend if no store) and the database in coalesced
+    batches.
+    The progress is written on state change, after an interval or before a
+    step runs, the step flag to the database at once and other columns only once when the
+    task is closed.
+    Progress is written by the publisher thread if any, and the task is
+    closed only after its progress has been written.
+    """
+    def __init__(self, manager, task, interval=None, store=None,
+                 publisher=None):
+        super(ProgressRecorder, self).__init__()
+        # task manager writing columns to the database
+        self._manager = manager
+        self._task = task
+        self._task_id = task.request.id
+        self._store = store if store else ProgressStore.instance()
+        self._publisher = (
+            publisher if publisher else ProgressPublisher.instance())
+        self._interval = (
+            interval if interval is not None else
+            app.config['SAKURA_PROGRESS_INTERVAL'])
+        # columns not written to the database yet
+        self._columns = {}
+        # (state, meta) not sent to the result backend yet
+        self._pending = None
+        # last state sent to the result backend and its sending time
+        self._state = None
+        self._sent_time = 0
+
+    def step(self, state, meta, flag=None):
+        """ record a step of the task """
+        if flag:
+            # rollback relies on the step reached even if the worker is killed
+            msg = self._manager.update(task_id=self._task_id, step=flag)
+            app.logger.debug(logmsg(msg))
+        self._pending = (state, meta)
+        if (state != self._state or
+                time.time() - self._sent_time >= self._interval):
+            self.flush()
+
+    def record(self, **columns):
+        """ record columns of the task written by the next database flush """
+        self._columns.update(columns)
+
+    def flush(self, columns=False):
+        """ write buffered progress, columns only if specified """
+        ret = None
+        if self._pending:
+            state, meta = self._pending
+            func = self._store.set if self._store else self._task.update_state
+            if self._publisher:
+                self._publisher.publish(
+                    self._task_id, func,
+                    task_id=self._task_id, state=state, meta=meta)
+            else:
+                func(task_id=self._task_id, state=state, meta=meta)
+            self._pending = None
+            self._state = state
+            self._sent_time = time.time()
+        if columns and self._columns:
+            columns, self._columns = self._columns, {}
+            ret = self._manager.update(task_id=self._task_id, **columns)
+        return ret
+
+    def close(self, **columns):
+        """ write all buffered progress and columns of the task, and wait
+            till the progress is published
+        """
+        self._manager._recorders.pop(self._task_id, None)
+        self.record(**columns)
+        ret = self.flush(columns=True)
+        if self._publisher and not self._publisher.flush(
+                key=self._task_id,
+                timeout=app.config['SAKURA_PROGRESS_FLUSH_TIMEOUT']):
+            msg = 'Progress Not Published: %s.' % self._task_id
+            app.logger.warning(logmsg(msg))
+        return ret
+
+
+class ProgressPublisher(object):
+    """ ProgressPublisher
+
+    Publish task progress from a background thread of this process, so that
+    a slow broker or progress store does not hold the steps of tasks.
+    Progress of a task not published yet is replaced by its latest one, and
+    at most `size` tasks wait at once, further ones wait for room.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, size=None):
+        super(ProgressPublisher, self).__init__()
+        self._size = (
+            size if size else app.config['SAKURA_PROGRESS_QUEUE_SIZE'])
+        # key -> (func, kwargs) waiting to be published, in order
+        self._pending = OrderedDict()
+        # keys being published
+        self._busy = set()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = os.getpid()
+
+    @classmethod
+    def instance(cls):
+        """ publisher of this process, None if not configured """
+        if not app.config['SAKURA_PROGRESS_ASYNC']:
+            return None
+        with cls._instance_lock:
+            # threads are not inherited by forked worker processes
+            if cls._instance is None or cls._instance._pid != os.getpid():
+                cls._instance = cls()
+            return cls._instance
+
+    def publish(self, key, func, **kwargs):
+        """ call func(**kwargs) in the publisher thread """
+        with self._cond:
+            while key not in self._pending and len(
+                    self._pending) >= self._size:
+                self._cond.wait()
+            self._pending[key] = (func, kwargs)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='sakura-progress')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _run(self):
+        with app.app_context():
+            while True:
+                with self._cond:
+                    while not self._pending:
+                        self._cond.wait()
+                    key, (func, kwargs) = self._pending.popitem(last=False)
+                    self._busy.add(key)
+                    self._cond.notify_all()
+                try:
+                    func(**kwargs)
+                except Exception:
+                    app.logger.error(logmsg(traceback.format_exc()))
+                finally:
+                    with self._cond:
+                        self._busy.discard(key)
+                        self._cond.notify_all()
+
+    def flush(self, key=None, timeout=None):
+        """ wait till progress of a key (or of all) is published
+            ret: False if not published within the timeout
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while (key in self._pending or key in self._busy if key else
+                   self._pending or self._busy):
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+class TaskLock(db.Model):
+    """
+        Task Lock Model.
+        One row per service held by its last configuration update task.
+    """
+    __tablename__ = 'task_lock'
+
+    # service name
+    service_name = db.Column(db.String(64), primary_key=True)
+    # environment name
+    env_name = db.Column(db.String(64), primary_key=True)
+    # service version
+    service_version = db.Column(db.String(64), primary_key=True)
+    # id of the configuration update task holding the lock
+    task_id = db.Column(db.String(64), nullable=False)
+    # lock taking time
+    lock_time = db.Column(db.DateTime, nullable=False)
+
+    # constructor
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            if k in self.__class__.__mapper__.columns.keys():
+                setattr(self, k, v)
+
+    @staticmethod
+    def _held(lock, task_id, ack_status, now):
+        """ whether a lock is still held by its task """
+        if task_id:
+            # held until the task is acknowledged or rollbacked
+            return ack_status in (
+                None, C.CONFIGURATION_UPDATE_ACK_STATE.PENDING.value)
+        # task queued but not recorded by a worker yet, or lost by the broker,
+        # a queued task finding its lock taken on starting never runs
+        return (now - lock.lock_time).total_seconds() < app.config[
+            'SAKURA_TASK_LOCK_TIMEOUT']
+
+    def acquire(self, task_id, service_name, env_name, service_version):
+        """ take the lock of a service for a configuration update task
+            ret: id of the task still holding the lock, None if taken
+        """
+        cls = self.__class__
+        key = dict(service_name=service_name, env_name=env_name,
+                   service_version=service_version)
+        now = datetime.now()
+        try:
+            # lock the row till commit, concurrent requests wait here
+            row = db.session.query(
+                cls, TaskManager.task_id, TaskManager.ack_status).outerjoin(
+                TaskManager, TaskManager.task_id == cls.task_id).filter(
+                cls.service_name == service_name,
+                cls.env_name == env_name,
+                cls.service_version == service_version).with_for_update(
+                ).first()
+            if row:
+                lock, holder, ack_status = row
+                if self._held(lock, holder, ack_status, now):
+                    db.session.rollback()
+                    return lock.task_id
+                lock.task_id = task_id
+                lock.lock_time = now
+            else:
+                db.session.add(cls(task_id=task_id, lock_time=now, **key))
+            db.session.commit()
+            return None
+        except (IntegrityError, OperationalError), e:
+            # duplicate key or deadlock with a concurrent request
+            db.session.rollback()
+            app.logger.warning(logmsg('Task Lock Conflict: %s.' % e))
+            lock = cls.query.filter_by(**key).first()
+            if lock:
+                return lock.task_id
+            raise
+
+    @classmethod
+    def holder(cls, service_name, env_name, service_version):
+        """ id of the task holding the lock of a service, None if no lock
+        """
+        try:
+            # wait for a concurrent request taking the lock
+            lock = cls.query.filter_by(
+                service_name=service_name, env_name=env_name,
+                service_version=service_version).with_for_update().first()
+            db.session.commit()
+            return lock.task_id if lock else None
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @classmethod
+    def release(cls, task_id, service_name, env_name, service_version):
+        """ give back the lock of a service still held by a task never sent
+            ret: number of locks released
+        """
+        try:
+            count = cls.query.filter_by(
+                task_id=task_id, service_name=service_name, env_name=env_name,
+                service_version=service_version).delete(
+                synchronize_session=False)
+            db.session.commit()
+            return count
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @classmethod
+    def backfill(cls):
+        """ build locks of unconfirmed configuration update tasks
+            ret: number of locks built
+        """
+        locks = {}
+        for x in TaskManager().get_unconfirmed():
+            kwargs = x.loads('kwargs')
+            key = (kwargs['service_name'], kwargs['env_name'],
+                   kwargs['service_version'])
+            # the latest task wins
+            locks[key] = cls(
+                service_name=key[0], env_name=key[1], service_version=key[2],
+                task_id=x.task_id, lock_time=x.begin_time)
+        for x in locks.values():
+            db.session.merge(x)
+        db.session.commit()
+        return len(locks)
+
+
+class TaskPayload(db.Model):
+    """
+        Task Payload Model.
+        Large kwargs/info of a task compressed out of its task_manager row.
+    """
+    __tablename__ = 'task_payload'
+
+    # task id
+    task_id = db.Column(db.String(64), primary_key=True)
+    # task column name
+    name = db.Column(db.String(16), primary_key=True)
+    # md5 of the uncompressed value
+    digest = db.Column(db.String(32), nullable=False)
+    # bytes of the uncompressed value
+    size = db.Column(db.Integer, nullable=False)
+    # zlib compressed value
+    data = db.Column(LONGBLOB, nullable=False)
+
+
+class PayloadStore(object):
+    """ PayloadStore
+
+    Values of task columns larger than a threshold are compressed into the
+    `task_payload` table, the row keeping only a reference with the digest,
+    the size and a summary of the scalar items.
+    """
+    _prefix = '{"__payload__": '
+    # max bytes of a summarized item
+    _summary_size = 128
+
+    def __init__(self, threshold=None, level=None):
+        super(PayloadStore, self).__init__()
+        self._threshold = (
+            threshold if threshold is not None else
+            app.config['SAKURA_PAYLOAD_THRESHOLD'])
+        self._level = (
+            level if level is not None else
+            app.config['SAKURA_PAYLOAD_LEVEL'])
+
+    def is_ref(self, value):
+        return isinstance(value, basestring) and value.startswith(self._prefix)
+
+    def _summary(self, value):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+        if not isinstance(value, dict):
+            return None
+        return {k: v for k, v in value.items()
+                if not isinstance(v, (dict, list)) and
+                len(json.dumps(v)) <= self._summary_size}
+
+    def pack(self, value):
+        """ ret: (reference kept in the row, columns of the payload) or
+            (value, None) if not larger than the threshold
+        """
+        if (value is None or not self._threshold or
+                len(value) <= self._threshold):
+            return value, None
+        raw = value.encode('utf-8') if isinstance(value, unicode) else value
+        payload = dict(
+            digest=md5hex(raw), size=len(raw),
+            data=zlib.compress(raw, self._level))
+        ref = json.dumps(dict(
+            __payload__=payload['digest'], size=payload['size'],
+            summary=self._summary(value)), sort_keys=True)
+        return ref, payload
+
+    def unpack(self, ref, data):
+        """ ret: value of a reference from its compressed value """
+        raw = zlib.decompress(data)
+        digest = json.loads(ref)['__payload__']
+        if md5hex(raw) != digest:
+            raise Exception('Task Payload Corrupted: %s.' % digest)
+        return raw.decode('utf-8')
+
+    def dump(self, task_id, name, value):
+        """ write a large value along with the next commit
+            ret: text kept in the task row
+        """
+        ref, payload = self.pack(value)
+        if payload:
+            db.session.merge(TaskPayload(task_id=task_id, name=name, **payload))
+        return ref
+
+    def load_many(self, task_ids):
+        """ ret: {(task id, column name): compressed value} """
+        return {(x.task_id, x.name): x.data for x in TaskPayload.query.filter(
+            TaskPayload.task_id.in_(task_ids)).all()}
+
+    def load(self, task_id, name, value, payloads=None):
+        """ ret: value of a task column, resolved if a reference """
+        if not self.is_ref(value):
+            return value
+        if payloads is not None and (task_id, name) in payloads:
+            data = payloads[(task_id, name)]
+        else:
+            obj = TaskPayload.query.get((task_id, name))
+            if not obj:
+                raise Exception(
+                    'Task Payload Not Found: %s.%s.' % (task_id, name))
+            data = obj.data
+        return self.unpack(value, data)
+
+
+class TaskProgress(db.Model):
+    """
+        Task Progress Model.
+        Latest progress of a task kept by the database progress store.
+    """
+    __tablename__ = 'task_progress'
+
+    # task id
+    task_id = db.Column(db.String(64), primary_key=True)
+    # task state
+    state = db.Column(db.String(16), nullable=False)
+    # task progress information
+    meta = db.Column(LONGTEXT)
+    # increased by each write
+    version = db.Column(db.Integer, nullable=False, default=1)
+    # last writing time
+    update_time = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class ProgressStore(object):
+    """ ProgressStore
+
+    Latest progress of tasks, read by status polling with a key lookup.
+    Each entry carries a version increased by each write and expires after
+    a ttl.
+    Entries are kept in memory of this process ('local'), ex. for eager
+    tasks in tests, stores shared with the workers keep them elsewhere.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, ttl=None):
+        super(ProgressStore, self).__init__()
+        # seconds to keep an entry after its last write
+        self._ttl = (
+            ttl if ttl else app.config['SAKURA_PROGRESS_TTL'])
+        self._entries = LRUCache(
+            maxsize=app.config['SAKURA_PROGRESS_SIZE'], ttl=self._ttl)
+
+    def set(self, task_id, state, meta):
+        """ write progress of a task, ret: version of the entry """
+        entry = self._entries.get(task_id)
+        version = entry['version'] + 1 if entry else 1
+        self._entries.set(
+            task_id, dict(state=state, meta=meta, version=version))
+        return version
+
+    def get(self, task_id):
+        """ read progress of a task
+            ret: dict(state=, meta=, version=), None if missing or expired
+        """
+        return self._entries.get(task_id)
+
+    @classmethod
+    def instance(cls):
+        """ progress store of this process, None if not configured """
+        name = app.config['SAKURA_PROGRESS_STORE']
+        if not name:
+            return None
+        with cls._instance_lock:
+            if cls._instance is None:
+                stores = dict(
+                    local=ProgressStore, redis=RedisProgressStore,
+                    database=DatabaseProgressStore)
+                if name not in stores:
+                    raise Exception(
+                        'Unknown Progress Store: {0}'.format(name))
+                cls._instance = stores[name]()
+            return cls._instance
+
+
+class RedisProgressStore(ProgressStore):
+    """ RedisProgressStore
+
+    Progress store on redis, entries expire by redis itself.
+    """
+    def __init__(self, ttl=None):
+        super(RedisProgressStore, self).__init__(ttl=ttl)
+        self._redis = redis.StrictRedis.from_url(
+            app.config['SAKURA_PROGRESS_REDIS_URL'])
+
+    @staticmethod
+    def _key(task_id):
+        return 'sakura:progress:{0}'.format(task_id)
+
+    def set(self, task_id, state, meta):
+        key = self._key(task_id)
+        pipe = self._redis.pipeline()
+        pipe.hincrby(key, 'version', 1)
+        pipe.hmset(key, dict(state=state, meta=json.dumps(meta)))
+        pipe.expire(key, self._ttl)
+        return pipe.execute()[0]
+
+    def get(self, task_id):
+        entry = self._redis.hgetall(self._key(task_id))
+        if not entry or 'state' not in entry:
+            return None
+        return dict(
+            state=entry['state'], meta=json.loads(entry['meta']),
+            version=int(entry['version']))
+
+
+class DatabaseProgressStore(ProgressStore):
+    """ DatabaseProgressStore
+
+    Progress store on the `task_progress` table, one row per task.
+    Entries are written through connections of its own, never touching the
+    session of the running task.
+    ps: each step written costs a transaction, redis is preferred
+    """
+    _table = TaskProgress.__table__
+
+    def set(self, task_id, state, meta):
+        columns = dict(
+            state=state, meta=json.dumps(meta), update_time=datetime.now())
+        table = self._table
+        with db.engine.begin() as conn:
+            # update without select
+            updated = conn.execute(
+                table.update().where(table.c.task_id == task_id).values(
+                    version=table.c.version + 1, **columns)).rowcount
+            if not updated:
+                conn.execute(table.insert().values(
+                    task_id=task_id, version=1, **columns))
+
+    def get(self, task_id):
+        table = self._table
+        row = db.engine.execute(
+            table.select().where(table.c.task_id == task_id)).first()
+        if not row or row.update_time < datetime.now() - timedelta(
+                seconds=self._ttl):
+            return None
+        return dict(
+            state=row.state, meta=json.loads(row.meta), version=row.version)
+
+    def purge(self):
+        """ delete expired entries, ret: number of entries deleted """
+        table = self._table
+        with db.engine.begin() as conn:
+            return conn.execute(table.delete().where(
+                table.c.update_time < datetime.now() - timedelta(
+                    seconds=self._ttl))).rowcount
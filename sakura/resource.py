@@ -8,7 +8,7 @@
 from sakura import api
 from sakura.release import __version__
 from sakura.service import (
-    TaskListAPI, ConfigurationUpdateAPI, ConfigurationCheckAPI,
+    TaskListAPI, TaskAPI, BlobAPI, ConfigurationUpdateAPI, ConfigurationCheckAPI,
     ConfigurationAcknowledgeAPI, ConfigurationRollbackAPI)
 
 
@@ -31,6 +31,9 @@ def add_resource(
 
 
 add_resource('task', many_resource=TaskListAPI)
+api.add_resource(
+    TaskAPI, '{}/<id>'.format(_url('task')), endpoint='ep_dr_task_id')
+add_resource('blob', many_resource=BlobAPI)
 add_resource('cfg_upd', one_resource=ConfigurationUpdateAPI)
 add_resource('cfg_chk', one_resource=ConfigurationCheckAPI)
 add_resource('cfg_ack', one_resource=ConfigurationAcknowledgeAPI)
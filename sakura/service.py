@@ -8,17 +8,22 @@
 import os
 import json
 import werkzeug
+import tempfile
 import traceback
 from datetime import datetime
 from inspect import isclass, isfunction
+from flask import request
 from flask.ext.restful import reqparse, Resource, inputs
+from celery.utils import uuid
 
 from sakura import app
 from sakura import constant as C
-from sakura.model import TaskManager
+from sakura.model import TaskManager, TaskLock, ProgressStore
 from sakura.task import SakuraTask
-from sakura.util import logmsg
-from sakura.input import defined_dictionary, union_dictionary, ip
+from sakura.tool import TemplateStore
+from sakura.util import logmsg, get_folder, is_utf8file
+from sakura.input import (
+    defined_dictionary, union_dictionary, ip, batch_size)
 
 
 """ Error
@@ -60,6 +65,90 @@ class SakuraObjectNotFoundError(SakuraAPIError):
             prefix=prefix, content=content, http_code=code)
 
 
+class SakuraPayloadTooLargeError(SakuraAPIError):
+    def __init__(self, content):
+        prefix = 'Payload Too Large'
+        code = 413
+        super(SakuraPayloadTooLargeError, self).__init__(
+            prefix=prefix, content=content, http_code=code)
+
+
+""" Request
+"""
+
+
+def check_length(limit=None):
+    """ refuse the request body if its length is over the limit
+        limit: max bytes of the body, no limit if None
+    """
+    # a number is always larger than None in python 2
+    if limit is not None and request.content_length > limit:
+        raise SakuraPayloadTooLargeError(
+            'Body Larger Than {0} Bytes'.format(limit))
+
+
+def read_body(limit=None, f=None):
+    """ read the request body in chunks, refuse it once over the limit
+        limit: max bytes of the body, no limit if None
+        ret: the body, or its size if written to the file object `f`
+    """
+    check_length(limit=limit)
+    if limit is None:
+        limit = float('inf')
+    chunks, size = [], 0
+    chunk_size = app.config['SAKURA_BODY_CHUNK_SIZE']
+    while True:
+        chunk = request.stream.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise SakuraPayloadTooLargeError(
+                'Body Larger Than {0} Bytes'.format(limit))
+        if f:
+            f.write(chunk)
+        else:
+            chunks.append(chunk)
+    return size if f else ''.join(chunks)
+
+
+def load_json():
+    """ parse a json body once, the result is cached for reqparse
+        ps: the bounded body is parsed as a whole, no incremental parser
+    """
+    limit = app.config['SAKURA_MAX_BODY_SIZE']
+    if request.mimetype != 'application/json':
+        # other bodies are parsed by werkzeug, which reads no more than
+        # the content length
+        check_length(limit=limit)
+        return None
+    data = read_body(limit=limit)
+    try:
+        value = json.loads(data) if data else None
+    except ValueError:
+        raise SakuraInvalidAccessError('Body Is Not Valid JSON')
+    # read by request.get_json() instead of the consumed stream
+    request._cached_json = value
+    return value
+
+
+def check_templates(files):
+    """ every file should carry a template or refer to an uploaded one
+    """
+    template_ids = []
+    for x in files:
+        if x.get('template') is None:
+            if not x.get('template_id'):
+                raise SakuraInvalidAccessError(
+                    'Template or Template ID Required: {0}'.format(x['name']))
+            template_ids.append(x['template_id'])
+    missing = TemplateStore().missing(template_ids) if template_ids else []
+    if missing:
+        raise SakuraObjectNotFoundError(
+            'Template Not Found: {0}.'.format(', '.join(missing)))
+    return files
+
+
 """ Service
 """
 
@@ -69,26 +158,47 @@ class TaskListAPI(Resource):
         TaskList Restful API.
         For GET(Readonly).
     """
+    # built once by compile()
+    parser = None
+    params = []
+
     def __init__(self):
         super(TaskListAPI, self).__init__()
         self.obj = TaskManager()
-        self.parser = reqparse.RequestParser(bundle_errors=True)
+
+    @classmethod
+    def compile(cls):
+        """ build the argument parser shared by all requests
+        """
+        parser = reqparse.RequestParser(bundle_errors=True)
         # page
-        self.parser.add_argument(
+        parser.add_argument(
             'page', type=inputs.positive,
             help='Page must be a positive integer')
         # pp: number of items per page
-        self.parser.add_argument(
+        parser.add_argument(
             'pp', type=inputs.positive,
             help='PerPage must be a positive integer', dest='per_page')
+        # cursor: keyset pagination, empty for the first page
+        parser.add_argument(
+            'cursor', type=str, help='Cursor must be a string')
+        # fields: comma separated columns to return, ex. info,kwargs
+        parser.add_argument(
+            'fields', type=str, help='Fields must be a string')
+        # count: whether to count total pages
+        parser.add_argument(
+            'count', type=inputs.boolean, default=True,
+            help='Count must be a boolean')
         # multi-type parameters
-        setattr(self, 'params', [])
+        params = []
         type_dict = {'String': unicode, 'Integer': int}
-        for k, v in self.obj._columns().items():
+        for k, v in TaskManager()._columns().items():
             if v.type.__class__.__name__ in type_dict:
-                self.parser.add_argument(
+                parser.add_argument(
                     k, type=type_dict[v.type.__class__.__name__])
-                self.params.append(k)
+                params.append(k)
+        cls.parser, cls.params = parser, params
+        return cls
 
     def get(self):
         """ get whole list of tasks
@@ -104,17 +214,31 @@ class TaskListAPI(Resource):
             pages, data, kwargs = False, [], {}
             kwargs = {k: v for k, v in args.items() if k in self.params and v}
             page = args['page']
-            if kwargs or not page:
+            if args['per_page']:
+                kwargs['per_page'] = args['per_page']
+            if args['fields']:
+                kwargs['fields'] = [
+                    x.strip() for x in args['fields'].split(',') if x.strip()]
+                unknown = set(kwargs['fields']) - set(self.obj._columns())
+                if unknown:
+                    raise SakuraInvalidAccessError(
+                        'Unknown Fields: {0}'.format(', '.join(unknown)))
+            if args['cursor'] is not None:
+                try:
+                    data, cursor = self.obj.get_after(
+                        cursor=args['cursor'], **kwargs)
+                except ValueError as e:
+                    raise SakuraInvalidAccessError(str(e))
+                return {'totalpage': pages, 'data': data,
+                        'cursor': cursor}, 200
+            if not page:
+                kwargs.pop('per_page', None)
                 data = self.obj.get(**kwargs)
             else:
-                query = []
-                per_page = args['per_page']
-                if per_page:
-                    query = self.obj.get(page=page, per_page=per_page, **kwargs)
-                else:
-                    query = self.obj.get(page=page, **kwargs)
-                if query:
-                    data, pages = query[0], query[1]
+                data, pages = self.obj.get(
+                    page=page, count=args['count'], **kwargs)
+                if pages is None:
+                    pages = False
             return {'totalpage': pages, 'data': data}, 200
         except SakuraAPIError as e:
             app.logger.error(logmsg(traceback.format_exc()))
@@ -124,23 +248,89 @@ class TaskListAPI(Resource):
             return {'error': str(e), 'status': 1}, 500
 
 
+class TaskAPI(Resource):
+    """
+        Task Restful API.
+        For GET(Readonly) of a single task with all its columns.
+    """
+    def __init__(self):
+        super(TaskAPI, self).__init__()
+        self.obj = TaskManager()
+
+    def get(self, id):
+        """ get a specific task
+        """
+        try:
+            task = self.obj.getObject(task_id=id)
+            if not task:
+                raise SakuraObjectNotFoundError(
+                    'Task Not Found: {0}.'.format(id))
+            return {'data': task._to_dict(), 'status': 0}, 200
+        except SakuraAPIError as e:
+            app.logger.error(logmsg(traceback.format_exc()))
+            return {'error': e.message, 'status': 1}, e.code
+        except Exception as e:
+            app.logger.error(logmsg(traceback.format_exc()))
+            return {'error': str(e), 'status': 1}, 500
+
+
+class BlobAPI(Resource):
+    """
+        Blob Restful API.
+        For POST(Upload) of a template referred by files with its id.
+    """
+    def post(self):
+        """ upload a template as the raw request body
+        """
+        try:
+            folder = get_folder(os.path.join(app.config['TMP_FOLDER'], 'blob'))
+            fd, file_path = tempfile.mkstemp(dir=folder)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    size = read_body(
+                        limit=app.config['SAKURA_MAX_BLOB_SIZE'], f=f)
+                if not size:
+                    raise SakuraInvalidAccessError('Empty Template')
+                if not is_utf8file(file_path):
+                    raise SakuraInvalidAccessError('Template Is Not UTF-8')
+                template_id = TemplateStore().save(file_path=file_path)
+            finally:
+                os.remove(file_path)
+            return {'id': template_id, 'status': 0}, 201
+        except SakuraAPIError as e:
+            app.logger.error(logmsg(traceback.format_exc()))
+            return {'error': e.message, 'status': 1}, e.code
+        except Exception as e:
+            app.logger.error(logmsg(traceback.format_exc()))
+            return {'error': str(e), 'status': 1}, 500
+
+
 class SakuraAPI(Resource):
     """
         Super Task Restful API.
         For both POST(Execute) and GET(Check).
     """
     __abstract__ = True
+    # name of the task to execute
+    task_name = None
+    # arguments of POST
+    post_params = {}
+    # built once by compile()
+    parser = None
 
-    def __init__(self, task_name, post_params=None):
+    def __init__(self):
         super(SakuraAPI, self).__init__()
-        self.parser = reqparse.RequestParser(bundle_errors=True)
         self.task = SakuraTask()
-        setattr(self, 'task_name', task_name)
-        setattr(self, 'post_params', post_params if post_params else {})
+        # id of the task to execute, known before sending it
+        setattr(self, 'task_id', None)
 
-    def _parse_args(self, params):
-        for k, v in params.items():
-            help = ''
+    @classmethod
+    def compile(cls):
+        """ build the argument parser shared by all requests
+        """
+        parser = reqparse.RequestParser(bundle_errors=True)
+        for k, v in cls.post_params.items():
+            v = dict(v)
             type_name = v['type'].__name__ if (
                 isclass(v['type']) or isfunction(v['type'])) \
                 else v['type'].__class__.__name__
@@ -151,7 +341,11 @@ class SakuraAPI(Resource):
                     k, type_name, v['choices'])
             else:
                 help = '{} must be {}'.format(k, type_name)
-            self.parser.add_argument(name=k, help=help, **v)
+            parser.add_argument(name=k, help=help, **v)
+        cls.parser = parser
+        return cls
+
+    def _parse_args(self):
         try:
             args = self.parser.parse_args(strict=True)
         except Exception as e:
@@ -165,13 +359,24 @@ class SakuraAPI(Resource):
     def _before_task(self, args):
         return args
 
+    def _task_unsent(self, args):
+        """ undo _before_task if the task could not be sent """
+        pass
+
     def post(self):
         """ execute a task
         """
         try:
-            args = self._parse_args(params=self.post_params)
+            load_json()
+            args = self._parse_args()
+            self.task_id = uuid()
             args = self._before_task(args=args)
-            task = eval('self.task.%s' % self.task_name).apply_async(kwargs=args)
+            try:
+                task = getattr(self.task, self.task_name).apply_async(
+                    kwargs=args, task_id=self.task_id)
+            except Exception:
+                self._task_unsent(args=args)
+                raise
             return {'id': task.task_id, 'status': 0}, 201
         except SakuraAPIError as e:
             app.logger.error(logmsg(traceback.format_exc()))
@@ -184,7 +389,16 @@ class SakuraAPI(Resource):
         """ check a specific task status
         """
         try:
-            task = eval('self.task.%s' % self.task_name).AsyncResult(id)
+            store = ProgressStore.instance()
+            entry = store.get(task_id=id) if store else None
+            if entry:
+                result = {
+                    'id': id,
+                    'state': entry['state'],
+                    'info': entry['meta']
+                }
+                return {'result': result, 'status': 0}, 200
+            task = getattr(self.task, self.task_name).AsyncResult(id)
             result = {
                 'id': task.id,
                 'state': task.result[0] if task.ready() else task.state,
@@ -204,67 +418,77 @@ class ConfigurationUpdateAPI(SakuraAPI):
         Configuration Update Restful API.
         Inherits from SakuraAPI.
     """
-    def __init__(self):
-        params = dict(
-            service_name=dict(type=str, required=True),
-            env_name=dict(type=str, required=True),
-            service_version=dict(type=str, required=True),
-            check_cmd=dict(type=str),
-            reload_cmd=dict(type=str),
-            files=dict(
-                type=defined_dictionary(
-                    keys=dict(
-                        name=str, dir=str, mode=str,
-                        owner=defined_dictionary(
-                            keys=dict(name=str, group=str)),
-                        template=unicode,
-                        items=union_dictionary(
-                            key_type=unicode, value_type=unicode))),
-                action='append', required=True),
-            hosts=dict(type=ip, action='append', required=True))
-        super(ConfigurationUpdateAPI, self).__init__(
-            task_name=C.TASK_NAME.CONFIGURATION_UPDATE.value,
-            post_params=params)
+    task_name = C.TASK_NAME.CONFIGURATION_UPDATE.value
+    post_params = dict(
+        service_name=dict(type=str, required=True),
+        env_name=dict(type=str, required=True),
+        service_version=dict(type=str, required=True),
+        check_cmd=dict(type=str),
+        reload_cmd=dict(type=str),
+        files=dict(
+            type=defined_dictionary(
+                keys=dict(
+                    name=str, dir=str, mode=str,
+                    owner=defined_dictionary(
+                        keys=dict(name=str, group=str)),
+                    template=unicode, template_id=str,
+                    items=union_dictionary(
+                        key_type=unicode, value_type=unicode)),
+                optional=['template', 'template_id']),
+            action='append', required=True),
+        hosts=dict(type=ip, action='append', required=True),
+        delta=dict(type=inputs.boolean),
+        batch_size=dict(type=batch_size),
+        max_parallel=dict(type=inputs.positive),
+        health_gate=dict(
+            type=str, choices=[
+                x.value for x in C.ROLLOUT_HEALTH_GATE]))
 
     def _before_task(self, args):
-        tasks = self.task.get(name=self.task_name, ack_status=None)
-        tasks.extend(self.task.get(
-            name=self.task_name,
-            ack_status=C.CONFIGURATION_UPDATE_ACK_STATE.PENDING.value))
-        # check pre task
-        for x in tasks:
-            kwargs = json.loads(x['kwargs'])
-            if (kwargs['service_name'] == args['service_name'] and
-                    kwargs['env_name'] == args['env_name'] and
-                    kwargs['service_version'] == args['service_version']):
-                raise SakuraConstraintConflictError(
-                    'Pre Task Unconfirmed: {0}'.format(x['task_id']))
+        check_templates(args['files'])
+        # check pre task and lock the service for this task
+        pre_task_id = TaskLock().acquire(
+            task_id=self.task_id, service_name=args['service_name'],
+            env_name=args['env_name'],
+            service_version=args['service_version'])
+        if pre_task_id:
+            raise SakuraConstraintConflictError(
+                'Pre Task Unconfirmed: {0}'.format(pre_task_id))
         return args
 
+    def _task_unsent(self, args):
+        # the lock would block the service till it expires otherwise
+        TaskLock.release(
+            task_id=self.task_id, service_name=args['service_name'],
+            env_name=args['env_name'],
+            service_version=args['service_version'])
+
 
 class ConfigurationCheckAPI(SakuraAPI):
     """
         Configuration Check Restful API.
         Inherits from SakuraAPI.
     """
-    def __init__(self):
-        params = dict(
-            files=dict(
-                type=defined_dictionary(
-                    keys=dict(
-                        name=unicode, dir=unicode, mode=str,
-                        owner=defined_dictionary(
-                            keys=dict(name=str, group=str)),
-                        template=unicode,
-                        items=union_dictionary(
-                            key_type=unicode, value_type=unicode)
-                        )
+    task_name = C.TASK_NAME.CONFIGURATION_CHECK.value
+    post_params = dict(
+        files=dict(
+            type=defined_dictionary(
+                keys=dict(
+                    name=unicode, dir=unicode, mode=str,
+                    owner=defined_dictionary(
+                        keys=dict(name=str, group=str)),
+                    template=unicode, template_id=str,
+                    items=union_dictionary(
+                        key_type=unicode, value_type=unicode)
                     ),
-                action='append', required=True),
-            hosts=dict(type=ip, action='append', required=True))
-        super(ConfigurationCheckAPI, self).__init__(
-            task_name=C.TASK_NAME.CONFIGURATION_CHECK.value,
-            post_params=params)
+                optional=['template', 'template_id']
+                ),
+            action='append', required=True),
+        hosts=dict(type=ip, action='append', required=True))
+
+    def _before_task(self, args):
+        check_templates(args['files'])
+        return args
 
 
 class ConfigurationAcknowledgeAPI(SakuraAPI):
@@ -272,11 +496,8 @@ class ConfigurationAcknowledgeAPI(SakuraAPI):
         Configuration Change Acknowledge Restful API.
         Inherits from SakuraAPI.
     """
-    def __init__(self):
-        params = dict(main_task_id=dict(type=str, required=True))
-        super(ConfigurationAcknowledgeAPI, self).__init__(
-            task_name=C.TASK_NAME.CONFIGURATION_ACKNOWLEDGE.value,
-            post_params=params)
+    task_name = C.TASK_NAME.CONFIGURATION_ACKNOWLEDGE.value
+    post_params = dict(main_task_id=dict(type=str, required=True))
 
     def _before_task(self, args):
         # check main task
@@ -315,11 +536,8 @@ class ConfigurationRollbackAPI(SakuraAPI):
         Configuration Rollback Restful API.
         Inherits from SakuraAPI.
     """
-    def __init__(self):
-        params = dict(main_task_id=dict(type=str, required=True))
-        super(ConfigurationRollbackAPI, self).__init__(
-            task_name=C.TASK_NAME.CONFIGURATION_ROLLBACK.value,
-            post_params=params)
+    task_name = C.TASK_NAME.CONFIGURATION_ROLLBACK.value
+    post_params = dict(main_task_id=dict(type=str, required=True))
 
     def _before_task(self, args):
         # check main task
@@ -347,3 +565,12 @@ class ConfigurationRollbackAPI(SakuraAPI):
             ack_status=C.CONFIGURATION_UPDATE_ACK_STATE.PENDING.value)
         args['main_task'] = main_task
         return args
+
+
+""" Compile
+"""
+
+
+for x in (TaskListAPI, ConfigurationUpdateAPI, ConfigurationCheckAPI,
+          ConfigurationAcknowledgeAPI, ConfigurationRollbackAPI):
+    x.compile()
@@ -7,18 +7,39 @@
 
 import os
 import re
+import sys
 import random
 import json
 import time
 import traceback
 from datetime import datetime
+from inspect import getargspec
 from celery.contrib.methods import task_method
+from celery.signals import worker_process_init
 
 from sakura import app, celery
 from sakura import constant as C
-from sakura.model import TaskManager
+from sakura.model import TaskManager, TaskLock
 from sakura.util import logmsg
-from sakura.tool import Etconf
+from sakura.tool import Etconf, ClientRegistry, RolloutScheduler
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """ build etcd/minio clients once per worker process """
+    with app.app_context():
+        try:
+            ClientRegistry.setup()
+        except Exception:
+            # clients would be built again by the first task
+            app.logger.error(logmsg(traceback.format_exc()))
+
+
+def etconf_args(main_task):
+    """ arguments of Etconf from kwargs of a configuration update task """
+    kwargs = main_task.loads('kwargs')
+    names = getargspec(Etconf.__init__).args
+    return {k: v for k, v in kwargs.items() if k in names}
 
 
 def sakura_task_catch(success_message, failure_message):
@@ -63,15 +84,15 @@ def sakura_task_catch(success_message, failure_message):
                     state=C.TASK_STATE.FAILURE.value,
                     current=C.TASK_PERCENTAGE.ENDPOINT.value)
             finally:
-                # record task
+                # record task with steps buffered while running, its progress
+                # published before it returns
                 end_time = datetime.now()
                 columns = dict(
-                    task_id=task_self.request.id,
                     info=json.dumps(meta),
                     end_time=end_time,
                     delta_time=(end_time - begin_time).total_seconds(),
                     state=state)
-                msg = notify.format(self.update(**columns))
+                msg = notify.format(self.progress(task_self).close(**columns))
                 app.logger.info(logmsg(msg))
                 # update main task if exists
                 if main_task_id:
@@ -112,7 +133,8 @@ class SakuraTask(TaskManager):
         failure_message='Error occurs while updating configurations.')
     def configuration_update(
             task_self, self, service_name, env_name, service_version, files,
-            hosts, check_cmd=None, reload_cmd=None):
+            hosts, check_cmd=None, reload_cmd=None, delta=False,
+            batch_size=None, max_parallel=None, health_gate=None):
         """
         Parameters:
             service_name(str)   : name of the service with configurations to update
@@ -134,7 +156,20 @@ class SakuraTask(TaskManager):
                                       ]
             hosts(list)         : hosts in which the configurations takes effect
                                   ex. ['127.0.0.1', ...]
+            delta(bool)         : only touch hosts/files/items changed since
+                                  the last update
+            batch_size(str)     : hosts of a rollout batch, ex. '2' or '25%'
+                                  all hosts in one batch if empty
+            max_parallel(int)   : max hosts of a batch handled at the same time
+            health_gate(str)    : check between batches, 'status' or 'check'
         """
+        # the lock of the service expires if this task waits too long in the
+        # queue, never update with the lock taken by another task
+        holder = TaskLock.holder(
+            service_name=service_name, env_name=env_name,
+            service_version=service_version)
+        if holder and holder != task_self.request.id:
+            raise Exception('Task Lock Taken: {0}.'.format(holder))
         # 0, initialize Etconf
         etconf, meta, state = self.task_step(
             task=task_self, name=Etconf,
@@ -145,6 +180,21 @@ class SakuraTask(TaskManager):
             message='Begin to update configurations of {0}.'.format(
                 service_name),
             flag=C.CONFIGURATION_UPDATE_STEP.INITIALIZE.value)
+        plan = None
+        if delta:
+            # compare with the last applied state
+            plan, meta, state = self.task_step(
+                task=task_self, name=etconf.diff_state,
+                current=random.randint(meta['current'], self._cur_edge),
+                message='Comparing with the last applied configurations ...')
+            if not plan['hosts'] and not plan['items']:
+                # nothing changed, no acknowledge or rollback needed
+                self.update(
+                    task_id=task_self.request.id,
+                    ack_status=getattr(
+                        C.CONFIGURATION_UPDATE_ACK_STATE,
+                        C.TASK_NAME.CONFIGURATION_ACKNOWLEDGE.value).value)
+                return plan
         # 1, create new template files
         ret, meta, state = self.task_step(
             task=task_self, name=etconf.create_tmpl,
@@ -165,34 +215,100 @@ class SakuraTask(TaskManager):
         ret, meta, state = self.task_step(
             task=task_self, name=etconf.backup_keys,
             message='Backuping old items ...')
-        # 5, stop confd client
-        ret, meta, state = self.task_step(
-            task=task_self, name=etconf.confd_cmd,
-            args=dict(action='stop'), message='Stopping remote CONFD ...',
-            current=random.randint(meta['current'], self._cur_edge),
-            flag=C.CONFIGURATION_UPDATE_STEP.CLEANUP.value)
-        # 6, delete old backuped toml/tmpl in remote confd client
-        ret, meta, state = self.task_step(
-            task=task_self, name=etconf.delete_files,
-            current=random.randint(meta['current'], self._cur_edge),
-            message='Deleting old template and toml files ...')
-        # 7, update etcd keys
-        ret, meta, state = self.task_step(
-            task=task_self, name=etconf.update_keys,
-            current=random.randint(meta['current'], self._cur_edge),
-            message='Updating items ...',
-            flag=C.CONFIGURATION_UPDATE_STEP.UPDATE.value)
-        # 8, push new toml/tmpl to remote/local confd client
-        ret, meta, state = self.task_step(
-            task=task_self, name=etconf.push_files,
-            current=random.randint(meta['current'], self._cur_edge),
-            message='Pushing new template and toml files ...')
-        # 9, start confd client
+        targets = etconf.rollout_hosts(plan=plan)
+        rollout = RolloutScheduler(
+            hosts=targets, batch_size=batch_size, max_parallel=max_parallel)
+        etconf.throttle(parallelism=rollout.max_parallel)
+        batches = rollout.batches
+        # ps: etcd keys are shared by all hosts, so confd of all hosts is
+        #     stopped before updating changed items and started batch by
+        #     batch, hosts of a batch render new items only at its start
+        gated = not plan or bool(plan['items'])
+        if gated:
+            # 5, stop confd client
+            ret, meta, state = self.task_step(
+                task=task_self, name=etconf.confd_cmd,
+                args=dict(action='stop', hosts=targets),
+                message='Stopping remote CONFD ...',
+                current=random.randint(meta['current'], self._cur_edge),
+                flag=C.CONFIGURATION_UPDATE_STEP.CLEANUP.value)
+            # 7, update etcd keys
+            ret, meta, state = self.task_step(
+                task=task_self, name=etconf.update_keys,
+                current=random.randint(meta['current'], self._cur_edge),
+                message='Updating items ...',
+                flag=C.CONFIGURATION_UPDATE_STEP.UPDATE.value)
+        try:
+            for i, batch in enumerate(batches):
+                first = i == 0
+                rolling = ' ({0}/{1})'.format(i + 1, len(batches)) if (
+                    len(batches) > 1) else ''
+                if not gated:
+                    # 5, stop confd client
+                    ret, meta, state = self.task_step(
+                        task=task_self, name=etconf.confd_cmd,
+                        args=dict(action='stop', hosts=batch),
+                        message='Stopping remote CONFD{0} ...'.format(rolling),
+                        current=random.randint(meta['current'], self._cur_edge),
+                        flag=C.CONFIGURATION_UPDATE_STEP.CLEANUP.value
+                        if first else None)
+                # 6, delete old backuped toml/tmpl in remote confd client
+                # ps: unnecessary for a delta update without files removed
+                if not plan or plan['removed']:
+                    ret, meta, state = self.task_step(
+                        task=task_self, name=etconf.delete_files,
+                        args=dict(hosts=batch),
+                        current=random.randint(meta['current'], self._cur_edge),
+                        message='Deleting old template and toml files{0} ...'
+                                .format(rolling))
+                if not gated and first:
+                    # 7, update etcd keys, nothing changed but the step flag
+                    ret, meta, state = self.task_step(
+                        task=task_self, name=etconf.update_keys,
+                        current=random.randint(meta['current'], self._cur_edge),
+                        message='Updating items ...',
+                        flag=C.CONFIGURATION_UPDATE_STEP.UPDATE.value)
+                # 8, push new toml/tmpl to remote/local confd client
+                # ps: a delta update pushes only changed files to hosts
+                #     which have applied the last state
+                for part, names in etconf.delta_pushes(plan=plan, hosts=batch):
+                    ret, meta, state = self.task_step(
+                        task=task_self, name=etconf.push_files,
+                        args=dict(hosts=part, files=names),
+                        current=random.randint(meta['current'], self._cur_edge),
+                        message='Pushing new template and toml files{0} ...'
+                                .format(rolling))
+                # 9, start confd client
+                ret, meta, state = self.task_step(
+                    task=task_self, name=etconf.confd_cmd,
+                    args=dict(action='start', hosts=batch),
+                    current=random.randint(meta['current'], self._cur_edge),
+                    message='Starting remote CONFD{0} ...'.format(rolling))
+                # 9.1, verify the batch before rolling the next one
+                if health_gate:
+                    ret, meta, state = self.task_step(
+                        task=task_self, name=etconf.health_gate,
+                        args=dict(gate=health_gate, hosts=batch),
+                        current=random.randint(meta['current'], self._cur_edge),
+                        message='Checking health of hosts{0} ...'.format(rolling))
+        except Exception:
+            # hosts of batches not rolled yet were stopped up front, start
+            # them again before raising the failure
+            rest = [x for y in batches[i + 1:] for x in y]
+            if gated and rest:
+                exc_info = sys.exc_info()
+                try:
+                    etconf.confd_cmd(action='start', hosts=rest)
+                except Exception:
+                    app.logger.error(logmsg(traceback.format_exc()))
+                raise exc_info[0], exc_info[1], exc_info[2]
+            raise
+        # 10, record applied state for the next delta update
         ret, meta, state = self.task_step(
-            task=task_self, name=etconf.confd_cmd,
-            args=dict(action='start'),
+            task=task_self, name=etconf.save_state,
             current=random.randint(meta['current'], self._cur_edge),
-            message='Starting remote CONFD ...')
+            message='Recording applied configurations ...')
+        return plan
 
     @celery.task(
         bind=True, filter=task_method, queue=_queue, routing_key=_routing_key,
@@ -218,12 +334,24 @@ class SakuraTask(TaskManager):
             hosts(list)         : hosts in which the configurations takes effect
                                   ex. ['127.0.0.1', ...]
         """
-        result, ret, meta, state = [], None, None, None
-        for x in files:
+        result, ret, meta, state = [None] * len(files), None, None, None
+        # files sharing a name are checked in separate batches,
+        # ex. [[(index, file), ...], ...]
+        batches = []
+        for i, x in enumerate(files):
+            for y in batches:
+                if x['name'] not in [z['name'] for _, z in y]:
+                    y.append((i, x))
+                    break
+            else:
+                batches.append([(i, x)])
+        for x in batches:
             kwargs = dict(
-                task=task_self, name=Etconf, args=dict(files=[x], hosts=hosts),
-                message='Checking file {0} ...'.format(
-                    os.path.join(x['dir'], x['name'])))
+                task=task_self, name=Etconf,
+                args=dict(files=[y for _, y in x], hosts=hosts),
+                message='Checking files {0} ...'.format(
+                    ', '.join([os.path.join(y['dir'], y['name'])
+                               for _, y in x])))
             if meta:
                 kwargs['current'] = random.randint(meta['current'], self._cur_edge)
             etconf, meta, state = self.task_step(**kwargs)
@@ -231,7 +359,9 @@ class SakuraTask(TaskManager):
                 task=task_self, name=etconf.check_files,
                 current=random.randint(meta['current'], self._cur_edge),
                 message=meta['message'])
-            result.append(ret)
+            # results follow the order of files requested
+            for i, y in x:
+                result[i] = {y['name']: ret[y['name']]}
         return result
 
     @celery.task(
@@ -248,7 +378,7 @@ class SakuraTask(TaskManager):
         # 0, initialize Etconf
         etconf, meta, state = self.task_step(
             task=task_self, name=Etconf,
-            args=json.loads(main_task.kwargs),
+            args=etconf_args(main_task),
             message='Begin to acknowledge task <{0}>.'.format(
                 main_task.task_id))
         # 1, stop confd client
@@ -288,7 +418,7 @@ class SakuraTask(TaskManager):
             # 0, initialize Etconf
             etconf, meta, state = self.task_step(
                 task=task_self, name=Etconf,
-                args=json.loads(main_task.kwargs),
+                args=etconf_args(main_task),
                 message='Begin to rollback task <{0}>.'.format(
                     main_task.task_id))
             # 1, stop confd client
@@ -320,3 +450,8 @@ class SakuraTask(TaskManager):
                 args=dict(action='start'),
                 current=random.randint(meta['current'], self._cur_edge),
                 message='Starting remote CONFD ...')
+            # 6, forget applied state, the next delta update would be full
+            ret, meta, state = self.task_step(
+                task=task_self, name=etconf.clear_state,
+                current=random.randint(meta['current'], self._cur_edge),
+                message='Clearing applied configurations ...')
@@ -7,13 +7,36 @@
 
 import os
 import re
+import math
+import calendar
 import time
+import json
+import base64
+import pipes
+import shutil
+import tarfile
+import tempfile
+import threading
+import traceback
+import multiprocessing
+from io import BytesIO
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from minio.error import BucketAlreadyOwnedByYou, BucketAlreadyExists
 
 from lotus.api import Ansible2API, EtcdAPI, MinioAPI
 from sakura import app
-from sakura.util import get_folder, remove_folder, logmsg, md5hex
+from sakura import constant as C
+from sakura.util import (
+    get_folder, remove_folder, logmsg, md5hex, md5file, LRUCache)
+
+
+# (host, user, group) -> dict(uid, gid), shared by tasks of a worker process
+uid_cache = (
+    LRUCache(
+        maxsize=app.config['SAKURA_UID_CACHE_SIZE'],
+        ttl=app.config['SAKURA_UID_CACHE_TTL'])
+    if app.config['SAKURA_UID_CACHE_TTL'] else None)
 
 
 class Etconf(object):
@@ -55,45 +78,35 @@ class Etconf(object):
                     app.config['CA_FOLDER'], app.config['ANSIBLE_SSH_KEY'])
                 if 'ANSIBLE_SSH_KEY' in app.config and
                 app.config['ANSIBLE_SSH_KEY'] else None))
+        # ansible forks of a multi-host run
+        self._ansible_forks = app.config['SAKURA_ANSIBLE_FORKS']
+        # runner of per-host pipelines
+        self._executor = HostExecutor()
+        # (host, user, group) -> dict(uid, gid), memo of this task
+        self._uids = {}
 
         # etcd
-        self.etcd_kwargs = dict(
-            host=app.config['ETCD_HOST'], port=app.config['ETCD_PORT'],
-            per_host_pool_size=10)
-        # etcd client cert/key file
-        if (
-                'ETCD_CERT' in app.config and app.config['ETCD_CERT'] and
-                'ETCD_CA_CERT' in app.config and app.config['ETCD_CA_CERT']):
-            self.etcd_kwargs['protocol'] = 'https'
-            self.etcd_kwargs['cert'] = (
-                os.path.join(app.config['CA_FOLDER'], app.config['ETCD_CERT'][0]),
-                os.path.join(app.config['CA_FOLDER'], app.config['ETCD_CERT'][1]))
-            self.etcd_kwargs['ca_cert'] = os.path.join(
-                app.config['CA_FOLDER'], app.config['ETCD_CA_CERT'])
-        # build connection to etcd server
-        self.etcd = EtcdAPI(**self.etcd_kwargs)
-        self.etcd.connect()
+        self.etcd_kwargs = ClientRegistry.etcd_kwargs()
         # etcd key backup prefix
         self._key_bak_pre = 'bak'
+        # keys of the service held in memory, {rollback: {cfg_name: items}}
+        self._keys = {}
+        # etcd prefix of the last applied state
+        self._key_meta_pre = 'meta'
 
         # minio
-        minio_kwargs = dict(
-            endpoint=app.config['MINIO_ENDPOINT'],
-            access_key=app.config['MINIO_ACCESS_KEY'],
-            secret_key=app.config['MINIO_SECRET_KEY'],
-            secure=False)
         # minio bucket name
         self._minio_bucket = app.config['MINIO_BUCKET']
-        # build connection to minio server
-        self.minio = MinioAPI(**minio_kwargs)
-        self.minio.connect()
-        try:
-            self.minio.make_bucket(self._minio_bucket)
-        except (BucketAlreadyOwnedByYou, BucketAlreadyExists):
-            pass
+        # fill templates of files referring to uploaded ones
+        if [x for x in self._files if not x.get('template')]:
+            TemplateStore(
+                minio=self.minio, bucket_name=self._minio_bucket).resolve(
+                files=self._files)
         # file name broken words using on minio
         self._broken_word_1 = 'i@mMINI0'
         self._broken_word_2 = 'iLikeKB'
+        # remote toml/tmpl/conf files collected per host
+        self._snapshots = {}
 
         # confd
         # remote toml folder
@@ -113,9 +126,10 @@ class Etconf(object):
         self._l_tmpl = os.path.join(
             app.config['TMP_FOLDER'], 'templates', self._folder_pre)
         # create local toml/tmpl folder
-        for x in self._hosts:
-            get_folder(os.path.join(self._l_toml, x))
+        get_folder(self._l_toml)
         get_folder(self._l_tmpl)
+        # toml artifact group -> hosts sharing the same uids and gids
+        self._toml_groups = {}
         # local tmpl backup folder
         self._l_toml_bak = os.path.join(
             app.config['DATA_FOLDER'], 'backup', 'conf.d', self._folder_pre)
@@ -136,6 +150,23 @@ class Etconf(object):
         remove_folder(self._l_toml)
         remove_folder(self._l_tmpl)
 
+    @property
+    def etcd(self):
+        """ reuse connection to etcd server of this process """
+        return ClientRegistry.etcd()
+
+    @property
+    def minio(self):
+        """ reuse connection to minio server of this process """
+        return ClientRegistry.minio()
+
+    @property
+    def _backups(self):
+        """ content-addressed backups on minio server """
+        return BackupStore(
+            minio=self.minio, bucket_name=self._minio_bucket,
+            folder_pre=self._folder_pre)
+
     @property
     def _file_pre(self):
         return '%s.%s.%s' % (self._env, self._service, self._version)
@@ -144,6 +175,16 @@ class Etconf(object):
     def _folder_pre(self):
         return os.path.join(self._env, self._service, self._version)
 
+    def _conf_bak_name(self, cfg):
+        """get backup file name of a configuration file
+            ps: the name keeps mode/owner/path of the file for rollback
+        """
+        src = os.path.join(cfg['dir'], cfg['name'])
+        return '%s%s%s' % (
+            '@@'.join([cfg['mode'], cfg['owner']['name'], cfg['owner']['group']]),
+            self._broken_word_2,
+            src.replace('/', self._broken_word_1))
+
     def get_cfg_name(self, toml_name):
         """get configuration file name from toml file name
         """
@@ -152,37 +193,89 @@ class Etconf(object):
     def get_uids(self, name, group):
         """fetch owner's uid and gid via name
         """
-        aapi = Ansible2API(hosts=self._hosts, **self._ansible_kwargs)
-        state, state_sum, results = ansible_safe_run(
-            aapi=aapi, module='shell',
-            args="cat /etc/passwd | grep ^%s: | awk -F ':' '{print $3}';"
-                 "cat /etc/passwd | grep ^%s: | awk -F ':' '{print $3}';" % (
-                     name, group))
-        msg = 'Uid and Gid Get: %s' % state_sum
-        app.logger.debug(logmsg(msg))
-        msg = 'Uid and Gid Get: %s' % results
-        app.logger.info(logmsg(msg))
-        ret = {}
-        for k, v in results.items():
-            if len(v['stdout_lines']) == 2:
-                ret[k] = dict(
-                    uid=v['stdout_lines'][0], gid=v['stdout_lines'][1])
-            else:
-                raise Exception(
-                    '{0}: No such user or group ({1}, {2})'.format(
-                        k, name, group))
-        return ret
+        return self.resolve_uids(owners=[(name, group)])[(name, group)]
+
+    def resolve_uids(self, owners):
+        """fetch uids and gids of several owners via names in one remote call
+            ret: {(name, group): {host: dict(uid=, gid=)}}
+        """
+        owners = set(owners)
+        # owners not resolved yet on each host
+        missing = {}
+        for host in self._hosts:
+            for x in owners:
+                key = (host, ) + x
+                if key in self._uids:
+                    continue
+                cached = uid_cache.get(key) if uid_cache else None
+                if cached:
+                    self._uids[key] = cached
+                else:
+                    missing.setdefault(host, set()).add(x)
+        if missing:
+            names = sorted(set([x[0] for y in missing.values() for x in y]))
+            groups = sorted(set([x[1] for y in missing.values() for x in y]))
+            aapi = Ansible2API(hosts=missing.keys(), **self._ansible_kwargs)
+            state, state_sum, results = ansible_safe_run(
+                aapi=aapi, module='shell',
+                args="getent passwd %s | cut -d: -f1,3 | sed 's/^/u:/';"
+                     "getent group %s | cut -d: -f1,3 | sed 's/^/g:/';" % (
+                         ' '.join([pipes.quote(x) for x in names]),
+                         ' '.join([pipes.quote(x) for x in groups])))
+            msg = 'Uid and Gid Get: %s' % state_sum
+            app.logger.debug(logmsg(msg))
+            msg = 'Uid and Gid Get: %s' % results
+            app.logger.info(logmsg(msg))
+            for host, v in missing.items():
+                ids = dict(u={}, g={})
+                for x in results[host]['stdout_lines']:
+                    info = x.split(':')
+                    if len(info) == 3 and info[0] in ids:
+                        ids[info[0]][info[1]] = info[2]
+                for name, group in v:
+                    if name not in ids['u'] or group not in ids['g']:
+                        raise Exception(
+                            '{0}: No such user or group ({1}, {2})'.format(
+                                host, name, group))
+                    key = (host, name, group)
+                    self._uids[key] = dict(
+                        uid=ids['u'][name], gid=ids['g'][group])
+                    if uid_cache:
+                        uid_cache.set(key, self._uids[key])
+        return {x: {host: self._uids[(host, ) + x] for host in self._hosts}
+                for x in owners}
+
+    def group_hosts(self, usrs):
+        """group hosts by uids and gids of all file owners
+            ret: {group: [host, ...]}, hosts of a group share the same tomls
+        """
+        groups = {}
+        for host in self._hosts:
+            signature = [
+                (x['name'],
+                 usrs[(x['owner']['name'], x['owner']['group'])][host]['uid'],
+                 usrs[(x['owner']['name'], x['owner']['group'])][host]['gid'])
+                for x in self._files]
+            groups.setdefault(md5hex(json.dumps(signature)), []).append(host)
+        return groups
 
     def create_toml(self):
-        """create toml files
+        """create toml files, once per group of hosts with the same owners
         """
         result = {}
+        usrs = self.resolve_uids(
+            owners=[(x['owner']['name'], x['owner']['group'])
+                    for x in self._files])
+        self._toml_groups = self.group_hosts(usrs)
+        for group, hosts in self._toml_groups.items():
+            get_folder(os.path.join(self._l_toml, group))
         for x in self._files:
             result[x['name']] = {}
-            usr = self.get_uids(**x['owner'])
-            for host in self._hosts:
+            usr = usrs[(x['owner']['name'], x['owner']['group'])]
+            for group, hosts in self._toml_groups.items():
+                host = hosts[0]
                 toml_file = os.path.join(
-                    self._l_toml, host,
+                    self._l_toml, group,
                     '{0}.{1}.toml'.format(self._file_pre, x['name']))
                 with open(toml_file, 'w') as f:
                     content = [
@@ -206,7 +299,8 @@ class Etconf(object):
                     f.writelines(content)
                 msg = 'Toml File Created: %s.' % toml_file
                 app.logger.info(logmsg(msg))
-                result[x['name']][host] = toml_file
+                for host in hosts:
+                    result[x['name']][host] = toml_file
         return result
 
     def create_tmpl(self):
@@ -226,15 +320,20 @@ class Etconf(object):
     def get_toml_content(self, cfg_name, host):
         """get toml file content from remote confd client
         """
-        aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
-        state, state_sum, results = ansible_safe_run(
-            aapi=aapi, module='shell',
-            args='cat %s.%s.toml' % (self._file_pre, cfg_name))
-        msg = 'Toml File Get: %s' % state_sum
-        app.logger.debug(logmsg(msg))
-        msg = 'Toml File Get: %s' % results
-        app.logger.info(logmsg(msg))
-        results = results[host]['stdout_lines'][1:]
+        toml_name = '%s.%s.toml' % (self._file_pre, cfg_name)
+        if host in self._snapshots:
+            with open(os.path.join(self._l_toml_bak, host, toml_name)) as f:
+                results = f.read().splitlines()[1:]
+        else:
+            aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
+            state, state_sum, results = ansible_safe_run(
+                aapi=aapi, module='shell',
+                args='cat %s' % os.path.join(self._r_toml, toml_name))
+            msg = 'Toml File Get: %s' % state_sum
+            app.logger.debug(logmsg(msg))
+            msg = 'Toml File Get: %s' % results
+            app.logger.info(logmsg(msg))
+            results = results[host]['stdout_lines'][1:]
         ret = dict()
         for x in results:
             key, value = x.split(' = ')
@@ -244,10 +343,15 @@ class Etconf(object):
     def get_tmpl_content(self, cfg_name, host):
         """get template file content from remote confd client
         """
+        if host in self._snapshots:
+            with open('{0}.tmpl'.format(
+                    os.path.join(self._l_tmpl_bak, host, cfg_name))) as f:
+                return '%s\r\n' % f.read().rstrip('\r\n')
         aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
         state, state_sum, results = ansible_safe_run(
             aapi=aapi, module='shell',
-            args='cat %s.tmpl' % os.path.join(self._folder_pre, cfg_name))
+            args='cat %s.tmpl' % os.path.join(
+                self._r_tmpl, self._folder_pre, cfg_name))
         msg = 'Tmpl File Get: %s' % state_sum
         app.logger.debug(logmsg(msg))
         msg = 'Tmpl File Get: %s' % results
@@ -257,6 +361,8 @@ class Etconf(object):
     def get_tomls(self, host):
         """get toml files from remote confd client
         """
+        if host in self._snapshots:
+            return list(self._snapshots[host]['tomls'])
         aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
         state, state_sum, results = ansible_safe_run(
             aapi=aapi, module='shell',
@@ -271,6 +377,8 @@ class Etconf(object):
     def get_tmpls(self, host):
         """get template files from remote confd client
         """
+        if host in self._snapshots:
+            return list(self._snapshots[host]['tmpls'])
         aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
         state, state_sum, results = ansible_safe_run(
             aapi=aapi, module='shell',
@@ -285,227 +393,279 @@ class Etconf(object):
     def backup_files(self):
         """backup old toml/tmpl/cfg files from remote confd client to server
         """
-        for host in self._hosts:
-            # local filesystem
-            toml_bak = os.path.join(self._l_toml_bak, host)
-            tmpl_bak = os.path.join(self._l_tmpl_bak, host)
-            conf_bak = os.path.join(self._l_conf_bak, host)
-            remove_folder(toml_bak)
-            remove_folder(tmpl_bak)
-            remove_folder(conf_bak)
-            get_folder(toml_bak)
-            get_folder(tmpl_bak)
-            get_folder(conf_bak)
-            # minio server
-            toml_pre = '%s/' % os.path.join('toml', self._folder_pre, host)
-            tmpl_pre = '%s/' % os.path.join('tmpl', self._folder_pre, host)
-            conf_pre = '%s/' % os.path.join('conf', self._folder_pre, host)
-            objs = self.minio.list_objects(
-                bucket_name=self._minio_bucket, prefix=toml_pre, recursive=False)
-            for x in objs:
-                self.minio.remove_object(
-                    bucket_name=self._minio_bucket,
-                    object_name=x.object_name.encode('utf-8'))
-            objs = self.minio.list_objects(
-                bucket_name=self._minio_bucket, prefix=tmpl_pre, recursive=False)
-            for x in objs:
-                self.minio.remove_object(
-                    bucket_name=self._minio_bucket,
-                    object_name=x.object_name.encode('utf-8'))
-            objs = self.minio.list_objects(
-                bucket_name=self._minio_bucket, prefix=conf_pre, recursive=False)
-            for x in objs:
-                self.minio.remove_object(
-                    bucket_name=self._minio_bucket,
-                    object_name=x.object_name.encode('utf-8'))
-            aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
-            # 1. backup toml to minio server
-            tomls = self.get_tomls(host=host)
-            for x in tomls:
-                state, state_sum, results = ansible_safe_run(
-                    aapi=aapi, module='fetch',
-                    args=dict(
-                        dest='%s/' % toml_bak,
-                        src=os.path.join(self._r_toml, x),
-                        flat='yes'))
-                msg = 'Toml File Backup: %s' % state_sum
-                app.logger.debug(logmsg(msg))
-                msg = 'Toml File Backup: %s' % results
-                app.logger.info(logmsg(msg))
-                self.minio.fput_object(
-                    bucket_name=self._minio_bucket,
-                    object_name=os.path.join(toml_pre, x),
-                    file_path=os.path.join(toml_bak, x))
-            # 2. backup tmpl to minio server
-            tmpls = self.get_tmpls(host=host)
-            for x in tmpls:
-                state, state_sum, results = ansible_safe_run(
-                    aapi=aapi, module='fetch',
-                    args=dict(
-                        dest='%s/' % tmpl_bak,
-                        src=os.path.join(self._r_tmpl, self._folder_pre, x),
-                        flat='yes'))
-                msg = 'Tmpl File Backup: %s' % state_sum
-                app.logger.debug(logmsg(msg))
-                msg = 'Tmpl File Backup: %s' % results
-                app.logger.info(logmsg(msg))
-                self.minio.fput_object(
-                    bucket_name=self._minio_bucket,
-                    object_name=os.path.join(tmpl_pre, x),
-                    file_path=os.path.join(tmpl_bak, x))
-            # 3. backup conf to minio server
-            # files should include (name, dir, mode, owner)
-            for x in self._files:
-                src = os.path.join(x['dir'], x['name'])
-                file_name = '%s%s%s' % (
-                    '@@'.join([x['mode'], x['owner']['name'], x['owner']['group']]),
-                    self._broken_word_2,
-                    src.replace('/', self._broken_word_1))
-                state, state_sum, results = ansible_safe_run(
-                    aapi=aapi, module='fetch',
-                    args=dict(
-                        dest=os.path.join(conf_bak, file_name),
-                        src=src, flat='yes'))
-                msg = 'Conf File Backup: %s' % state_sum
-                app.logger.debug(logmsg(msg))
-                msg = 'Conf File Backup: %s' % results
-                app.logger.info(logmsg(msg))
-                file_path = os.path.join(conf_bak, file_name)
-                if os.path.isfile(file_path):
-                    self.minio.fput_object(
-                        bucket_name=self._minio_bucket,
-                        object_name=os.path.join(conf_pre, file_name),
-                        file_path=file_path)
-            # 4. check if toml/tmpl/conf have been backuped to minio server
-            objs = [os.path.basename(x.object_name.encode('utf-8')) for x in
-                    self.minio.list_objects(
-                        bucket_name=self._minio_bucket, prefix=toml_pre,
-                        recursive=False)]
-            for x in tomls:
-                if x not in objs:
-                    raise Exception('Toml Backup Failed: %s.' % x)
-            objs = [os.path.basename(x.object_name.encode('utf-8')) for x in
-                    self.minio.list_objects(
-                        bucket_name=self._minio_bucket, prefix=tmpl_pre,
-                        recursive=False)]
-            for x in tmpls:
-                if x not in objs:
-                    raise Exception('Tmpl Backup Failed: %s.' % x)
+        results = self._executor.run(
+            action='Files Backup', hosts=self._hosts, func=self._backup_host)
+        # collected by the host processes, reused by the following steps
+        for host, v in results.items():
+            self._snapshots[host] = v['result']['snapshot']
+        return results
+
+    def snapshot(self, host):
+        """collect toml/tmpl/conf files of a host in one remote invocation
+            ps: files are unpacked into the local backup folders
+        """
+        # local filesystem
+        toml_bak = os.path.join(self._l_toml_bak, host)
+        tmpl_bak = os.path.join(self._l_tmpl_bak, host)
+        conf_bak = os.path.join(self._l_conf_bak, host)
+        for x in (toml_bak, tmpl_bak, conf_bak):
+            remove_folder(x)
+            get_folder(x)
+        # archive members are relative to '/'
+        r_toml = self._r_toml.lstrip('/')
+        r_tmpl = os.path.join(self._r_tmpl, self._folder_pre).lstrip('/')
+        confs = {os.path.join(x['dir'], x['name']).lstrip('/'):
+                 self._conf_bak_name(x) for x in self._files}
+        paths = [
+            '%s.*.toml' % pipes.quote(os.path.join(r_toml, self._file_pre)),
+            '%s/*' % pipes.quote(r_tmpl)] + [pipes.quote(x) for x in confs]
+        # stream a gzipped tarball of all existing files back via stdout
+        aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
+        state, state_sum, results = ansible_safe_run(
+            aapi=aapi, module='shell',
+            args='cd / && for f in %s; do [ -f "$f" ] && echo "$f"; done | '
+                 'tar czf - -T - | base64' % ' '.join(paths))
+        msg = 'Files Snapshot: %s' % state_sum
+        app.logger.debug(logmsg(msg))
+        try:
+            tar = tarfile.open(
+                fileobj=BytesIO(base64.b64decode(results[host]['stdout'])),
+                mode='r:gz')
+        except Exception:
+            raise Exception('{0}: Files Snapshot Failed ({1})'.format(
+                host, results[host]['stderr']))
+        ret = dict(tomls=[], tmpls=[], confs=[])
+        for x in tar.getmembers():
+            if not x.isfile():
+                continue
+            if x.name in confs:
+                kind, folder, name = 'confs', conf_bak, confs[x.name]
+            elif os.path.dirname(x.name) == r_toml:
+                kind, folder, name = 'tomls', toml_bak, os.path.basename(x.name)
+            elif os.path.dirname(x.name) == r_tmpl:
+                kind, folder, name = 'tmpls', tmpl_bak, os.path.basename(x.name)
+            else:
+                continue
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(tar.extractfile(x).read())
+            ret[kind].append(name)
+        tar.close()
+        self._snapshots[host] = ret
+        msg = 'Files Snapshot: %s' % {host: ret}
+        app.logger.info(logmsg(msg))
+        return ret
+
+    def forget_snapshots(self, hosts):
+        """ remote files changed, changes of host processes are not seen
+            by this process
+        """
+        for host in hosts:
+            self._snapshots.pop(host, None)
+
+    def _backup_host(self, host):
+        """backup old toml/tmpl/cfg files of a single host
+        """
+        folders = dict(
+            tomls=os.path.join(self._l_toml_bak, host),
+            tmpls=os.path.join(self._l_tmpl_bak, host),
+            confs=os.path.join(self._l_conf_bak, host))
+        # 1. collect toml/tmpl/conf from remote/local confd client at once
+        snapshot = self.snapshot(host=host)
+        # 2. backup toml/tmpl/conf to minio server
+        # files should include (name, dir, mode, owner)
+        return dict(snapshot=snapshot, backup=self._backups.save(
+            host=host, files={
+                k: {x: os.path.join(v, x) for x in snapshot[k]}
+                for k, v in folders.items()}))
 
     def backup_keys(self):
         """backup configuration keys using etcd server
         """
         dir_pre = os.path.join('/', self._key_bak_pre, self._folder_pre)
-        if dir_pre in self.etcd:
-            self.etcd.delete(key=dir_pre, dir=True, recursive=True)
-        for x in self._files:
-            items = self.get_keys(cfg_name=x['name'])
-            for k, v in items.items():
-                ret = self.etcd.write(
-                    key=os.path.join(dir_pre, x['name'], k), value=v)
-                msg = 'Etcd Key Backup: %s.' % ret
-                app.logger.info(logmsg(msg))
+        current = self.key_snapshot()
+        backup = self.key_snapshot(rollback=True)
+        # backup should be the same as current keys of the files
+        expected = {x['name']: current.get(x['name'], {}) for x in self._files}
+        writes, deletes = self._diff_keys(
+            dir_pre=dir_pre, current=backup, expected=expected)
+        deletes.extend([
+            os.path.join(dir_pre, k, y) for k, v in backup.items()
+            if k not in expected for y in v])
+        ret = EtcdBulkWriter(self.etcd).run(
+            action='Etcd Key Backup', writes=writes, deletes=deletes)
+        self._keys[True] = {k: dict(v) for k, v in expected.items()}
+        return ret
 
     def update_keys(self, rollback=False):
         """ update configuration keys stored in etcd server
             ps: when called for rollback, would delete keys totally new
         """
+        dir_pre = os.path.join('/', self._folder_pre)
+        current = self.key_snapshot()
+        expected = {}
         for x in self._files:
             items = (self.get_keys(cfg_name=x['name'], rollback=rollback)
                      if rollback else x['items'])
             # delete keys which did not exist before update when doing rollback
-            diff = set(x['items'].keys()).difference(set(items.keys()))
-            for k in diff:
-                key = os.path.join('/', self._folder_pre, x['name'], k)
-                if key in self.etcd:
-                    ret = self.etcd.delete(key=key)
-                    msg = 'Etcd Key Deleted: %s.' % ret
-                    app.logger.info(logmsg(msg))
-            # update keys
+            expected[x['name']] = dict(current.get(x['name'], {}))
+            expected[x['name']].update(items)
+            for k in set(x['items'].keys()).difference(set(items.keys())):
+                expected[x['name']].pop(k, None)
+        writes, deletes = self._diff_keys(
+            dir_pre=dir_pre, current=current, expected=expected)
+        ret = EtcdBulkWriter(self.etcd).run(
+            action='Etcd Key Update', writes=writes, deletes=deletes)
+        current.update(expected)
+        return ret
+
+    def _diff_keys(self, dir_pre, current, expected):
+        """ compare keys of configuration files with the expected ones
+            ret: keys to write ({key: value}) and keys to delete ([key])
+        """
+        writes, deletes = {}, []
+        for cfg_name, items in expected.items():
+            old = current.get(cfg_name, {})
             for k, v in items.items():
-                ret = self.etcd.write(
-                    key=os.path.join('/', self._folder_pre, x['name'], k),
-                    value=v)
-                msg = 'Etcd Key Updated: %s.' % ret
-                app.logger.info(logmsg(msg))
+                if k not in old or old[k] != v:
+                    writes[os.path.join(dir_pre, cfg_name, k)] = v
+            deletes.extend([
+                os.path.join(dir_pre, cfg_name, k) for k in old
+                if k not in items])
+        return writes, deletes
+
+    def key_snapshot(self, rollback=False):
+        """ get configuration keys of the service in one recursive read
+            ps: held in memory for the rest of the task
+        """
+        if rollback not in self._keys:
+            self._keys[rollback] = self.read_keys(key_pre=os.path.join(
+                '/',
+                (os.path.join(self._key_bak_pre, self._folder_pre)
+                 if rollback else self._folder_pre)))
+        return self._keys[rollback]
+
+    def read_keys(self, key_pre):
+        """ get configuration keys under a prefix in one recursive read
+            ret: {cfg_name: {key: value}}
+        """
+        ret = {}
+        if key_pre in self.etcd:
+            father = self.etcd.read(key=key_pre, recursive=True)
+            for x in father.leaves:
+                path = x.key[len(key_pre):].strip('/').split('/')
+                if x.dir or len(path) != 2:
+                    continue
+                ret.setdefault(path[0], {})[path[1]] = x.value
+        msg = 'Etcd Key Read: %s.' % ret
+        app.logger.debug(logmsg(msg))
+        return ret
 
     def get_keys(self, cfg_name, rollback=False):
         """ get configuration keys stored in the etcd server """
-        key_pre = os.path.join(
-            '/',
-            (os.path.join(self._key_bak_pre, self._folder_pre)
-             if rollback else os.path.join(self._folder_pre)),
-            cfg_name)
-        items = {}
-        if key_pre in self.etcd:
-            father = self.etcd.read(key=key_pre)
-            msg = 'Etcd Key Read: %s.' % father
-            app.logger.info(logmsg(msg))
-            if hasattr(father, '_children'):
-                for x in father._children:
-                    items[x['key'].split('/')[-1]] = x['value']
-        return items
+        return dict(self.key_snapshot(rollback=rollback).get(cfg_name, {}))
 
     def delete_expired_keys(self):
         """delete expired configuration keys stored in etcd server
         """
+        dir_pre = os.path.join('/', self._folder_pre)
+        current = self.key_snapshot()
+        deletes = []
+        for x in self._files:
+            deletes.extend([
+                os.path.join(dir_pre, x['name'], k)
+                for k in current.get(x['name'], {}) if k not in x['items']])
+            current[x['name']] = {
+                k: v for k, v in current.get(x['name'], {}).items()
+                if k in x['items']}
+        return EtcdBulkWriter(self.etcd).run(
+            action='Etcd Key Delete', deletes=deletes)
+
+    def _file_digest(self, cfg):
+        """digest of everything but items that makes up toml/tmpl of a file
+        """
+        return md5hex(json.dumps(
+            [cfg['name'], cfg['dir'], cfg['mode'], cfg['owner'],
+             cfg['template'], sorted(cfg['items'].keys()),
+             self._check_cmd, self._reload_cmd], sort_keys=True))
+
+    def diff_state(self):
+        """ compare the requested files/items/hosts with the last applied state
+            ret: dict(
+                    files=[names of changed files], removed=[names of files
+                    no more requested], items=[keys to write or delete],
+                    hosts=[hosts to push files to], fresh=[hosts never
+                    applied])
+        """
+        applied = self.read_keys(
+            key_pre=os.path.join('/', self._key_meta_pre, self._folder_pre))
+        files, hosts = applied.get('files', {}), applied.get('hosts', {})
+        names = [x['name'] for x in self._files]
+        changed = [x['name'] for x in self._files
+                   if files.get(x['name']) != self._file_digest(x)]
+        removed = [x for x in files if x not in names]
+        # items compared with those stored in etcd
+        current = self.key_snapshot()
+        expected = {}
         for x in self._files:
-            key_pre = os.path.join('/', self._folder_pre, x['name'])
-            if key_pre in self.etcd:
-                father = self.etcd.read(key=key_pre)
-                if hasattr(father, '_children'):
-                    for y in father._children:
-                        if y['key'].split('/')[-1] not in x['items'].keys():
-                            ret = self.etcd.delete(key=y['key'])
-                            msg = 'Etcd Key Deleted: %s.' % ret
-                            app.logger.info(logmsg(msg))
+            expected[x['name']] = dict(current.get(x['name'], {}))
+            expected[x['name']].update(x['items'])
+        writes, deletes = self._diff_keys(
+            dir_pre=os.path.join('/', self._folder_pre), current=current,
+            expected=expected)
+        fresh = [x for x in self._hosts if x not in hosts]
+        ret = dict(
+            files=changed, removed=removed,
+            items=sorted(writes.keys()) + sorted(deletes),
+            hosts=list(self._hosts) if changed or removed else fresh,
+            fresh=fresh)
+        msg = 'State Diff: %s.' % ret
+        app.logger.info(logmsg(msg))
+        return ret
+
+    def save_state(self):
+        """record the applied state of the files and hosts
+        """
+        dir_pre = os.path.join('/', self._key_meta_pre, self._folder_pre)
+        applied = self.read_keys(key_pre=dir_pre)
+        expected = dict(
+            files={x['name']: self._file_digest(x) for x in self._files},
+            hosts=dict(applied.get('hosts', {})))
+        expected['hosts'].update({x: '1' for x in self._hosts})
+        writes, deletes = self._diff_keys(
+            dir_pre=dir_pre, current=applied, expected=expected)
+        return EtcdBulkWriter(self.etcd).run(
+            action='State Record', writes=writes, deletes=deletes)
+
+    def clear_state(self):
+        """forget the applied state, the next delta update would be a full one
+        """
+        dir_pre = os.path.join('/', self._key_meta_pre, self._folder_pre)
+        if dir_pre in self.etcd:
+            self.etcd.delete(key=dir_pre, dir=True, recursive=True)
 
     def delete_expired_files(self):
         """delete expired toml/tmpl files in remote confd client
         """
-        cfg_names = [x['name'] for x in self._files]
-        for host in self._hosts:
-            aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
-            # 1. delete expired toml file
-            tomls = self.get_tomls(host=host)
-            for x in tomls:
-                config = x.split(self._file_pre)[1].split('toml')[0].strip('.')
-                if config not in cfg_names:
-                    state, state_sum, results = ansible_safe_run(
-                        aapi=aapi, module='file',
-                        args=dict(
-                            path=os.path.join(self._r_toml, x),
-                            state='absent'))
-                    msg = 'Toml File Deleted: %s' % state_sum
-                    app.logger.debug(logmsg(msg))
-                    msg = 'Toml File Deleted: %s' % results
-                    app.logger.info(logmsg(msg))
-            # 2. delete expired tmpl file
-            tmpls = self.get_tmpls(host=host)
-            for x in tmpls:
-                config = x.split('.tmpl')[0]
-                if config not in cfg_names:
-                    state, state_sum, results = ansible_safe_run(
-                        aapi=aapi, module='file',
-                        args=dict(
-                            path=os.path.join(
-                                self._r_tmpl, self._folder_pre, x),
-                            state='absent'))
-                    msg = 'Tmpl File Deleted: %s' % state_sum
-                    app.logger.debug(logmsg(msg))
-                    msg = 'Tmpl File Deleted: %s' % results
-                    app.logger.info(logmsg(msg))
-
-    def delete_files(self):
-        """
-            delete old toml/tmpl files in remote confd client
-            ps: make sure that all these files have been backup already
+        try:
+            return self._executor.run(
+                action='Expired Files Delete', hosts=self._hosts,
+                func=self._delete_expired_host)
+        finally:
+            self.forget_snapshots(hosts=self._hosts)
+
+    def _delete_expired_host(self, host):
+        """delete expired toml/tmpl files of a single host
         """
-        for host in self._hosts:
-            aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
-            # 1. delete toml
-            tomls = self.get_tomls(host=host)
-            for x in tomls:
+        cfg_names = [x['name'] for x in self._files]
+        tomls = self.get_tomls(host=host)
+        tmpls = self.get_tmpls(host=host)
+        # remote files are about to change
+        self._snapshots.pop(host, None)
+        aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
+        # 1. delete expired toml file
+        for x in tomls:
+            config = x.split(self._file_pre)[1].split('toml')[0].strip('.')
+            if config not in cfg_names:
                 state, state_sum, results = ansible_safe_run(
                     aapi=aapi, module='file',
                     args=dict(
@@ -515,127 +675,249 @@ class Etconf(object):
                 app.logger.debug(logmsg(msg))
                 msg = 'Toml File Deleted: %s' % results
                 app.logger.info(logmsg(msg))
-            # 2. delete tmpl
-            state, state_sum, results = ansible_safe_run(
-                aapi=aapi, module='file',
-                args=dict(
-                    path='%s/' % os.path.join(
-                        self._r_tmpl, self._folder_pre),
-                    state='absent'))
-            msg = 'Tmpl File Deleted: %s' % state_sum
-            app.logger.debug(logmsg(msg))
-            msg = 'Tmpl File Deleted: %s' % results
-            app.logger.info(logmsg(msg))
-            # 3. delete conf
-            for x in self._files:
+        # 2. delete expired tmpl file
+        for x in tmpls:
+            config = x.split('.tmpl')[0]
+            if config not in cfg_names:
                 state, state_sum, results = ansible_safe_run(
                     aapi=aapi, module='file',
                     args=dict(
-                        path=os.path.join(x['dir'], x['name']),
+                        path=os.path.join(
+                            self._r_tmpl, self._folder_pre, x),
                         state='absent'))
-                msg = 'Conf File Deleted: %s' % state_sum
+                msg = 'Tmpl File Deleted: %s' % state_sum
                 app.logger.debug(logmsg(msg))
-                msg = 'Conf File Deleted: %s' % results
+                msg = 'Tmpl File Deleted: %s' % results
                 app.logger.info(logmsg(msg))
 
-    def push_files(self, rollback=False):
-        """ update toml/tmpl/(conf) files to remote/local confd client """
-        for host in self._hosts:
-            aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
-            toml_folder = '%s/' % (
-                os.path.join(self._l_toml_bak, host)
-                if rollback else os.path.join(self._l_toml, host))
-            tmpl_folder = '{}/'.format(
-                os.path.join(self._l_tmpl_bak, host)
-                if rollback else self._l_tmpl)
-            if rollback:
-                conf_folder = '%s/' % os.path.join(self._l_conf_bak, host)
-                # clear folders
-                remove_folder(toml_folder)
-                remove_folder(tmpl_folder)
-                remove_folder(conf_folder)
-                get_folder(toml_folder)
-                get_folder(tmpl_folder)
-                get_folder(conf_folder)
-                # download latest tomls/tmpls from minio
-                toml_pre = '%s/' % os.path.join('toml', self._folder_pre, host)
-                objs = self.minio.list_objects(
-                    bucket_name=self._minio_bucket, prefix=toml_pre, recursive=False)
-                for x in objs:
-                    object_name = x.object_name.encode('utf-8')
-                    self.minio.fget_object(
-                        bucket_name=self._minio_bucket,
-                        object_name=object_name,
-                        file_path=os.path.join(
-                            toml_folder, os.path.basename(object_name)))
-                tmpl_pre = '%s/' % os.path.join('tmpl', self._folder_pre, host)
-                objs = self.minio.list_objects(
-                    bucket_name=self._minio_bucket, prefix=tmpl_pre, recursive=False)
-                for x in objs:
-                    object_name = x.object_name.encode('utf-8')
-                    self.minio.fget_object(
-                        bucket_name=self._minio_bucket,
-                        object_name=object_name,
-                        file_path=os.path.join(
-                            tmpl_folder, os.path.basename(object_name)))
-                conf_pre = '%s/' % os.path.join('conf', self._folder_pre, host)
-                objs = self.minio.list_objects(
-                    bucket_name=self._minio_bucket, prefix=conf_pre, recursive=False)
-                for x in objs:
-                    object_name = x.object_name.encode('utf-8')
-                    self.minio.fget_object(
-                        bucket_name=self._minio_bucket,
-                        object_name=object_name,
-                        file_path=os.path.join(
-                            conf_folder, os.path.basename(object_name)))
-                # push conf files to remote/local confd client
-                for x in os.listdir(conf_folder):
-                    config = x.split(self._broken_word_2)
-                    file_path = config[1].replace(self._broken_word_1, '/')
-                    info = config[0].split('@@')
-                    state, state_sum, results = ansible_safe_run(
-                        aapi=aapi, module='copy',
-                        args=dict(
-                            mode=info[0],
-                            src=os.path.join(conf_folder, x),
-                            dest=file_path,
-                            group=info[2],
-                            owner=info[1]))
-                    msg = 'Conf File Updated: %s' % state_sum
-                    app.logger.debug(logmsg(msg))
-                    msg = 'Conf File Updated: %s' % results
-                    app.logger.info(logmsg(msg))
-            # 1. push toml files to remote/local confd client
+    def delete_files(self, hosts=None):
+        """
+            delete old toml/tmpl files in remote confd client
+            ps: make sure that all these files have been backup already
+        """
+        hosts = hosts if hosts else self._hosts
+        try:
+            return self._executor.run(
+                action='Files Delete', hosts=hosts, func=self._delete_host)
+        finally:
+            self.forget_snapshots(hosts=hosts)
+
+    def _delete_host(self, host):
+        """delete old toml/tmpl/conf files of a single host
+        """
+        tomls = self.get_tomls(host=host)
+        # remote files are about to change
+        self._snapshots.pop(host, None)
+        aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
+        # 1. delete toml
+        for x in tomls:
+            state, state_sum, results = ansible_safe_run(
+                aapi=aapi, module='file',
+                args=dict(
+                    path=os.path.join(self._r_toml, x),
+                    state='absent'))
+            msg = 'Toml File Deleted: %s' % state_sum
+            app.logger.debug(logmsg(msg))
+            msg = 'Toml File Deleted: %s' % results
+            app.logger.info(logmsg(msg))
+        # 2. delete tmpl
+        state, state_sum, results = ansible_safe_run(
+            aapi=aapi, module='file',
+            args=dict(
+                path='%s/' % os.path.join(
+                    self._r_tmpl, self._folder_pre),
+                state='absent'))
+        msg = 'Tmpl File Deleted: %s' % state_sum
+        app.logger.debug(logmsg(msg))
+        msg = 'Tmpl File Deleted: %s' % results
+        app.logger.info(logmsg(msg))
+        # 3. delete conf
+        for x in self._files:
+            state, state_sum, results = ansible_safe_run(
+                aapi=aapi, module='file',
+                args=dict(
+                    path=os.path.join(x['dir'], x['name']),
+                    state='absent'))
+            msg = 'Conf File Deleted: %s' % state_sum
+            app.logger.debug(logmsg(msg))
+            msg = 'Conf File Deleted: %s' % results
+            app.logger.info(logmsg(msg))
+
+    def delta_pushes(self, plan, hosts):
+        """ files to push to hosts of a batch
+            ret: [(hosts, names of files or None for all), ...]
+        """
+        if not plan or plan['removed']:
+            # all files of the service are deleted before pushing
+            return [(hosts, None)]
+        fresh = [x for x in hosts if x in plan['fresh']]
+        applied = [x for x in hosts if x not in fresh]
+        return [x for x in ((fresh, None), (applied, plan['files']))
+                if x[0] and x[1] != []]
+
+    def push_files(self, rollback=False, hosts=None, files=None):
+        """ update toml/tmpl/(conf) files to remote/local confd client
+            files: names of files to push, all if None
+        """
+        hosts = hosts if hosts else self._hosts
+        # remote files are about to change
+        self.forget_snapshots(hosts=hosts)
+        if rollback:
+            # backups differ from host to host
+            return self._executor.run(
+                action='Files Push', hosts=hosts, func=self._rollback_host)
+        if not self._toml_groups:
+            self.create_toml()
+        # hosts of a group share the same artifacts, push them in one run
+        groups = {}
+        for group, v in self._toml_groups.items():
+            members = [x for x in v if x in hosts]
+            if members:
+                groups[group] = members
+        results = {}
+        try:
+            # 1. tmpl files are the same on all hosts
+            tmpls = self._copy_tmpl(
+                aapi=self._multi_host_api(hosts=hosts),
+                folder='%s/' % self._l_tmpl, files=files)
+            # 2. toml files are the same on hosts of a group
+            tomls = self._executor.run(
+                action='Toml Files Push', hosts=groups.keys(),
+                func=lambda group: self._copy_toml(
+                    aapi=self._multi_host_api(hosts=groups[group]),
+                    folder='%s/' % os.path.join(self._l_toml, group),
+                    files=files))
+        except HostExecutionError as e:
+            for group, v in e.results.items():
+                for host in groups[group]:
+                    results[host] = v
+            raise HostExecutionError(action='Files Push', results=results)
+        except Exception as e:
+            app.logger.error(logmsg(traceback.format_exc()))
+            for host in hosts:
+                results[host] = dict(
+                    state=C.HOST_STATE.FAILURE.value, error=str(e))
+            raise HostExecutionError(action='Files Push', results=results)
+        for group, v in tomls.items():
+            for host in groups[group]:
+                results[host] = dict(
+                    state=v['state'],
+                    result=dict(toml=v['result'].get(host),
+                                tmpl=tmpls.get(host)))
+        return results
+
+    def _multi_host_api(self, hosts):
+        """ ansible api running a module on several hosts with forks """
+        return Ansible2API(
+            hosts=hosts, forks=min(self._ansible_forks, len(hosts)),
+            **self._ansible_kwargs)
+
+    def _rollback_host(self, host):
+        """ update backup toml/tmpl/conf files of a single host """
+        # remote files are about to change
+        self._snapshots.pop(host, None)
+        aapi = Ansible2API(hosts=[host], **self._ansible_kwargs)
+        toml_folder = '%s/' % os.path.join(self._l_toml_bak, host)
+        tmpl_folder = '%s/' % os.path.join(self._l_tmpl_bak, host)
+        conf_folder = '%s/' % os.path.join(self._l_conf_bak, host)
+        # clear folders
+        remove_folder(toml_folder)
+        remove_folder(tmpl_folder)
+        remove_folder(conf_folder)
+        get_folder(toml_folder)
+        get_folder(tmpl_folder)
+        get_folder(conf_folder)
+        # download latest tomls/tmpls/confs from minio
+        if self._backups.load(host=host, folders=dict(
+                tomls=toml_folder, tmpls=tmpl_folder,
+                confs=conf_folder)) is None:
+            # backups made before the content-addressed layout
+            MinioTransfer(self.minio, self._minio_bucket).download(prefixes={
+                '%s/' % os.path.join('toml', self._folder_pre, host): toml_folder,
+                '%s/' % os.path.join('tmpl', self._folder_pre, host): tmpl_folder,
+                '%s/' % os.path.join('conf', self._folder_pre, host): conf_folder})
+        # push conf files to remote/local confd client
+        for x in os.listdir(conf_folder):
+            config = x.split(self._broken_word_2)
+            file_path = config[1].replace(self._broken_word_1, '/')
+            info = config[0].split('@@')
+            state, state_sum, results = ansible_safe_run(
+                aapi=aapi, module='copy',
+                args=dict(
+                    mode=info[0],
+                    src=os.path.join(conf_folder, x),
+                    dest=file_path,
+                    group=info[2],
+                    owner=info[1]))
+            msg = 'Conf File Updated: %s' % state_sum
+            app.logger.debug(logmsg(msg))
+            msg = 'Conf File Updated: %s' % results
+            app.logger.info(logmsg(msg))
+        self._copy_toml(aapi=aapi, folder=toml_folder)
+        self._copy_tmpl(aapi=aapi, folder=tmpl_folder)
+
+    def _stage(self, folder, names):
+        """ folder holding only the named files of a folder """
+        staged = '%s.delta/' % folder.rstrip('/')
+        remove_folder(staged)
+        get_folder(staged)
+        for x in names:
+            shutil.copy(os.path.join(folder, x), staged)
+        return staged
+
+    def _copy_toml(self, aapi, folder, files=None):
+        """ push toml files to remote/local confd client """
+        staged = None
+        if files is not None:
+            folder = staged = self._stage(folder=folder, names=[
+                '{0}.{1}.toml'.format(self._file_pre, x) for x in files])
+        try:
             state, state_sum, results = ansible_safe_run(
                 aapi=aapi, module='copy',
                 args=dict(
                     mode=self._confd_file_mode,
-                    src=toml_folder,
+                    src=folder,
                     dest=self._r_toml,
                     group=self._confd_owner[1],
                     owner=self._confd_owner[0]))
-            msg = 'Toml File Updated: %s' % state_sum
-            app.logger.debug(logmsg(msg))
-            msg = 'Toml File Updated: %s' % results
-            app.logger.info(logmsg(msg))
-            # 2. push tmpl files to remote/local confd client
-            r_tmpl_folder = os.path.join(self._r_tmpl, self._folder_pre)
+        finally:
+            if staged:
+                remove_folder(staged)
+        msg = 'Toml File Updated: %s' % state_sum
+        app.logger.debug(logmsg(msg))
+        msg = 'Toml File Updated: %s' % results
+        app.logger.info(logmsg(msg))
+        return results
+
+    def _copy_tmpl(self, aapi, folder, files=None):
+        """ push tmpl files to remote/local confd client """
+        staged = None
+        if files is not None:
+            folder = staged = self._stage(
+                folder=folder, names=['{0}.tmpl'.format(x) for x in files])
+        r_tmpl_folder = os.path.join(self._r_tmpl, self._folder_pre)
+        try:
             state, state_sum, results = ansible_safe_run(
                 aapi=aapi, module='copy',
                 args=dict(
                     mode=self._confd_file_mode,
-                    src=tmpl_folder,
+                    src=folder,
                     dest=r_tmpl_folder,
                     group=self._confd_owner[1],
                     owner=self._confd_owner[0]))
-            msg = 'Tmpl File Updated: %s' % state_sum
-            app.logger.debug(logmsg(msg))
-            msg = 'Tmpl File Updated: %s' % results
-            app.logger.info(logmsg(msg))
+        finally:
+            if staged:
+                remove_folder(staged)
+        msg = 'Tmpl File Updated: %s' % state_sum
+        app.logger.debug(logmsg(msg))
+        msg = 'Tmpl File Updated: %s' % results
+        app.logger.info(logmsg(msg))
+        return results
 
-    def confd_cmd(self, action):
+    def confd_cmd(self, action, hosts=None):
         """ confd client startup cmd """
-        aapi = Ansible2API(hosts=self._hosts, **self._ansible_kwargs)
+        aapi = Ansible2API(
+            hosts=hosts if hosts else self._hosts, **self._ansible_kwargs)
         state, state_sum, results = ansible_safe_run(
             aapi=aapi, module='shell',
             args=self._confd_startup_cmd[action])
@@ -643,79 +925,701 @@ class Etconf(object):
         app.logger.debug(logmsg(msg))
         msg = 'Confd %s: %s' % (action.upper(), results)
         app.logger.info(logmsg(msg))
+        return results
+
+    def stat_files(self, paths, hosts=None):
+        """get mode/owner/modify time/md5 of files in one remote invocation
+            ps: ret[host][path] is None if the file does not exist
+        """
+        hosts = hosts if hosts else self._hosts
+        aapi = Ansible2API(hosts=hosts, **self._ansible_kwargs)
+        state, state_sum, results = ansible_safe_run(
+            aapi=aapi, module='shell',
+            args='i=0; for f in ' + ' '.join([pipes.quote(x) for x in paths]) +
+                 '; do if [ -f "$f" ]; then printf \'%s\\t\' "$i"; '
+                 'stat --printf \'%a\\t%U\\t%G\\t%y\\t\' "$f"; '
+                 'md5sum < "$f" | cut -c1-32; '
+                 'else printf \'%s\\t-\\n\' "$i"; fi; i=$((i+1)); done')
+        msg = 'Files Stat: %s' % state_sum
+        app.logger.debug(logmsg(msg))
+        msg = 'Files Stat: %s' % results
+        app.logger.info(logmsg(msg))
+        ret = {}
+        for host in hosts:
+            ret[host] = {x: None for x in paths}
+            for x in results[host]['stdout_lines']:
+                info = x.split('\t')
+                if len(info) != 6:
+                    continue
+                ret[host][paths[int(info[0])]] = dict(
+                    mode=info[1].zfill(4), owner=info[2:4], mtime=info[4],
+                    md5=info[5])
+        return ret
 
-    def check_files(self):
+    def check_files(self, hosts=None):
         ret = {}
-        template_regex = r'{{getv\s+"/%s"}}'
-        mode_dict = {'-': 0, 'x': 1, 'w': 2, 'r': 4}
-        aapi = Ansible2API(hosts=self._hosts, **self._ansible_kwargs)
-        for x in self._files:
-            abs_path = os.path.join(x['dir'], x['name'])
-            ret[x['name']] = {host: {} for host in self._hosts}
-            # 1. check md5
+        hosts = hosts if hosts else self._hosts
+        paths = [os.path.join(x['dir'], x['name']) for x in self._files]
+        # 1. check mode/owner/modify time/md5 of all files at once
+        stats = self.stat_files(paths=paths, hosts=hosts)
+        for x, abs_path in zip(self._files, paths):
+            ret[x['name']] = {host: {} for host in hosts}
             # use tmpl to generate expected configuration file content
-            content = x['template']
-            for k, v in x['items'].items():
-                content = re.sub(
-                    pattern=template_regex % k, repl=v, string=content)
+            content = TemplateRenderer.render(
+                template=x['template'], items=x['items'],
+                template_id=x.get('template_id'))
             # cuz ansible shell 'stdout' will ignore terminal '\r\n'
             expected_raw = content.rstrip('\r\n')
             expected_md5 = md5hex(expected_raw)
-            # use ansible to fetch file content
-            state, state_sum, results = ansible_safe_run(
-                aapi=aapi, module='shell', args='cat {0}'.format(abs_path))
-            # compare the online to the expected using md5
-            for host in self._hosts:
-                if results[host]['stderr']:
+            # digests of the file exactly as confd would render it
+            expected_md5s = set([
+                md5hex(content), expected_md5, md5hex(expected_raw + '\n'),
+                md5hex(expected_raw + '\r\n')])
+            mismatched = []
+            for host in hosts:
+                stat = stats[host][abs_path]
+                if not stat:
                     ret[x['name']][host] = dict(
                         error='{0}: No such file or directory'.format(abs_path))
-                else:
-                    actual_raw = results[host]['stdout'].rstrip('\r\n')
-                    actual_md5 = md5hex(actual_raw)
-                    if actual_md5 != expected_md5:
-                        ret[x['name']][host]['content'] = '{0} != {1}'.format(
-                            actual_md5, expected_md5)
-                        ret[x['name']][host]['content_expected'] = expected_raw
-                        ret[x['name']][host]['content_actual'] = actual_raw
-                    else:
-                        ret[x['name']][host]['content'] = "OK"
-            # 2. check mode
-            state, state_sum, results = ansible_safe_run(
-                aapi=aapi, module='shell',
-                args="ls -al %s|awk '{print $1}'" % abs_path)
-            for host in self._hosts:
-                if 'error' in ret[x['name']][host]:
                     continue
-                mode = '0{0}{1}{2}'.format(
-                    sum([mode_dict[y] for y in results[host]['stdout'][1:4]]),
-                    sum([mode_dict[y] for y in results[host]['stdout'][4:7]]),
-                    sum([mode_dict[y] for y in results[host]['stdout'][7:]]))
+                if stat['md5'] in expected_md5s:
+                    ret[x['name']][host]['content'] = "OK"
+                else:
+                    mismatched.append(host)
                 ret[x['name']][host]['mode'] = (
-                    '{0} != {1}'.format(mode, x['mode'])
-                    if mode != x['mode'] else 'OK')
-            # 3. check owner
-            state, state_sum, results = ansible_safe_run(
-                aapi=aapi, module='shell',
-                args="ls -al %s|awk '{print $3,$4}'" % abs_path)
-            for host in self._hosts:
-                if 'error' in ret[x['name']][host]:
-                    continue
-                owner = results[host]['stdout'].split()
+                    '{0} != {1}'.format(stat['mode'], x['mode'])
+                    if stat['mode'] != x['mode'] else 'OK')
+                owner = stat['owner']
                 ret[x['name']][host]['owner'] = (
                     '{0} != {1}'.format(
                         tuple(owner), (x['owner']['name'], x['owner']['group']))
                     if owner[0] != x['owner']['name'] and
                     owner[1] != x['owner']['group'] else 'OK')
-            # 4. check modify time
+                ret[x['name']][host]['last_modify_time'] = stat['mtime']
+            if not mismatched:
+                continue
+            # 2. fetch full content only from hosts whose digest differs
+            aapi = Ansible2API(hosts=mismatched, **self._ansible_kwargs)
             state, state_sum, results = ansible_safe_run(
-                aapi=aapi, module='shell',
-                args="ls --full-time %s|awk '{print $6,$7,$8}'" % abs_path)
-            for host in self._hosts:
-                if 'error' in ret[x['name']][host]:
-                    continue
-                ret[x['name']][host]['last_modify_time'] = results[host]['stdout']
+                aapi=aapi, module='shell', args='cat {0}'.format(abs_path))
+            for host in mismatched:
+                actual_raw = results[host]['stdout'].rstrip('\r\n')
+                actual_md5 = md5hex(actual_raw)
+                if actual_md5 != expected_md5:
+                    ret[x['name']][host]['content'] = '{0} != {1}'.format(
+                        actual_md5, expected_md5)
+                    ret[x['name']][host]['content_expected'] = expected_raw
+                    ret[x['name']][host]['content_actual'] = actual_raw
+                else:
+                    ret[x['name']][host]['content'] = "OK"
         return ret
 
+    def rollout_hosts(self, plan=None):
+        """ hosts to roll out batch by batch
+            items are shared by all hosts and rendered by any running confd,
+            so all hosts are rolled out if items changed
+        """
+        if not plan or plan['items']:
+            return list(self._hosts)
+        return plan['hosts']
+
+    def throttle(self, parallelism=None):
+        """ limit hosts handled at the same time by the following steps
+            keep the configured parallelism and ansible forks if not given
+        """
+        if not parallelism:
+            return
+        self._executor = HostExecutor(parallelism=parallelism)
+        self._ansible_forks = parallelism
+
+    def health_gate(self, gate, hosts):
+        """ verify hosts of a rollout batch before rolling the next one
+            gate: `status` of confd client or `check` of configuration files
+        """
+        if gate == C.ROLLOUT_HEALTH_GATE.STATUS.value:
+            results = self.confd_cmd(action='status', hosts=hosts)
+            failed = [x for x in hosts
+                      if results[x].get('failed') or results[x].get('rc')]
+        elif gate == C.ROLLOUT_HEALTH_GATE.CHECK.value:
+            # confd renders the new files asynchronously
+            time.sleep(app.config['SAKURA_ROLLOUT_GATE_WAIT'])
+            results = self.check_files(hosts=hosts)
+            failed = sorted(set([
+                host for v in results.values() for host, x in v.items()
+                if 'error' in x or [k for k in ('content', 'mode', 'owner')
+                                    if x.get(k) != 'OK']]))
+        else:
+            raise Exception('Unknown Health Gate: {0}'.format(gate))
+        if failed:
+            raise Exception(
+                'Health Gate ({0}) Failed: {1}'.format(gate, failed))
+        return hosts
+
+
+class RolloutScheduler(object):
+    """ RolloutScheduler
+
+    Split hosts of a configuration update into batches rolled one by one.
+    """
+    def __init__(self, hosts, batch_size=None, max_parallel=None):
+        super(RolloutScheduler, self).__init__()
+        self._hosts = list(hosts)
+        # number of hosts of a batch, ex. 2 or '25%', all hosts if empty
+        self._batch_size = self.parse_batch_size(
+            batch_size=batch_size, total=len(self._hosts))
+        # max number of hosts of a batch handled at the same time,
+        # configured parallelism if empty
+        self.max_parallel = int(max_parallel) if max_parallel else None
+
+    @staticmethod
+    def parse_batch_size(batch_size, total):
+        if not batch_size:
+            return max(total, 1)
+        batch_size = str(batch_size).strip()
+        if batch_size.endswith('%'):
+            size = int(math.ceil(total * float(batch_size[:-1]) / 100))
+        else:
+            size = int(batch_size)
+        return max(size, 1)
+
+    @property
+    def batches(self):
+        return [self._hosts[i:i + self._batch_size]
+                for i in range(0, len(self._hosts), self._batch_size)]
+
+
+class TemplateRenderer(object):
+    """ TemplateRenderer
+
+    Render `{{getv "/key"}}` of confd templates with items in one pass.
+    Results are memoized by the template id (or the digest of the template
+    if not uploaded) and the digest of items.
+    """
+    _regex = re.compile(r'{{getv\s+"/([^"]*)"}}')
+    _cache = LRUCache(
+        maxsize=app.config['SAKURA_RENDER_CACHE_SIZE'],
+        maxbytes=app.config['SAKURA_RENDER_CACHE_BYTES'])
+
+    @classmethod
+    def render(cls, template, items, template_id=None):
+        key = (template_id if template_id else md5hex(template),
+               md5hex(json.dumps(items, sort_keys=True)))
+        content = cls._cache.get(key)
+        if content is None:
+            # keys without items are left as they are
+            content = cls._regex.sub(
+                lambda m: items.get(m.group(1), m.group(0)), template)
+            cls._cache.set(key, content)
+        return content
+
+
+class ClientRegistry(object):
+    """ ClientRegistry
+
+    Process-wide etcd/minio clients, keyed by endpoint and tls settings.
+    ps: should be reset in a forked process before use
+    """
+    _lock = threading.Lock()
+    _clients = {}
+
+    @classmethod
+    def etcd_kwargs(cls):
+        kwargs = dict(
+            host=app.config['ETCD_HOST'], port=app.config['ETCD_PORT'],
+            per_host_pool_size=10)
+        # etcd client cert/key file
+        if (
+                'ETCD_CERT' in app.config and app.config['ETCD_CERT'] and
+                'ETCD_CA_CERT' in app.config and app.config['ETCD_CA_CERT']):
+            kwargs['protocol'] = 'https'
+            kwargs['cert'] = (
+                os.path.join(app.config['CA_FOLDER'], app.config['ETCD_CERT'][0]),
+                os.path.join(app.config['CA_FOLDER'], app.config['ETCD_CERT'][1]))
+            kwargs['ca_cert'] = os.path.join(
+                app.config['CA_FOLDER'], app.config['ETCD_CA_CERT'])
+        return kwargs
+
+    @classmethod
+    def minio_kwargs(cls):
+        return dict(
+            endpoint=app.config['MINIO_ENDPOINT'],
+            access_key=app.config['MINIO_ACCESS_KEY'],
+            secret_key=app.config['MINIO_SECRET_KEY'],
+            secure=False)
+
+    @classmethod
+    def etcd(cls):
+        """get the etcd client, build connection to etcd server at first
+        """
+        kwargs = cls.etcd_kwargs()
+        key = ('etcd', ) + tuple(sorted(kwargs.items()))
+        with cls._lock:
+            if key not in cls._clients:
+                client = EtcdAPI(**kwargs)
+                client.connect()
+                cls._clients[key] = client
+            return cls._clients[key]
+
+    @classmethod
+    def minio(cls):
+        """get the minio client, build connection to minio server and make
+            the bucket at first
+        """
+        kwargs = cls.minio_kwargs()
+        key = ('minio', app.config['MINIO_BUCKET']) + tuple(
+            sorted(kwargs.items()))
+        with cls._lock:
+            if key not in cls._clients:
+                client = MinioAPI(**kwargs)
+                client.connect()
+                try:
+                    client.make_bucket(app.config['MINIO_BUCKET'])
+                except (BucketAlreadyOwnedByYou, BucketAlreadyExists):
+                    pass
+                cls._clients[key] = client
+            return cls._clients[key]
+
+    @classmethod
+    def reset(cls):
+        """drop inherited clients of a forked process, built again on demand
+        """
+        # the lock might be held by another thread of the parent at fork
+        cls._lock = threading.Lock()
+        cls._clients = {}
+
+    @classmethod
+    def setup(cls):
+        """drop inherited clients and build new ones, call on process start
+        """
+        with cls._lock:
+            cls._clients.clear()
+        cls.etcd()
+        cls.minio()
+        msg = 'Clients Initialized: %s' % cls._clients.keys()
+        app.logger.info(logmsg(msg))
+
+
+class MinioTransfer(object):
+    """ MinioTransfer
+
+    Upload/download/delete minio objects with parallel workers.
+    """
+    def __init__(self, minio, bucket_name, parallelism=None):
+        super(MinioTransfer, self).__init__()
+        self._minio = minio
+        self._bucket = bucket_name
+        self._parallelism = (
+            parallelism if parallelism else
+            app.config['SAKURA_MINIO_PARALLELISM'])
+
+    def _map(self, func, jobs):
+        if not jobs:
+            return []
+        pool = ThreadPool(processes=max(min(self._parallelism, len(jobs)), 1))
+        try:
+            return pool.map(func, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    def list(self, prefix, recursive=False):
+        return [x.object_name.encode('utf-8') for x in self._minio.list_objects(
+            bucket_name=self._bucket, prefix=prefix, recursive=recursive)]
+
+    def ages(self, prefix):
+        """ get seconds since the last modification of objects under prefix
+        """
+        now = time.time()
+        return {x.object_name.encode('utf-8'):
+                now - calendar.timegm(x.last_modified.utctimetuple())
+                for x in self._minio.list_objects(
+                    bucket_name=self._bucket, prefix=prefix, recursive=True)}
+
+    def exists(self, object_names):
+        """ get names of objects that already exist
+        """
+        return [x for x, y in zip(object_names, self._map(
+            lambda x: bool(self.list(prefix=x)), object_names)) if y]
+
+    def upload(self, objects):
+        """ upload files ({object_name: file_path}) and verify them via etag
+        """
+        def _upload(job):
+            object_name, file_path = job
+            etag = self._minio.fput_object(
+                bucket_name=self._bucket, object_name=object_name,
+                file_path=file_path)
+            etag = etag.strip('"') if etag else ''
+            # etag of a multipart upload is not the md5 of content
+            if not etag or ('-' not in etag and etag != md5file(file_path)):
+                raise Exception('Backup Failed: %s.' % object_name)
+            return object_name, etag
+
+        ret = dict(self._map(_upload, objects.items()))
+        msg = 'Minio Objects Uploaded: %s' % ret
+        app.logger.info(logmsg(msg))
+        return ret
+
+    def download(self, prefixes=None, objects=None):
+        """ download objects ({object_name: file_path}) and objects under
+            prefixes ({prefix: folder}) to folders
+        """
+        jobs = (objects or {}).items()
+        jobs.extend([(x, os.path.join(folder, os.path.basename(x)))
+                     for pre, folder in (prefixes or {}).items()
+                     for x in self.list(pre)])
+
+        def _download(job):
+            self._minio.fget_object(
+                bucket_name=self._bucket, object_name=job[0], file_path=job[1])
+            return job[0]
+
+        ret = self._map(_download, jobs)
+        msg = 'Minio Objects Downloaded: %s' % ret
+        app.logger.info(logmsg(msg))
+        return ret
+
+    def remove(self, prefixes=None, objects=None):
+        """ delete objects (and those under prefixes) in multi-object requests
+        """
+        objects = list(objects) if objects else []
+        for x in prefixes or []:
+            objects.extend(self.list(x))
+        if not objects:
+            return objects
+        if hasattr(self._minio, 'remove_objects'):
+            # errors are yielded lazily
+            errors = [x for x in self._minio.remove_objects(
+                bucket_name=self._bucket, objects_iter=objects)]
+            if errors:
+                raise Exception('Minio Objects Delete Failed: %s.' % errors)
+        else:
+            self._map(lambda x: self._minio.remove_object(
+                bucket_name=self._bucket, object_name=x), objects)
+        msg = 'Minio Objects Deleted: %s' % objects
+        app.logger.info(logmsg(msg))
+        return objects
+
+
+class TemplateStore(object):
+    """ TemplateStore
+
+    Templates uploaded once and referred by files with `template_id`, the md5
+    of the content, stored under 'template/' of the minio bucket.
+    """
+    _cache = LRUCache(
+        maxsize=app.config['SAKURA_TEMPLATE_CACHE_SIZE'],
+        maxbytes=app.config['SAKURA_TEMPLATE_CACHE_BYTES'])
+
+    def __init__(self, minio=None, bucket_name=None):
+        super(TemplateStore, self).__init__()
+        self._minio = minio if minio else ClientRegistry.minio()
+        self._bucket = (
+            bucket_name if bucket_name else app.config['MINIO_BUCKET'])
+        self._transfer = MinioTransfer(self._minio, self._bucket)
+        self._folder = get_folder(os.path.join(app.config['TMP_FOLDER'], 'blob'))
+
+    def _blob(self, template_id):
+        return os.path.join('template', template_id)
+
+    def save(self, file_path):
+        """ upload a template file, ret: template id """
+        template_id = md5file(file_path)
+        if not self._transfer.exists([self._blob(template_id)]):
+            self._transfer.upload({self._blob(template_id): file_path})
+        return template_id
+
+    def missing(self, template_ids):
+        """ get ids of templates never uploaded """
+        template_ids = [
+            x for x in set(template_ids) if self._cache.get(x) is None]
+        exists = set(self._transfer.exists(
+            [self._blob(x) for x in template_ids]))
+        return [x for x in template_ids if self._blob(x) not in exists]
+
+    def load(self, template_id):
+        """ get content of an uploaded template """
+        content = self._cache.get(template_id)
+        if content is None:
+            fd, file_path = tempfile.mkstemp(dir=self._folder)
+            os.close(fd)
+            try:
+                self._transfer.download(
+                    objects={self._blob(template_id): file_path})
+                with open(file_path) as f:
+                    content = f.read().decode('utf-8')
+            finally:
+                os.remove(file_path)
+            if md5hex(content) != template_id:
+                raise Exception('Template Corrupted: %s.' % template_id)
+            self._cache.set(template_id, content)
+        return content
+
+    def resolve(self, files):
+        """ fill `template` of files referring to a `template_id` """
+        for x in files:
+            if not x.get('template') and x.get('template_id'):
+                x['template'] = self.load(x['template_id'])
+        return files
+
+    def collect(self, keep, grace=None):
+        """ delete templates not in `keep` and older than `grace` seconds
+            ret: names of objects deleted
+        """
+        grace = grace if grace is not None else app.config[
+            'SAKURA_BLOB_GC_GRACE']
+        keep = set(self._blob(x) for x in keep)
+        expired = [x for x, age in self._transfer.ages(
+            prefix='template/').items() if x not in keep and age > grace]
+        return self._transfer.remove(objects=expired)
+
+
+class BackupStore(object):
+    """ BackupStore
+
+    Content-addressed backups on minio.
+    Files are stored once per digest under 'blob/', each backup of a host is
+    a small manifest under 'manifest/<env>/<service>/<version>/<host>/'.
+    Blobs no more referred by any manifest are deleted by `collect`.
+    """
+    def __init__(self, minio, bucket_name, folder_pre, generations=None):
+        super(BackupStore, self).__init__()
+        self._transfer = MinioTransfer(minio=minio, bucket_name=bucket_name)
+        self._folder_pre = folder_pre
+        # number of backups kept per host
+        self._generations = (
+            generations if generations else
+            app.config['SAKURA_BACKUP_GENERATIONS'])
+        # local manifest folder
+        self._l_manifest = os.path.join(
+            app.config['DATA_FOLDER'], 'backup', 'manifest', folder_pre)
+        # digests known to be stored already
+        self._blobs = set()
+
+    def _blob(self, digest):
+        return os.path.join('blob', digest)
+
+    def _manifest_pre(self, host):
+        return '%s/' % os.path.join('manifest', self._folder_pre, host)
+
+    def save(self, host, files):
+        """ backup files ({kind: {name: file_path}}) of a host as a generation
+            ps: content already stored would not be uploaded again
+        """
+        manifest, objects = {}, {}
+        for kind, v in files.items():
+            manifest[kind] = {}
+            for name, file_path in v.items():
+                digest = md5file(file_path)
+                manifest[kind][name] = digest
+                if digest not in self._blobs:
+                    objects[self._blob(digest)] = file_path
+        # skip content stored by former backups
+        for x in self._transfer.exists(object_names=objects.keys()):
+            self._blobs.add(os.path.basename(x))
+            objects.pop(x)
+        self._transfer.upload(objects=objects)
+        self._blobs.update([os.path.basename(x) for x in objects])
+        # manifest of this generation
+        generation = '%s.json' % datetime.now().strftime('%Y%m%d%H%M%S%f')
+        file_path = os.path.join(get_folder(self._l_manifest), host)
+        with open(file_path, 'w') as f:
+            json.dump(manifest, f)
+        self._transfer.upload(objects={
+            os.path.join(self._manifest_pre(host), generation): file_path})
+        # drop old generations
+        generations = sorted(self._transfer.list(prefix=self._manifest_pre(host)))
+        self._transfer.remove(objects=generations[:-self._generations])
+        msg = 'Files Backup: %s' % {host: dict(
+            generation=generation, uploaded=len(objects), manifest=manifest)}
+        app.logger.info(logmsg(msg))
+        return manifest
+
+    def load(self, host, folders):
+        """ restore files of the latest generation into folders ({kind: folder})
+            ret: the manifest or None if no backup
+        """
+        generations = sorted(self._transfer.list(prefix=self._manifest_pre(host)))
+        if not generations:
+            return None
+        file_path = os.path.join(get_folder(self._l_manifest), host)
+        self._transfer.download(objects={generations[-1]: file_path})
+        with open(file_path) as f:
+            manifest = json.load(f)
+        self._transfer.download(objects={
+            self._blob(digest): os.path.join(folders[kind], name)
+            for kind, v in manifest.items() for name, digest in v.items()})
+        msg = 'Files Restore: %s' % {host: dict(
+            generation=os.path.basename(generations[-1]), manifest=manifest)}
+        app.logger.info(logmsg(msg))
+        return manifest
+
+    def collect(self, grace=None):
+        """ delete blobs not referred by the manifests of any service
+            ps: blobs newer than `grace` seconds are kept for backups still
+                uploading their manifests
+            ret: names of blobs deleted
+        """
+        grace = grace if grace is not None else app.config[
+            'SAKURA_BLOB_GC_GRACE']
+        folder = os.path.join(app.config['TMP_FOLDER'], 'manifest')
+        remove_folder(folder)
+        get_folder(folder)
+        manifests = {
+            x: os.path.join(folder, md5hex(x))
+            for x in self._transfer.list(prefix='manifest/', recursive=True)}
+        self._transfer.download(objects=manifests)
+        referred = set()
+        for file_path in manifests.values():
+            with open(file_path) as f:
+                referred.update(self._blob(digest) for v in json.load(
+                    f).values() for digest in v.values())
+        remove_folder(folder)
+        orphans = [x for x, age in self._transfer.ages(prefix='blob/').items()
+                   if x not in referred and age > grace]
+        return self._transfer.remove(objects=orphans)
+
+
+class EtcdBulkWriter(object):
+    """ EtcdBulkWriter
+
+    Write/delete a batch of etcd keys concurrently over the pooled connection.
+    """
+    def __init__(self, etcd, parallelism=None):
+        super(EtcdBulkWriter, self).__init__()
+        self._etcd = etcd
+        self._parallelism = (
+            parallelism if parallelism else
+            app.config['SAKURA_ETCD_PARALLELISM'])
+
+    def run(self, action, writes=None, deletes=None):
+        """ write `writes` ({key: value}) and delete `deletes` ([key])
+            return per-key results, raise if any key failed
+        """
+        jobs = [(k, v) for k, v in (writes or {}).items()]
+        jobs.extend([(k, None) for k in (deletes or [])])
+        results = {}
+        if not jobs:
+            return results
+
+        def _run(job):
+            key, value = job
+            try:
+                if value is None:
+                    self._etcd.delete(key=key)
+                else:
+                    self._etcd.write(key=key, value=value)
+                return key, 'OK'
+            except Exception as e:
+                return key, str(e)
+
+        pool = ThreadPool(processes=max(min(self._parallelism, len(jobs)), 1))
+        try:
+            for key, ret in pool.imap_unordered(_run, jobs):
+                results[key] = ret
+        finally:
+            pool.close()
+            pool.join()
+        errors = {k: v for k, v in results.items() if v != 'OK'}
+        msg = '%s: %s written, %s deleted, %s failed %s.' % (
+            action, len(writes or {}), len(deletes or []), len(errors), errors)
+        app.logger.info(logmsg(msg))
+        if errors:
+            raise Exception('{0} Failed: {1}'.format(action, errors))
+        return results
+
+
+class HostExecutionError(Exception):
+    """ HostExecutionError
+
+    Raised when a per-host pipeline fails on one or more hosts.
+    """
+    def __init__(self, action, results):
+        self.action = action
+        # per-host results, ex. {'127.0.0.1': {'state': 'FAILURE', 'error': ''}}
+        self.results = results
+        errors = {k: v['error'] for k, v in results.items()
+                  if v['state'] == C.HOST_STATE.FAILURE.value}
+        super(HostExecutionError, self).__init__(
+            '{0} Failed: {1}'.format(action, errors))
+
+
+# job of the running HostExecutor, inherited by its forked host processes
+_host_job = {}
+
+
+def _host_process_init():
+    """ sockets of inherited clients are shared with the parent and the
+        other host processes, build new ones on demand
+    """
+    ClientRegistry.reset()
+
+
+def _host_run(host):
+    """ run the pipeline of a host in a host process """
+    if _host_job['aborted'].is_set():
+        return host, dict(state=C.HOST_STATE.SKIPPED.value)
+    try:
+        return host, dict(
+            state=C.HOST_STATE.SUCCESS.value,
+            result=_host_job['func'](host, **_host_job['kwargs']))
+    except Exception as e:
+        app.logger.error(logmsg(traceback.format_exc()))
+        if _host_job['fail_fast']:
+            _host_job['aborted'].set()
+        return host, dict(state=C.HOST_STATE.FAILURE.value, error=str(e))
+
+
+class HostExecutor(object):
+    """ HostExecutor
+
+    Run a per-host pipeline on several hosts with bounded concurrency.
+    Ansible keeps process-wide state and is not thread-safe, so hosts are
+    run in forked processes: the pipeline is inherited instead of pickled,
+    its results are sent back and its changes to objects are lost.
+    """
+    def __init__(self, parallelism=None, fail_fast=None):
+        super(HostExecutor, self).__init__()
+        # max number of hosts handled at the same time
+        self._parallelism = (
+            parallelism if parallelism else
+            app.config['SAKURA_HOST_PARALLELISM'])
+        # stop dispatching the remaining hosts after the first failure
+        self._fail_fast = (
+            fail_fast if fail_fast is not None else
+            app.config['SAKURA_HOST_FAIL_FAST'])
+
+    def run(self, action, hosts, func, **kwargs):
+        """ run `func(host, **kwargs)` on each host
+            return per-host results, raise HostExecutionError if any failed
+        """
+        results = {}
+        if not hosts:
+            return results
+        _host_job.update(
+            func=func, kwargs=kwargs, fail_fast=self._fail_fast,
+            aborted=multiprocessing.Event())
+        try:
+            pool = multiprocessing.Pool(
+                processes=max(min(self._parallelism, len(hosts)), 1),
+                initializer=_host_process_init)
+            try:
+                for host, ret in pool.imap_unordered(_host_run, hosts):
+                    results[host] = ret
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _host_job.clear()
+        summary = {}
+        for v in results.values():
+            summary[v['state']] = summary.get(v['state'], 0) + 1
+        msg = '%s: %s' % (action, summary)
+        app.logger.info(logmsg(msg))
+        if summary.get(C.HOST_STATE.FAILURE.value):
+            raise HostExecutionError(action=action, results=results)
+        return results
+
 
 def ansible_safe_run(aapi, module, args):
     state, state_sum, results = aapi.run(module=module, args=args)
@@ -6,8 +6,12 @@
 #
 
 import os
+import time
+import codecs
 import hashlib
 import shutil
+import threading
+from collections import OrderedDict
 from enum import Enum
 from flask import request
 
@@ -57,3 +61,83 @@ def md5hex(text):
     m = hashlib.md5()
     m.update(text)
     return m.hexdigest()
+
+
+def md5file(file_path, chunk_size=65536):
+    """ md5 hex code of a file's content.
+    """
+    m = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def is_utf8file(file_path, chunk_size=65536):
+    """ whether a file's content is utf-8 encoded.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+class LRUCache(object):
+    """ LRUCache
+
+    A thread-safe LRU cache with optional time-to-live (seconds), bounded by
+    number of entries and optionally by bytes, `sizeof(key, value)` of each.
+    """
+    def __init__(self, maxsize=1024, ttl=None, maxbytes=None, sizeof=None):
+        super(LRUCache, self).__init__()
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._maxbytes = maxbytes
+        self._sizeof = sizeof if sizeof else lambda key, value: len(value)
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value, expire = self._data.pop(key)
+            if expire is not None and expire < time.time():
+                self._bytes -= self._size(key, value)
+                return default
+            # mark as recently used
+            self._data[key] = (value, expire)
+            return value
+
+    def _size(self, key, value):
+        return self._sizeof(key, value) if self._maxbytes else 0
+
+    def set(self, key, value):
+        size = self._size(key, value)
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._size(key, self._data.pop(key)[0])
+            if self._maxbytes and size > self._maxbytes:
+                # never kept
+                return
+            self._data[key] = (
+                value, time.time() + self._ttl if self._ttl else None)
+            self._bytes += size
+            while len(self._data) > self._maxsize or (
+                    self._maxbytes and self._bytes > self._maxbytes):
+                k, v = self._data.popitem(last=False)
+                self._bytes -= self._size(k, v[0])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
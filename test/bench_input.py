@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Leann Mak, leannmak@139.com, (c) 2018.
+# This is the micro-benchmark of input module.
+#   $ python test/bench_input.py [number of files] [template size in KB]
+#
+
+import sys
+sys.path.append('.')
+
+import timeit
+from copy import deepcopy
+
+from sakura.input import defined_dictionary, union_dictionary
+
+
+def schema():
+    return defined_dictionary(
+        keys=dict(
+            name=str, dir=str, mode=str,
+            owner=defined_dictionary(keys=dict(name=str, group=str)),
+            template=unicode,
+            items=union_dictionary(key_type=unicode, value_type=unicode)))
+
+
+def payload(files, size):
+    return [dict(
+        name='f%s.cfg' % x, dir='/cfg', mode='0755',
+        owner=dict(name='u', group='g'),
+        template=u'x' * (size * 1024),
+        items={u'k%s' % y: u'v%s' % y for y in range(100)})
+        for x in range(files)]
+
+
+def eager(validator, value):
+    """ error message formatted on every call, as validators used to do """
+    deepcopy(validator.keys)
+    return 'Invalid {arg}: {value}. {arg} must be a dictionary like {type}'.format(
+        arg=validator.argument, value=value, type=str(validator))
+
+
+if __name__ == '__main__':
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    validator, value = schema(), payload(files, size)
+    number = 10
+    compiled = timeit.timeit(
+        lambda: [validator(x) for x in value], number=number) / number
+    legacy = timeit.timeit(
+        lambda: [(eager(validator, x), validator(x)) for x in value],
+        number=number) / number
+    print '%s files with %sKB templates per request:' % (files, size)
+    print '  compiled validator : %.3f ms' % (compiled * 1000)
+    print '  eager error format : %.3f ms' % (legacy * 1000)
+    print '  speedup            : %.1fx' % (legacy / compiled)
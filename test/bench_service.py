@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Leann Mak, leannmak@139.com, (c) 2018.
+# This is the micro-benchmark of service module, requests per second of
+# building a resource and parsing its arguments on each endpoint.
+#   $ python test/bench_service.py [number of requests]
+#
+
+import sys
+sys.path.append('.')
+
+import json
+import time
+
+from sakura import app
+from sakura.service import (
+    TaskListAPI, ConfigurationUpdateAPI, ConfigurationCheckAPI,
+    ConfigurationAcknowledgeAPI, ConfigurationRollbackAPI)
+
+
+files = [dict(
+    name='test.cfg', dir='/apps/conf/test', mode='0755',
+    owner=dict(name='leannmak', group='leannmak'),
+    template='{{getv "/who"}} {{getv "/what"}}.\r\n',
+    items=dict(who='jay', what='is playing basketball'))]
+
+endpoints = [
+    ('task', TaskListAPI, 'GET', '/?page=1&pp=20&state=SUCCESS', None,
+     lambda x: x.parser.parse_args()),
+    ('cfg_upd', ConfigurationUpdateAPI, 'POST', '/', dict(
+        service_name='test', env_name='qa', service_version='1.0',
+        files=files, hosts=['127.0.0.1']), lambda x: x._parse_args()),
+    ('cfg_chk', ConfigurationCheckAPI, 'POST', '/', dict(
+        files=files, hosts=['127.0.0.1']), lambda x: x._parse_args()),
+    ('cfg_ack', ConfigurationAcknowledgeAPI, 'POST', '/', dict(
+        main_task_id='7640edbc-d6b2-4fc7-ab37-6f8a3c16bb40'),
+     lambda x: x._parse_args()),
+    ('cfg_rbk', ConfigurationRollbackAPI, 'POST', '/', dict(
+        main_task_id='7640edbc-d6b2-4fc7-ab37-6f8a3c16bb40'),
+     lambda x: x._parse_args())]
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for name, resource, method, path, body, parse in endpoints:
+        kwargs = dict(method=method)
+        if body:
+            kwargs.update(
+                data=json.dumps(body), content_type='application/json')
+        begin = time.time()
+        for x in range(number):
+            with app.test_request_context(path, **kwargs):
+                parse(resource())
+        print '%-8s: %.0f requests/s' % (name, number / (time.time() - begin))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Leann Mak, leannmak@139.com, (c) 2018.
+# This is the autotest cases for input module.
+#
+
+import sys
+sys.path.append('.')
+
+from nose.tools import eq_, assert_raises
+
+from sakura.input import (
+    defined_dictionary, union_dictionary, ip, batch_size)
+
+
+class TestInput():
+    """ unit tests for inputs of sakura.
+    """
+    def test_defined_dictionary(self):
+        """ [input     ] defined dictionary test """
+        owner = defined_dictionary(keys=dict(name=str, group=str))
+        validator = defined_dictionary(
+            keys=dict(name=str, owner=owner,
+                      items=union_dictionary(
+                          key_type=unicode, value_type=unicode)))
+        value = dict(
+            name='a.cfg', owner=dict(name='u', group='g'),
+            items={u'k': u'v'})
+        # validated in place
+        ret = validator(value)
+        eq_(ret, value)
+        assert ret is value
+        assert ret['owner'] is value['owner']
+        # from json
+        eq_(owner('{"name": "u", "group": "g"}'), dict(name='u', group='g'))
+        # description built once
+        eq_(str(owner), str(owner))
+        assert "'defined_dictionary'" in str(validator)
+        assert str(owner) in str(validator)
+        # missing or unknown keys
+        for x in (dict(name='u'), dict(name='u', group='g', x=1), {}):
+            with assert_raises(ValueError) as cm:
+                owner(x)
+            assert str(owner) in str(cm.exception)
+        # invalid nested value
+        with assert_raises(ValueError):
+            validator(dict(name='a.cfg', owner=dict(name='u'), items={}))
+        with assert_raises(ValueError):
+            owner('not json')
+        # optional keys may be missing, but not all keys are optional
+        f = defined_dictionary(
+            keys=dict(name=str, template=unicode, template_id=str),
+            optional=['template', 'template_id'])
+        eq_(f(dict(name='a.cfg', template_id='x')),
+            dict(name='a.cfg', template_id='x'))
+        for x in (dict(template_id='x'), dict(name='a.cfg', x=1)):
+            with assert_raises(ValueError):
+                f(x)
+
+    def test_union_dictionary(self):
+        """ [input     ] union dictionary test """
+        validator = union_dictionary(key_type=unicode, value_type=int)
+        eq_(validator({u'a': '1', u'b': 2}), {u'a': 1, u'b': 2})
+        eq_(validator({}), {})
+        with assert_raises(ValueError) as cm:
+            validator({u'a': 'x'})
+        assert str(validator) in str(cm.exception)
+
+    def test_ip(self):
+        """ [input     ] ip test """
+        eq_(ip('127.0.0.1'), '127.0.0.1')
+        for x in ('127.0.0.0/24', '127.0.0.1-2', 'localhost'):
+            assert_raises(ValueError, ip, x)
+
+    def test_batch_size(self):
+        """ [input     ] batch size test """
+        eq_(batch_size('2'), '2')
+        eq_(batch_size(' 25% '), '25%')
+        eq_(batch_size('100%'), '100%')
+        for x in ('0', '0%', '101%', '-1', 'x', '2.5'):
+            assert_raises(ValueError, batch_size, x)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Leann Mak, leannmak@139.com, (c) 2018.
+# This is the autotest cases for model module.
+#
+
+import sys
+sys.path.append('.')
+
+import json
+import threading
+from datetime import datetime, timedelta
+from nose.tools import with_setup, eq_, assert_raises
+from mock import Mock
+
+from sakura import app, config_app, db
+from sakura import constant as C
+from sakura.util import remove_folder
+from sakura.model import (
+    TaskManager, TaskLock, TaskPayload, ProgressRecorder, ProgressPublisher,
+    ProgressStore, DatabaseProgressStore, PayloadStore)
+
+
+class TestModel():
+    """ unit tests for models of sakura.
+    """
+    def setUp(self):
+        app.testing = True
+        config_app(app, instance_config='test_config.py')
+
+    # clean up the garbage data
+    def tearDown(self):
+        remove_folder(app.config['TEST_FOLDER'])
+
+    @with_setup(setUp, tearDown)
+    def test_progress_recorder(self):
+        """ [model     ] progress recorder test """
+        manager, task = Mock(_recorders={}), Mock()
+        task.request.id = 'test'
+        recorder = ProgressRecorder(manager=manager, task=task, interval=60)
+        progress = C.TASK_STATE.PROGRESS.value
+        # state changed, step flag written at once
+        recorder.step(state=progress, meta=dict(current=0), flag=1)
+        eq_(task.update_state.call_count, 1)
+        eq_(manager.update.call_args[1], dict(task_id='test', step=1))
+        # coalesced within the interval but the step flag
+        recorder.step(state=progress, meta=dict(current=10), flag=2)
+        recorder.step(state=progress, meta=dict(current=20))
+        eq_(task.update_state.call_count, 1)
+        eq_(manager.update.call_count, 2)
+        eq_(manager.update.call_args[1], dict(task_id='test', step=2))
+        # state changed again
+        recorder.step(state=C.TASK_STATE.SUCCESS.value, meta=dict(current=100))
+        eq_(task.update_state.call_count, 2)
+        eq_(task.update_state.call_args[1]['meta'], dict(current=100))
+        # other columns written once when closed
+        recorder.close(state=C.TASK_STATE.SUCCESS.value)
+        eq_(manager.update.call_count, 3)
+        eq_(manager.update.call_args[1], dict(
+            task_id='test', state=C.TASK_STATE.SUCCESS.value))
+
+    @with_setup(setUp, tearDown)
+    def test_progress_recorder_running_step(self):
+        """ [model     ] progress recorder running step test """
+        store, task, shown = ProgressStore(ttl=60), Mock(), []
+        task.request.id = 'running'
+        manager = TaskManager()
+        manager._recorders['running'] = ProgressRecorder(
+            manager=manager, task=task, interval=60, store=store)
+
+        def running():
+            shown.append(store.get(task_id='running')['meta']['message'])
+        try:
+            # a slow step right after a fast one within the interval
+            manager.task_step(task=task, name=running, message='fast')
+            manager.task_step(task=task, name=running, message='slow')
+            eq_(shown, ['fast', 'slow'])
+        finally:
+            manager._recorders.pop('running', None)
+
+    @with_setup(setUp, tearDown)
+    def test_local_progress_store(self):
+        """ [model     ] local progress store test """
+        store = ProgressStore(ttl=60)
+        eq_(store.get(task_id='test'), None)
+        # the in-memory store by name
+        app.config['SAKURA_PROGRESS_STORE'] = 'local'
+        ProgressStore._instance = None
+        eq_(type(ProgressStore.instance()), ProgressStore)
+        ProgressStore._instance = None
+        eq_(store.set(task_id='test', state='PROGRESS', meta=dict(current=0)), 1)
+        eq_(store.set(task_id='test', state='SUCCESS', meta=dict(current=100)), 2)
+        # read many times
+        for x in range(2):
+            eq_(store.get(task_id='test'), dict(
+                state='SUCCESS', meta=dict(current=100), version=2))
+        # written to the store instead of the result backend
+        task = Mock()
+        task.request.id = 'recorded'
+        recorder = ProgressRecorder(
+            manager=Mock(_recorders={}), task=task, store=store)
+        recorder.step(state='PROGRESS', meta=dict(current=0))
+        eq_(task.update_state.call_count, 0)
+        eq_(store.get(task_id='recorded')['version'], 1)
+
+    @with_setup(setUp, tearDown)
+    def test_payload_store(self):
+        """ [model     ] payload store test """
+        store = PayloadStore(threshold=64)
+        # small values kept in the row
+        eq_(store.pack('{"a": 1}'), ('{"a": 1}', None))
+        eq_(store.pack(None), (None, None))
+        value = json.dumps(dict(
+            service_name='s', env_name='e', files=[u'文件'] * 100))
+        ref, payload = store.pack(value)
+        assert store.is_ref(ref)
+        assert not store.is_ref(value)
+        assert len(payload['data']) < len(value)
+        eq_(payload['size'], len(value))
+        # the row keeps a digest and the scalar items
+        eq_(json.loads(ref)['summary'], dict(service_name='s', env_name='e'))
+        eq_(json.loads(ref)['__payload__'], payload['digest'])
+        eq_(store.unpack(ref, payload['data']), value)
+        eq_(store.load(
+            task_id='test', name='kwargs', value=ref,
+            payloads={('test', 'kwargs'): payload['data']}), value)
+        eq_(store.load(task_id='test', name='kwargs', value=value), value)
+        # corrupted
+        with assert_raises(Exception):
+            store.unpack(ref, store.pack(value + ' ')[1]['data'])
+
+    @with_setup(setUp, tearDown)
+    def test_payload_offload(self):
+        """ [model     ] payload offload test """
+        app.config['SAKURA_PAYLOAD_THRESHOLD'] = 64
+        db.create_all()
+        try:
+            kwargs = json.dumps(dict(
+                service_name='s', files=[dict(template=u'模板' * 100)]))
+            info = json.dumps(dict(message='checked', data=['x' * 100]))
+            TaskManager().insert(
+                task_id='a', name=C.TASK_NAME.CONFIGURATION_UPDATE.value,
+                kwargs=kwargs, state=C.TASK_STATE.PROGRESS.value,
+                begin_time=datetime.now())
+            TaskManager().update(task_id='a', info=info)
+            db.session.remove()
+            # rows keep references, values compressed out of them
+            row = db.session.query(
+                TaskManager.kwargs, TaskManager.info).filter_by(
+                task_id='a').one()
+            store = PayloadStore()
+            assert store.is_ref(row.kwargs) and store.is_ref(row.info)
+            eq_(json.loads(row.kwargs)['summary'], dict(service_name='s'))
+            eq_(sorted((x.name, x.size) for x in TaskPayload.query.all()),
+                [('info', len(info)), ('kwargs', len(kwargs.encode('utf-8')))])
+            # resolved when read back, one by one or all at once
+            manager = TaskManager()
+            obj = manager.getObject(task_id='a')
+            eq_((obj._to_dict()['kwargs'], obj._to_dict()['info']),
+                (kwargs, info))
+            eq_(obj.loads('kwargs')['service_name'], 's')
+            eq_(manager.get(fields=['kwargs', 'info']),
+                [dict(kwargs=kwargs, info=info)])
+            # small values kept in the row
+            TaskManager().update(task_id='a', info='{}')
+            eq_(manager.getObject(task_id='a')._to_dict()['info'], '{}')
+            # references without payloads
+            TaskPayload.query.delete()
+            db.session.commit()
+            db.session.remove()
+            with assert_raises(Exception):
+                manager.getObject(task_id='a').loads('kwargs')
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+    @with_setup(setUp, tearDown)
+    def test_progress_publisher(self):
+        """ [model     ] progress publisher test """
+        publisher, published = ProgressPublisher(size=2), []
+        event = threading.Event()
+
+        def publish(**kwargs):
+            event.wait()
+            published.append(kwargs['current'])
+        publisher.publish('test', publish, current=0)
+        # latest progress of a task waiting replaces the previous one
+        publisher.publish('test', publish, current=10)
+        publisher.publish('test', publish, current=20)
+        eq_(publisher.flush(key='test', timeout=0.1), False)
+        event.set()
+        eq_(publisher.flush(key='test', timeout=5), True)
+        eq_(published[-1], 20)
+        assert 10 not in published
+        # published by the recorder before closed
+        task = Mock()
+        task.request.id = 'published'
+        recorder = ProgressRecorder(
+            manager=Mock(_recorders={}), task=task, publisher=publisher)
+        recorder.step(state='PROGRESS', meta=dict(current=0))
+        recorder.close(state='SUCCESS')
+        eq_(task.update_state.call_count, 1)
+
+    @with_setup(setUp, tearDown)
+    def test_database_progress_store(self):
+        """ [model     ] database progress store test """
+        db.create_all()
+        try:
+            store = DatabaseProgressStore(ttl=60)
+            eq_(store.get(task_id='test'), None)
+            # changes of the running task left pending
+            db.session.add(TaskLock(
+                service_name='sakura', env_name='test', service_version='1',
+                task_id='test', lock_time=datetime.now()))
+            store.set(task_id='test', state='PROGRESS', meta=dict(current=0))
+            store.set(task_id='test', state='SUCCESS', meta=dict(current=100))
+            eq_(len(db.session.new), 1)
+            eq_(store.get(task_id='test'), dict(
+                state='SUCCESS', meta=dict(current=100), version=2))
+            db.session.rollback()
+            # expired entries purged
+            eq_(store.purge(), 0)
+            store._ttl = -1
+            eq_(store.get(task_id='test'), None)
+            eq_(store.purge(), 1)
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+    @with_setup(setUp, tearDown)
+    def test_task_lock(self):
+        """ [model     ] task lock test """
+        db.create_all()
+        try:
+            key = dict(service_name='sakura', env_name='test',
+                       service_version='1')
+            lock = TaskLock()
+            eq_(lock.acquire(task_id='a', **key), None)
+            # held by a queued task not recorded yet
+            eq_(lock.acquire(task_id='b', **key), 'a')
+            eq_(TaskLock.holder(**key), 'a')
+            # given back if the task could not be sent
+            eq_(TaskLock.release(task_id='b', **key), 0)
+            eq_(TaskLock.release(task_id='a', **key), 1)
+            eq_(TaskLock.holder(**key), None)
+            eq_(lock.acquire(task_id='b', **key), None)
+            # held while the recorded task is unacknowledged, whatever its age
+            app.config['SAKURA_TASK_LOCK_TIMEOUT'] = 0
+            TaskManager().insert(
+                task_id='b', name=C.TASK_NAME.CONFIGURATION_UPDATE.value,
+                kwargs=json.dumps(key), state=C.TASK_STATE.PROGRESS.value,
+                begin_time=datetime.now() - timedelta(days=1))
+            eq_(lock.acquire(task_id='c', **key), 'b')
+            TaskManager().update(
+                task_id='b', ack_status=getattr(
+                    C.CONFIGURATION_UPDATE_ACK_STATE,
+                    C.TASK_NAME.CONFIGURATION_ACKNOWLEDGE.value).value)
+            eq_(lock.acquire(task_id='c', **key), None)
+            # expired if never recorded, task `c` finds it taken on starting
+            eq_(lock.acquire(task_id='d', **key), None)
+            eq_(TaskLock.holder(**key), 'd')
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+    @with_setup(setUp, tearDown)
+    def test_task_pagination(self):
+        """ [model     ] task pagination test """
+        db.create_all()
+        try:
+            now = datetime.now().replace(microsecond=0)
+            # tasks `c`, `d` and `e` begun at the same time
+            for i, x in enumerate('abcde'):
+                TaskManager().insert(
+                    task_id=x, name=C.TASK_NAME.CONFIGURATION_CHECK.value,
+                    kwargs='{}', state=C.TASK_STATE.SUCCESS.value,
+                    begin_time=now + timedelta(seconds=min(i, 2)))
+            manager = TaskManager()
+            # keyset pages in order of begin_time and task_id desc
+            data, cursor = manager.get_after(per_page=2)
+            eq_([x['task_id'] for x in data], ['e', 'd'])
+            data, cursor = manager.get_after(cursor=cursor, per_page=2)
+            eq_([x['task_id'] for x in data], ['c', 'b'])
+            data, cursor = manager.get_after(cursor=cursor, per_page=2)
+            eq_(([x['task_id'] for x in data], cursor), (['a'], None))
+            # together with filters
+            data, cursor = manager.get_after(
+                per_page=1, name=C.TASK_NAME.CONFIGURATION_CHECK.value)
+            eq_([x['task_id'] for x in data], ['e'])
+            data, cursor = manager.get_after(
+                per_page=1, name=C.TASK_NAME.CONFIGURATION_UPDATE.value)
+            eq_((data, cursor), ([], None))
+            assert_raises(ValueError, manager.get_after, cursor='invalid')
+            # total pages counted or not
+            data, pages = manager.get(page=2, per_page=2)
+            eq_(([x['task_id'] for x in data], pages), (['c', 'b'], 3))
+            data, pages = manager.get(page=2, per_page=2, count=False)
+            eq_(([x['task_id'] for x in data], pages), (['c', 'b'], None))
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+    @with_setup(setUp, tearDown)
+    def test_task_projection(self):
+        """ [model     ] task projection test """
+        db.create_all()
+        try:
+            TaskManager().insert(
+                task_id='a', name=C.TASK_NAME.CONFIGURATION_CHECK.value,
+                kwargs='{}', state=C.TASK_STATE.SUCCESS.value,
+                info=json.dumps(dict(message='checked')),
+                begin_time=datetime.now())
+            db.session.remove()
+            manager = TaskManager()
+            # payload columns deferred by default
+            data = manager.get()
+            assert 'state' in data[0]
+            assert 'info' not in data[0] and 'kwargs' not in data[0]
+            # only the fields requested
+            data, cursor = manager.get_after(fields=['state', 'info'])
+            eq_(data, [dict(state=C.TASK_STATE.SUCCESS.value,
+                            info=json.dumps(dict(message='checked')))])
+            # a single task with its full payload
+            data = manager.getObject(task_id='a')._to_dict()
+            eq_((data['kwargs'], json.loads(data['info'])),
+                ('{}', dict(message='checked')))
+        finally:
+            db.session.remove()
+            db.drop_all()
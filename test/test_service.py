@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Leann Mak, leannmak@139.com, (c) 2018.
+# This is the autotest cases for service module.
+#
+
+import sys
+sys.path.append('.')
+
+import json
+from datetime import datetime, timedelta
+from nose.tools import with_setup, eq_, assert_raises
+from mock import patch
+from flask import request
+
+from sakura import app, config_app, db
+from sakura import constant as C
+from sakura.release import __version__
+from sakura.util import remove_folder
+from sakura.model import TaskManager
+from sakura.service import (
+    SakuraInvalidAccessError, SakuraPayloadTooLargeError, TaskListAPI,
+    ConfigurationCheckAPI, read_body, load_json)
+
+
+class TestService():
+    """ unit tests for services of sakura.
+    """
+    def setUp(self):
+        app.testing = True
+        config_app(app, instance_config='test_config.py')
+        self.client = app.test_client()
+
+    # clean up the garbage data
+    def tearDown(self):
+        remove_folder(app.config['TEST_FOLDER'])
+
+    def _url(self, identifier):
+        return '/api/v{0}/sakura/{1}'.format(__version__, identifier)
+
+    def _tasks(self, count):
+        """ record tasks begun one second after another """
+        now = datetime.now().replace(microsecond=0)
+        for i in range(count):
+            TaskManager().insert(
+                task_id=str(i), name=C.TASK_NAME.CONFIGURATION_CHECK.value,
+                kwargs=json.dumps(dict(hosts=['127.0.0.1'])),
+                state=C.TASK_STATE.SUCCESS.value,
+                info=json.dumps(dict(message='checked')),
+                begin_time=now + timedelta(seconds=i))
+
+    @with_setup(setUp, tearDown)
+    def test_task_list_pagination(self):
+        """ [service   ] task list pagination test """
+        db.create_all()
+        try:
+            self._tasks(3)
+            # keyset pages from an empty cursor
+            resp = self.client.get(self._url('task?cursor=&pp=2'))
+            ret = json.loads(resp.data)
+            eq_([x['task_id'] for x in ret['data']], ['2', '1'])
+            resp = self.client.get(self._url(
+                'task?cursor={0}&pp=2'.format(ret['cursor'])))
+            ret = json.loads(resp.data)
+            eq_(([x['task_id'] for x in ret['data']], ret['cursor']),
+                (['0'], None))
+            resp = self.client.get(self._url('task?cursor=invalid'))
+            eq_(resp.status_code, 400)
+            # total pages skipped
+            ret = json.loads(self.client.get(
+                self._url('task?page=1&pp=2')).data)
+            eq_(ret['totalpage'], 2)
+            ret = json.loads(self.client.get(
+                self._url('task?page=1&pp=2&count=false')).data)
+            eq_((len(ret['data']), ret['totalpage']), (2, False))
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+    @with_setup(setUp, tearDown)
+    def test_task_list_fields(self):
+        """ [service   ] task list fields test """
+        db.create_all()
+        try:
+            self._tasks(1)
+            db.session.remove()
+            # payload columns left out by default
+            ret = json.loads(self.client.get(self._url('task')).data)
+            assert 'info' not in ret['data'][0]
+            ret = json.loads(self.client.get(
+                self._url('task?fields=task_id, info')).data)
+            eq_(ret['data'], [dict(
+                task_id='0', info=json.dumps(dict(message='checked')))])
+            resp = self.client.get(self._url('task?fields=unknown'))
+            eq_(resp.status_code, 400)
+            # a single task with its full payload
+            ret = json.loads(self.client.get(self._url('task/0')).data)
+            eq_(json.loads(ret['data']['kwargs']), dict(hosts=['127.0.0.1']))
+            resp = self.client.get(self._url('task/1'))
+            eq_(resp.status_code, 404)
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+    @with_setup(setUp, tearDown)
+    def test_read_body(self):
+        """ [service   ] read body test """
+        app.config['SAKURA_BODY_CHUNK_SIZE'] = 4
+        body = json.dumps(dict(hosts=['127.0.0.1']))
+        with app.test_request_context(
+                method='POST', data=body, content_type='application/json'):
+            # no limit
+            eq_(read_body(limit=None), body)
+        with app.test_request_context(
+                method='POST', data=body, content_type='application/json'):
+            assert_raises(SakuraPayloadTooLargeError, read_body, limit=8)
+        # parsed once for reqparse
+        app.config['SAKURA_MAX_BODY_SIZE'] = None
+        with app.test_request_context(
+                method='POST', data=body, content_type='application/json'):
+            eq_(load_json(), dict(hosts=['127.0.0.1']))
+            eq_(request.get_json(), dict(hosts=['127.0.0.1']))
+        with app.test_request_context(
+                method='POST', data='{', content_type='application/json'):
+            assert_raises(SakuraInvalidAccessError, load_json)
+        # other bodies limited as well
+        app.config['SAKURA_MAX_BODY_SIZE'] = 8
+        with app.test_request_context(
+                method='POST', data=dict(hosts='127.0.0.1')):
+            assert_raises(SakuraPayloadTooLargeError, load_json)
+
+    @with_setup(setUp, tearDown)
+    def test_blob(self):
+        """ [service   ] blob test """
+        with patch('sakura.service.TemplateStore') as store:
+            # templates should be utf-8
+            resp = self.client.post(
+                self._url('blob'), data=u'hello 世界'.encode('gbk'),
+                content_type='text/plain')
+            eq_(resp.status_code, 400)
+            eq_(store.call_count, 0)
+            store.return_value.save.return_value = 'id'
+            resp = self.client.post(
+                self._url('blob'), data=u'hello 世界'.encode('utf-8'),
+                content_type='text/plain')
+            eq_(resp.status_code, 201)
+            eq_(json.loads(resp.data)['id'], 'id')
+
+    @with_setup(setUp, tearDown)
+    def test_compile(self):
+        """ [service   ] compile test """
+        # parsers built once, models created per request
+        eq_(TaskListAPI().parser, TaskListAPI.parser)
+        assert 'name' in TaskListAPI.params
+        assert 'info' not in TaskListAPI.params
+        assert TaskListAPI().obj is not TaskListAPI().obj
+        assert ConfigurationCheckAPI().task is not ConfigurationCheckAPI().task
+
+        # arguments declared by post_params, which is left untouched
+        class EchoAPI(ConfigurationCheckAPI):
+            post_params = dict(hosts=dict(
+                type=str, action='append', required=True, help='No Hosts'))
+        EchoAPI.compile()
+        eq_(EchoAPI.post_params['hosts']['help'], 'No Hosts')
+        eq_([(x.name, x.help) for x in EchoAPI.parser.args],
+            [('hosts', 'No Hosts')])
+        assert EchoAPI.parser is not ConfigurationCheckAPI.parser
+        # only parsed per request
+        body = dict(
+            files=[dict(
+                name='test.cfg', dir='/test', mode='0644',
+                owner=dict(name='u', group='g'), template_id='test',
+                items={})],
+            hosts=['127.0.0.1'])
+        with app.test_request_context(
+                method='POST', data=json.dumps(body),
+                content_type='application/json'):
+            args = ConfigurationCheckAPI()._parse_args()
+            eq_((args['hosts'], args['files'][0]['template_id']),
+                (['127.0.0.1'], 'test'))
+        body.pop('files')
+        with app.test_request_context(
+                method='POST', data=json.dumps(body),
+                content_type='application/json'):
+            assert_raises(
+                SakuraInvalidAccessError, ConfigurationCheckAPI()._parse_args)
+
+    @with_setup(setUp, tearDown)
+    def test_configuration_update_unsent(self):
+        """ [service   ] configuration update unsent test """
+        body = dict(
+            service_name='sakura', env_name='test', service_version='1',
+            files=[dict(
+                name='test.cfg', dir='/test', mode='0644',
+                owner=dict(name='u', group='g'), template='test',
+                items={})],
+            hosts=['127.0.0.1'])
+        with patch('sakura.service.TaskLock') as lock, \
+                patch('sakura.service.check_templates'), \
+                patch('sakura.service.SakuraTask') as task:
+            lock.return_value.acquire.return_value = None
+            task.return_value.configuration_update.apply_async.side_effect = \
+                Exception('Broker Unavailable')
+            resp = self.client.post(
+                self._url('cfg_upd'), data=json.dumps(body),
+                content_type='application/json')
+            eq_(resp.status_code, 500)
+            # the lock taken for the task is given back
+            task_id = lock.return_value.acquire.call_args[1]['task_id']
+            eq_(lock.release.call_args[1], dict(
+                task_id=task_id, service_name='sakura', env_name='test',
+                service_version='1'))
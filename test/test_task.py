@@ -70,3 +70,76 @@ class TestTask():
         eq_(Etconf.check_files.call_count, 1)
         eq_(state, C.TASK_STATE.SUCCESS)
         eq_(meta['data'], [return_value])
+
+    @with_setup(setUp, tearDown)
+    def test_configuration_check_same_name(self):
+        """ [task      ] configuration check with same names test """
+        files = [
+            dict(name=x, dir=y, mode='0755', template='hello world!', items={},
+                 owner={'name': 'leannmak', 'group': 'leannmak'})
+            for x, y in [('a.cfg', '/x'), ('a.cfg', '/y'), ('b.cfg', '/x')]]
+        # same names are checked in separate batches
+        Etconf.check_files = Mock(side_effect=[
+            {'a.cfg': '/x', 'b.cfg': '/x'}, {'a.cfg': '/y'}])
+        task = SakuraTask()
+        state, meta = task.configuration_check(files=files, hosts=['127.0.0.1'])
+        eq_(Etconf.check_files.call_count, 2)
+        eq_(state, C.TASK_STATE.SUCCESS)
+        # results follow the order of files requested
+        eq_(meta['data'], [{'a.cfg': '/x'}, {'a.cfg': '/y'}, {'b.cfg': '/x'}])
+
+    @with_setup(setUp, tearDown)
+    def test_configuration_rollback_sub_task(self):
+        """ [task      ] configuration rollback sub task test """
+        # nothing to rollback before the backup step
+        main_task = Mock(task_id='main', step=1)
+        state, meta = SakuraTask().configuration_rollback(main_task=main_task)
+        eq_(state, C.TASK_STATE.SUCCESS)
+        # the main task links its sub task once it starts
+        calls = [x[1] for x in SakuraTask.update.call_args_list
+                 if x[1].get('task_id') == 'main']
+        eq_(calls[0], dict(task_id='main', sub_task_id=None))
+        eq_(calls[-1]['ack_status'], getattr(
+            C.CONFIGURATION_UPDATE_ACK_STATE,
+            C.TASK_NAME.CONFIGURATION_ROLLBACK.value).value)
+
+    @with_setup(setUp, tearDown)
+    def test_configuration_update_lock_taken(self):
+        """ [task      ] configuration update with lock taken test """
+        kwargs = dict(
+            service_name='sakura', env_name='test', service_version='1',
+            files=[], hosts=['127.0.0.1'])
+        # the lock expired while queued and was taken by another task
+        with patch('sakura.task.TaskLock') as lock, \
+                patch('sakura.task.Etconf') as etconf:
+            lock.holder.return_value = 'other'
+            state, meta = SakuraTask().configuration_update(**kwargs)
+            eq_(state, C.TASK_STATE.FAILURE)
+            eq_(etconf.call_count, 0)
+
+    @with_setup(setUp, tearDown)
+    def test_configuration_update_gate_failure(self):
+        """ [task      ] configuration update with health gate failure test """
+        hosts = ['127.0.0.1', '127.0.0.2', '127.0.0.3']
+        kwargs = dict(
+            service_name='sakura', env_name='test', service_version='1',
+            files=[], hosts=hosts, batch_size='1', health_gate='status')
+        with patch('sakura.task.TaskLock') as lock, \
+                patch('sakura.task.Etconf') as etconf:
+            lock.holder.return_value = None
+            etconf = etconf.return_value
+            etconf.rollout_hosts.return_value = hosts
+            etconf.delta_pushes.side_effect = \
+                lambda plan, hosts: [(hosts, None)]
+            # the second batch is unhealthy
+            etconf.health_gate.side_effect = [None, Exception('Unhealthy')]
+            state, meta = SakuraTask().configuration_update(**kwargs)
+            eq_(state, C.TASK_STATE.FAILURE)
+            eq_(etconf.health_gate.call_count, 2)
+            # confd of hosts not rolled yet started again
+            eq_([x[1] for x in etconf.confd_cmd.call_args_list], [
+                dict(action='stop', hosts=hosts),
+                dict(action='start', hosts=hosts[:1]),
+                dict(action='start', hosts=hosts[1:2]),
+                dict(action='start', hosts=hosts[2:])])
+            eq_(meta['error'], 'Unhealthy')
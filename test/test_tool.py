@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Leann Mak, leannmak@139.com, (c) 2018.
+# This is the autotest cases for tool module.
+#
+
+import sys
+sys.path.append('.')
+
+import os
+import json
+import base64
+import tarfile
+from io import BytesIO
+from datetime import datetime
+from mock import patch, Mock
+from nose.tools import with_setup, eq_, assert_raises
+
+from sakura import app, config_app
+from sakura import constant as C
+from sakura.util import get_folder, remove_folder, md5hex
+from sakura.tool import (
+    Etconf, ClientRegistry, HostExecutor, HostExecutionError, TemplateRenderer,
+    RolloutScheduler, BackupStore, TemplateStore, EtcdBulkWriter)
+
+
+def make_etconf(**kwargs):
+    """ Etconf without clients, attributes set by kwargs """
+    etconf = Etconf.__new__(Etconf)
+    etconf._env, etconf._service, etconf._version = 'test', 'sakura', '1'
+    etconf._r_toml = '/etc/confd/conf.d'
+    etconf._r_tmpl = '/etc/confd/templates'
+    etconf._snapshots, etconf._ansible_kwargs, etconf._keys = {}, {}, {}
+    etconf._key_meta_pre, etconf._key_bak_pre = 'meta', 'bak'
+    etconf._check_cmd, etconf._reload_cmd = 'true', 'true'
+    etconf._files, etconf._hosts = [], []
+    for k, v in kwargs.items():
+        setattr(etconf, '_{0}'.format(k), v)
+    return etconf
+
+
+class FakeMinio(object):
+    """ minio client keeping objects in memory """
+    def __init__(self):
+        # object name -> (content, last modified)
+        self.objects = {}
+
+    def fput_object(self, bucket_name, object_name, file_path):
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        self.objects[object_name] = (content, datetime.utcnow())
+        return md5hex(content)
+
+    def fget_object(self, bucket_name, object_name, file_path):
+        get_folder(os.path.dirname(file_path))
+        with open(file_path, 'wb') as f:
+            f.write(self.objects[object_name][0])
+
+    def list_objects(self, bucket_name, prefix, recursive=False):
+        ret = {}
+        for name, (content, mtime) in self.objects.items():
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if not recursive and '/' in rest:
+                # folders are listed once
+                name = prefix + rest.split('/')[0] + '/'
+            ret[name] = Mock(object_name=name, last_modified=mtime)
+        return ret.values()
+
+    def remove_objects(self, bucket_name, objects_iter):
+        for x in objects_iter:
+            self.objects.pop(x, None)
+        return iter([])
+
+
+class TestTool():
+    """ unit tests for tools of sakura.
+    """
+    def setUp(self):
+        app.testing = True
+        config_app(app, instance_config='test_config.py')
+
+    # clean up the garbage data
+    def tearDown(self):
+        remove_folder(app.config['TEST_FOLDER'])
+
+    @with_setup(setUp, tearDown)
+    def test_remote_file_content(self):
+        """ [tool      ] remote toml/tmpl content test """
+        host = '127.0.0.1'
+        etconf = make_etconf()
+        with patch('sakura.tool.Ansible2API'), patch(
+                'sakura.tool.ansible_safe_run') as run:
+            # read by absolute path when no snapshot of the host
+            run.return_value = (0, {}, {host: dict(
+                stdout_lines=['[template]', 'mode = "0644"'])})
+            eq_(etconf.get_toml_content(cfg_name='a.cfg', host=host),
+                dict(mode='0644'))
+            eq_(run.call_args[1]['args'],
+                'cat /etc/confd/conf.d/test.sakura.1.a.cfg.toml')
+            run.return_value = (0, {}, {host: dict(stdout='hello')})
+            eq_(etconf.get_tmpl_content(cfg_name='a.cfg', host=host),
+                'hello\r\n')
+            eq_(run.call_args[1]['args'],
+                'cat /etc/confd/templates/test/sakura/1/a.cfg.tmpl')
+
+    @with_setup(setUp, tearDown)
+    def test_host_executor(self):
+        """ [tool      ] host executor test """
+        hosts = ['127.0.0.%s' % x for x in range(1, 6)]
+        # success
+        results = HostExecutor(parallelism=3).run(
+            action='Test', hosts=hosts, func=lambda host, n: n, n=1)
+        eq_(sorted(results.keys()), hosts)
+        eq_(set(x['state'] for x in results.values()),
+            set([C.HOST_STATE.SUCCESS.value]))
+        eq_(set(x['result'] for x in results.values()), set([1]))
+        # run in host processes without clients of this process
+        ClientRegistry._clients['test'] = Mock()
+        try:
+            results = HostExecutor(parallelism=3).run(
+                action='Test', hosts=hosts, func=lambda host: (
+                    os.getpid(), len(ClientRegistry._clients)))
+        finally:
+            ClientRegistry._clients.pop('test')
+        pids = set(x['result'][0] for x in results.values())
+        assert os.getpid() not in pids and len(pids) <= 3
+        eq_(set(x['result'][1] for x in results.values()), set([0]))
+
+        # failure collected per host
+        def func(host):
+            if host == hosts[0]:
+                raise Exception('boom')
+        with assert_raises(HostExecutionError) as cm:
+            HostExecutor(parallelism=1, fail_fast=False).run(
+                action='Test', hosts=hosts, func=func)
+        eq_(cm.exception.results[hosts[0]],
+            dict(state=C.HOST_STATE.FAILURE.value, error='boom'))
+        eq_(len([x for x in cm.exception.results.values()
+                 if x['state'] == C.HOST_STATE.SUCCESS.value]), 4)
+        # fail fast skips the remaining hosts
+        with assert_raises(HostExecutionError) as cm:
+            HostExecutor(parallelism=1, fail_fast=True).run(
+                action='Test', hosts=hosts, func=func)
+        eq_(len([x for x in cm.exception.results.values()
+                 if x['state'] == C.HOST_STATE.SKIPPED.value]), 4)
+
+    @with_setup(setUp, tearDown)
+    def test_template_renderer(self):
+        """ [tool      ] template renderer test """
+        template = u'{{getv "/who"}} {{getv  "/what"}} {{getv "/whom"}}.\r\n'
+        items = {u'who': u'jay', u'what': u'\\1 plays'}
+        eq_(TemplateRenderer.render(template=template, items=items),
+            u'jay \\1 plays {{getv "/whom"}}.\r\n')
+        # memoized
+        size = len(TemplateRenderer._cache)
+        eq_(TemplateRenderer.render(template=template, items=dict(items)),
+            u'jay \\1 plays {{getv "/whom"}}.\r\n')
+        eq_(len(TemplateRenderer._cache), size)
+        # inline templates keyed by their digest
+        eq_(TemplateRenderer._cache.get(
+            (md5hex(template), md5hex(json.dumps(items, sort_keys=True)))),
+            u'jay \\1 plays {{getv "/whom"}}.\r\n')
+        # keyed by the id of an uploaded template instead of its content
+        TemplateRenderer._cache.clear()
+        eq_(TemplateRenderer.render(
+            template=template, items=items, template_id='id'),
+            u'jay \\1 plays {{getv "/whom"}}.\r\n')
+        eq_(TemplateRenderer._cache.get(
+            ('id', md5hex(json.dumps(items, sort_keys=True)))),
+            u'jay \\1 plays {{getv "/whom"}}.\r\n')
+
+    @with_setup(setUp, tearDown)
+    def test_rollout_scheduler(self):
+        """ [tool      ] rollout scheduler test """
+        hosts = ['127.0.0.%s' % x for x in range(1, 6)]
+        # all hosts in one batch by default
+        eq_(RolloutScheduler(hosts=hosts).batches, [hosts])
+        # number of hosts
+        eq_(RolloutScheduler(hosts=hosts, batch_size='2').batches,
+            [hosts[:2], hosts[2:4], hosts[4:]])
+        # percentage of hosts
+        eq_(RolloutScheduler(hosts=hosts, batch_size='50%').batches,
+            [hosts[:3], hosts[3:]])
+        eq_(RolloutScheduler(hosts=hosts, batch_size='1%').batches,
+            [[x] for x in hosts])
+        eq_(RolloutScheduler(hosts=hosts, max_parallel=2).max_parallel, 2)
+        # forks and parallelism only overridden if max_parallel given
+        executor = HostExecutor()
+        etconf = make_etconf(executor=executor, ansible_forks=20)
+        etconf.throttle(
+            parallelism=RolloutScheduler(hosts=hosts).max_parallel)
+        eq_((etconf._executor, etconf._ansible_forks), (executor, 20))
+        etconf.throttle(parallelism=2)
+        eq_((etconf._executor._parallelism, etconf._ansible_forks), (2, 2))
+
+    @with_setup(setUp, tearDown)
+    def test_delta_plan(self):
+        """ [tool      ] delta plan test """
+        hosts = ['127.0.0.1', '127.0.0.2']
+        files = [
+            dict(name=x, dir='/test', mode='0644',
+                 owner=dict(name='u', group='g'), template=x,
+                 items={'k': 'v'}) for x in ('a.cfg', 'b.cfg')]
+        etconf = make_etconf(files=files, hosts=hosts)
+        applied = dict(
+            files={x['name']: etconf._file_digest(x) for x in files},
+            hosts={x: '1' for x in hosts})
+        keys = {x['name']: dict(x['items']) for x in files}
+
+        def read_keys(key_pre):
+            return applied if key_pre.startswith('/meta/') else keys
+        etconf.read_keys = Mock(side_effect=read_keys)
+        # no change
+        plan = etconf.diff_state()
+        eq_((plan['files'], plan['removed'], plan['items'], plan['hosts']),
+            ([], [], [], []))
+        # one file changed, only pushed to hosts applied before
+        files[0]['template'] = 'changed'
+        plan = etconf.diff_state()
+        eq_((plan['files'], plan['items'], plan['hosts']),
+            (['a.cfg'], [], hosts))
+        eq_(etconf.delta_pushes(plan=plan, hosts=hosts), [(hosts, ['a.cfg'])])
+        eq_(etconf.rollout_hosts(plan=plan), hosts)
+        # a new host gets all files
+        applied['hosts'].pop(hosts[1])
+        plan = etconf.diff_state()
+        eq_(etconf.delta_pushes(plan=plan, hosts=hosts),
+            [([hosts[1]], None), ([hosts[0]], ['a.cfg'])])
+        # key only change pushes no file
+        applied['hosts'][hosts[1]] = '1'
+        files[0]['template'] = 'a.cfg'
+        files[1]['items'] = {'k': 'changed'}
+        etconf._keys = {}
+        plan = etconf.diff_state()
+        eq_((plan['files'], plan['items'], plan['hosts']),
+            ([], ['/test/sakura/1/b.cfg/k'], []))
+        eq_(etconf.delta_pushes(plan=plan, hosts=hosts), [])
+        # items are rendered by any running confd, all hosts rolled out
+        eq_(etconf.rollout_hosts(plan=plan), hosts)
+        eq_(etconf.rollout_hosts(plan=dict(plan, items=[])), [])
+        # all files pushed once a file is removed
+        files.pop()
+        plan = etconf.diff_state()
+        eq_(plan['removed'], ['b.cfg'])
+        eq_(etconf.delta_pushes(plan=plan, hosts=hosts), [(hosts, None)])
+        eq_(etconf.delta_pushes(plan=None, hosts=hosts), [(hosts, None)])
+
+    @with_setup(setUp, tearDown)
+    def test_delta_push(self):
+        """ [tool      ] delta push test """
+        folder = get_folder(os.path.join(app.config['TEST_FOLDER'], 'tmpl'))
+        for x in ('a.cfg', 'b.cfg'):
+            with open(os.path.join(folder, '{0}.tmpl'.format(x)), 'w') as f:
+                f.write(x)
+        etconf = make_etconf(confd_file_mode='0644', confd_owner=('u', 'g'))
+        copied = []
+
+        def copy(**kwargs):
+            copied.append(sorted(os.listdir(kwargs['args']['src'])))
+            return (0, {}, {})
+        with patch('sakura.tool.ansible_safe_run', side_effect=copy) as run:
+            # only the changed files are copied
+            etconf._copy_tmpl(aapi=None, folder='%s/' % folder, files=['a.cfg'])
+            eq_(copied[-1], ['a.cfg.tmpl'])
+            # staged folder removed once pushed
+            eq_(os.path.exists(run.call_args[1]['args']['src']), False)
+            etconf._copy_tmpl(aapi=None, folder='%s/' % folder)
+            eq_(run.call_args[1]['args']['src'], '%s/' % folder)
+            eq_(copied[-1], ['a.cfg.tmpl', 'b.cfg.tmpl'])
+
+    @with_setup(setUp, tearDown)
+    def test_backup_store(self):
+        """ [tool      ] backup store test """
+        minio, host = FakeMinio(), '127.0.0.1'
+        folder = get_folder(os.path.join(app.config['TEST_FOLDER'], 'bak'))
+        paths = {}
+        for x in ('a', 'b', 'c'):
+            paths[x] = os.path.join(folder, x)
+            with open(paths[x], 'w') as f:
+                f.write(x)
+        store = BackupStore(
+            minio=minio, bucket_name='test', folder_pre='test/sakura/1',
+            generations=1)
+
+        def blobs():
+            return sorted(x for x in minio.objects if x.startswith('blob/'))
+        # content stored once
+        store.save(host=host, files=dict(
+            tomls={'a.toml': paths['a']}, confs={'a': paths['a']}))
+        eq_(blobs(), ['blob/{0}'.format(md5hex('a'))])
+        store.save(host=host, files=dict(
+            tomls={'b.toml': paths['b']}, confs={'a': paths['a']}))
+        eq_(len(blobs()), 2)
+        # only the latest generation kept
+        eq_(len([x for x in minio.objects if x.startswith('manifest/')]), 1)
+        restored = get_folder(os.path.join(folder, 'restore'))
+        eq_(store.load(host=host, folders=dict(tomls=restored, confs=restored)),
+            dict(tomls={'b.toml': md5hex('b')}, confs={'a': md5hex('a')}))
+        with open(os.path.join(restored, 'b.toml')) as f:
+            eq_(f.read(), 'b')
+        eq_(store.load(host='127.0.0.2', folders={}), None)
+        # templates are kept apart from backup blobs
+        templates = TemplateStore(minio=minio, bucket_name='test')
+        template_id = templates.save(file_path=paths['c'])
+        eq_(template_id, md5hex('c'))
+        assert 'template/{0}'.format(template_id) in minio.objects
+        eq_(len(blobs()), 2)
+        # blobs no more referred are collected, templates are not
+        store.save(host=host, files=dict(tomls={'c.toml': paths['c']}))
+        eq_(store.collect(grace=3600), [])
+        eq_(sorted(store.collect(grace=-1)),
+            ['blob/{0}'.format(md5hex(x)) for x in ('a', 'b')])
+        eq_(blobs(), ['blob/{0}'.format(md5hex('c'))])
+        assert 'template/{0}'.format(template_id) in minio.objects
+        # templates still referred are kept
+        eq_(templates.collect(keep=[template_id], grace=-1), [])
+        eq_(templates.collect(keep=[], grace=-1),
+            ['template/{0}'.format(template_id)])
+
+    @with_setup(setUp, tearDown)
+    def test_etcd_bulk_writer(self):
+        """ [tool      ] etcd bulk writer test """
+        etcd = Mock()
+        eq_(EtcdBulkWriter(etcd, parallelism=2).run(
+            action='Test', writes={'/a': '1', '/b': '2'}, deletes=['/c']),
+            {'/a': 'OK', '/b': 'OK', '/c': 'OK'})
+        eq_(etcd.write.call_count, 2)
+        etcd.delete.assert_called_once_with(key='/c')
+        eq_(EtcdBulkWriter(etcd).run(action='Test'), {})
+        # failures of any key raised
+        etcd.delete.side_effect = Exception('boom')
+        with assert_raises(Exception):
+            EtcdBulkWriter(etcd).run(action='Test', deletes=['/c'])
+
+    @with_setup(setUp, tearDown)
+    def test_snapshot(self):
+        """ [tool      ] files snapshot test """
+        host = '127.0.0.1'
+        folder = os.path.join(app.config['TEST_FOLDER'], 'bak')
+        etconf = make_etconf(
+            files=[dict(name='a.cfg', dir='/test', mode='0644',
+                        owner=dict(name='u', group='g'))],
+            l_toml_bak=os.path.join(folder, 'toml'),
+            l_tmpl_bak=os.path.join(folder, 'tmpl'),
+            l_conf_bak=os.path.join(folder, 'conf'),
+            broken_word_1='i@mMINI0', broken_word_2='iLikeKB')
+        stream = BytesIO()
+        tar = tarfile.open(fileobj=stream, mode='w:gz')
+        for name, content in (
+                ('etc/confd/conf.d/test.sakura.1.a.cfg.toml', 'toml'),
+                ('etc/confd/templates/test/sakura/1/a.cfg.tmpl', 'tmpl'),
+                ('test/a.cfg', 'conf'), ('tmp/other', 'other')):
+            info = tarfile.TarInfo(name=name)
+            info.size = len(content)
+            tar.addfile(info, BytesIO(content))
+        tar.close()
+        with patch('sakura.tool.Ansible2API'), patch(
+                'sakura.tool.ansible_safe_run') as run:
+            run.return_value = (0, {}, {host: dict(
+                stdout=base64.b64encode(stream.getvalue()), stderr='')})
+            ret = etconf.snapshot(host=host)
+            eq_(run.call_count, 1)
+        conf = '0644@@u@@giLikeKBi@mMINI0testi@mMINI0a.cfg'
+        eq_(ret, dict(tomls=['test.sakura.1.a.cfg.toml'],
+                      tmpls=['a.cfg.tmpl'], confs=[conf]))
+        with open(os.path.join(folder, 'conf', host, conf)) as f:
+            eq_(f.read(), 'conf')
+        # answered from the snapshot without remote runs
+        eq_(etconf.get_tomls(host=host), ['test.sakura.1.a.cfg.toml'])
+        eq_(etconf.get_tmpl_content(cfg_name='a.cfg', host=host), 'tmpl\r\n')
+
+    @with_setup(setUp, tearDown)
+    def test_stat_files(self):
+        """ [tool      ] files stat test """
+        host = '127.0.0.1'
+        etconf = make_etconf(hosts=[host])
+        with patch('sakura.tool.Ansible2API'), patch(
+                'sakura.tool.ansible_safe_run') as run:
+            run.return_value = (0, {}, {host: dict(stdout_lines=[
+                '0\t644\tu\tg\t2018-05-22 10:24:10 +0800\t%s' % md5hex('a'),
+                '1\t-'])})
+            eq_(etconf.stat_files(paths=['/test/a.cfg', '/test/b.cfg']), {
+                host: {
+                    '/test/a.cfg': dict(
+                        mode='0644', owner=['u', 'g'],
+                        mtime='2018-05-22 10:24:10 +0800', md5=md5hex('a')),
+                    '/test/b.cfg': None}})
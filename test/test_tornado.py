@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Leann Mak, leannmak@139.com, (c) 2018.
+# This is the autotest cases for tornado_run module.
+#
+
+import sys
+sys.path.append('.')
+
+import json
+import threading
+from nose.tools import eq_
+from tornado.testing import AsyncHTTPTestCase
+
+from sakura import app, config_app
+from sakura import constant as C
+from sakura.release import __version__
+from sakura.util import remove_folder
+from sakura.model import ProgressStore
+from tornado_run import make_application
+
+
+class TestTornado(AsyncHTTPTestCase):
+    """ unit tests for the progress handler of tornado_run.
+    """
+    def setUp(self):
+        app.testing = True
+        config_app(app, instance_config='test_config.py')
+        app.config['SAKURA_PROGRESS_STORE'] = 'local'
+        ProgressStore._instance = None
+        super(TestTornado, self).setUp()
+
+    # clean up the garbage data
+    def tearDown(self):
+        super(TestTornado, self).tearDown()
+        ProgressStore._instance = None
+        remove_folder(app.config['TEST_FOLDER'])
+
+    def get_app(self):
+        return make_application()
+
+    def _url(self, id, since=0):
+        return '/api/v{0}/sakura/progress/{1}?since={2}'.format(
+            __version__, id, since)
+
+    def test_task_progress(self):
+        """ [tornado   ] task progress test """
+        store = ProgressStore.instance()
+        store.set(task_id='test', state=C.TASK_STATE.SUCCESS.value,
+                  meta=dict(current=100))
+        # store lookups run off the IOLoop thread
+        threads, get = [], store.get
+
+        def lookup(task_id):
+            threads.append(threading.current_thread())
+            return get(task_id=task_id)
+        store.get = lookup
+        resp = self.fetch(self._url('test'))
+        eq_(resp.code, 200)
+        ret = json.loads(resp.body)
+        eq_((ret['result']['version'], ret['result']['info']),
+            (1, dict(current=100)))
+        assert threads
+        assert threading.current_thread() not in threads
+        # server-sent events till the task ends
+        resp = self.fetch(
+            self._url('test'), headers={'Accept': 'text/event-stream'})
+        event = resp.body.split('\n')
+        eq_(event[0], 'id: 1')
+        eq_(json.loads(event[1][len('data: '):])['state'],
+            C.TASK_STATE.SUCCESS.value)
+        # nothing newer than the version known
+        app.config['SAKURA_PROGRESS_POLL_TIMEOUT'] = 0
+        resp = self.fetch(self._url('test', since=1))
+        eq_(json.loads(resp.body)['result']['version'], 1)
+        resp = self.fetch(self._url('missing'))
+        eq_(resp.code, 404)
+        resp = self.fetch(self._url('test', since='x'))
+        eq_(resp.code, 400)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Leann Mak, leannmak@139.com, (c) 2018.
+# This is the autotest cases for util module.
+#
+
+import sys
+sys.path.append('.')
+
+from nose.tools import eq_
+from mock import patch
+
+from sakura.util import LRUCache
+
+
+class TestUtil():
+    """ unit tests for utilities of sakura.
+    """
+    def test_lru_cache(self):
+        """ [util      ] lru cache test """
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        eq_(cache.get('a'), 1)
+        # 'b' is the least recently used
+        cache.set('c', 3)
+        eq_(cache.get('b'), None)
+        eq_(cache.get('a'), 1)
+        eq_(cache.get('c'), 3)
+        eq_(len(cache), 2)
+
+    def test_lru_cache_bytes(self):
+        """ [util      ] lru cache bytes test """
+        cache = LRUCache(maxsize=10, maxbytes=5)
+        cache.set('a', 'xx')
+        cache.set('b', 'yyy')
+        eq_(cache.get('a'), 'xx')
+        # 'b' is evicted to keep 5 bytes at most
+        cache.set('c', 'zz')
+        eq_(cache.get('b'), None)
+        eq_((cache.get('a'), cache.get('c')), ('xx', 'zz'))
+        # replaced values are not counted twice
+        cache.set('a', 'x')
+        cache.set('a', 'xx')
+        eq_(len(cache), 2)
+        # values larger than the cache are never kept
+        cache.set('d', 'dddddd')
+        eq_(cache.get('d'), None)
+        eq_(len(cache), 2)
+
+    def test_lru_cache_ttl(self):
+        """ [util      ] lru cache ttl test """
+        cache = LRUCache(maxsize=2, ttl=10)
+        with patch('sakura.util.time.time', return_value=100):
+            cache.set('a', 1)
+        with patch('sakura.util.time.time', return_value=105):
+            eq_(cache.get('a'), 1)
+        with patch('sakura.util.time.time', return_value=111):
+            eq_(cache.get('a', 0), 0)
@@ -4,7 +4,16 @@
 # Leann Mak, leannmak@139.com, (c) 2018.
 #
 
-from sakura import app
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sakura import app, constant as C
+from sakura.model import ProgressStore
+from sakura.release import __version__
+from tornado import gen
+from tornado.concurrent import run_on_executor
+from tornado.iostream import StreamClosedError
+from tornado.web import Application, RequestHandler, FallbackHandler
 from tornado.wsgi import WSGIContainer
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
@@ -16,8 +25,93 @@ from tornado.options import define, options
 define("port", default=5000, help="run on the given port", type=int)
 
 
+class TaskProgressHandler(RequestHandler):
+    """
+        Task Progress Handler.
+        Long-poll (`since=<version>`) or server-sent events of the progress
+        of a task, served on the IOLoop instead of the WSGI workers.
+    """
+    # lookups of the progress store are blocking, ex. a database query
+    executor = ThreadPoolExecutor(
+        max_workers=app.config['SAKURA_PROGRESS_POLL_WORKERS'])
+
+    @run_on_executor
+    def _entry(self, id):
+        with app.app_context():
+            return ProgressStore.instance().get(task_id=id)
+
+    def _result(self, id, entry):
+        return {
+            'id': id, 'state': entry['state'], 'info': entry['meta'],
+            'version': entry['version']}
+
+    def _write_error(self, message, code):
+        self.set_status(code)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps({'error': message, 'status': 1}))
+
+    @gen.coroutine
+    def get(self, id):
+        """ wait for progress of a task newer than version `since`
+        """
+        if not ProgressStore.instance():
+            self._write_error('Progress Store Not Configured', 501)
+            return
+        try:
+            since = int(self.get_argument(
+                'since', self.request.headers.get('Last-Event-ID', 0)))
+        except ValueError:
+            self._write_error(
+                'Invalid Access: since must be an integer', 400)
+            return
+        stream = 'text/event-stream' in self.request.headers.get('Accept', '')
+        interval = app.config['SAKURA_PROGRESS_POLL_INTERVAL']
+        deadline = time.time() + app.config['SAKURA_PROGRESS_POLL_TIMEOUT']
+        if stream:
+            self.set_header('Content-Type', 'text/event-stream')
+            self.set_header('Cache-Control', 'no-cache')
+        entry = None
+        while True:
+            entry = yield self._entry(id)
+            if entry and entry['version'] > since:
+                since = entry['version']
+                if not stream:
+                    break
+                self.write('id: {0}\ndata: {1}\n\n'.format(
+                    since, json.dumps(self._result(id, entry))))
+                try:
+                    yield self.flush()
+                except StreamClosedError:
+                    # client went away
+                    return
+                if entry['state'] in (
+                        C.TASK_STATE.SUCCESS.value,
+                        C.TASK_STATE.FAILURE.value):
+                    break
+            if time.time() >= deadline:
+                break
+            yield gen.sleep(interval)
+        if stream:
+            self.finish()
+        elif entry:
+            self.set_header('Content-Type', 'application/json')
+            self.finish(json.dumps(
+                {'result': self._result(id, entry), 'status': 0}))
+        else:
+            self._write_error(
+                'Object Not Found: Task Progress Not Found: {0}.'.format(id),
+                404)
+
+
+def make_application():
+    return Application([
+        (r'/api/v{0}/sakura/progress/([^/]+)'.format(__version__),
+         TaskProgressHandler),
+        (r'.*', FallbackHandler, dict(fallback=WSGIContainer(app)))])
+
+
 if __name__ == "__main__":
     tornado.options.parse_command_line()
-    http_server = HTTPServer(WSGIContainer(app))
+    http_server = HTTPServer(make_application())
     http_server.listen(options.port)
     IOLoop.instance().start()